@@ -4,16 +4,12 @@ import argparse
 import json
 import logging
 import os
-import subprocess
 import sys
 import time
-import urllib.parse
-import urllib.request
-from datetime import datetime
+from typing import TYPE_CHECKING
 
-import lxml.html as html_parser
-import requests
-from requests import Response
+if TYPE_CHECKING:
+    from ecard_client import ECardManager
 
 __version__ = '2.2.0'
 
@@ -22,28 +18,100 @@ __version__ = '2.2.0'
 # It could be caisse-epargne, sg, labanquepostale, banquepopulaire, banquebcp...
 bank = 'caisse-epargne'
 
-# gopass keys
+# per bank settings, overriding the defaults of the global vars below: service_url, t3ds_host (the 3D Secure host of the
+# bank's cards) and endpoints (paths by http step, see ecard_client.bank_endpoints and t3ds_endpoints), e.g.
+# {'sg': {'t3ds_host': 'https://...', 'endpoints': {'historic': '/historique'}}}
+bank_profiles = {}
+
+# credentials provider: gopass, env, keyring or file (see ecard_credentials.py)
+credentials_provider = 'gopass'
+
+# gopass keys, the login is read from the login_gopass_field of the password's entry if it has one
 login_gopass_location = 'me/sites/e-cartebleue.com/{card} user'
 password_gopass_location = 'me/sites/e-cartebleue.com/{card}'
+login_gopass_field = 'login'
 default_card = 'joint'
+
+# encrypted credentials file (file provider), its passphrase is read from ECARD_CREDENTIALS_PASSPHRASE or prompted
+credentials_file_path = os.path.expanduser('~/.config/ecartebleue/credentials')
+# credentials kept in memory by the daemon, in seconds
+credentials_cache_ttl = 15 * 60
+
+# http connection pool size, per host
+http_pool_size = 4
+# open the connections to the 3D Secure host, and back to the bank, ahead of their first request
+prefetch_connections = True
+
+# http timeouts in seconds, to connect and to read a response, and retries of the failed requests (connection error,
+# timeout or 5xx status) after an exponential backoff from http_retry_backoff seconds. A POST is retried only if it
+# couldn't be sent, unless its step is idempotent; http_step_policies overrides these settings per step (see
+# ecard_client.http_steps), e.g. {'historic': {'read_timeout': 60}}
+http_connect_timeout = 5
+http_read_timeout = 30
+http_retries = 2
+http_retry_backoff = 0.5
+http_step_policies = {'historic': {'idempotent': True}, 'startPolling': {'idempotent': True}}
+# circuit breaker per host: after breaker_failures failed requests in a row, the requests to the host fail at once for
+# breaker_reset_timeout seconds, then a single trial request closes it again, or opens it for another period
+breaker_failures = 5
+breaker_reset_timeout = 30
+
+# request scheduler of the orchestrator and the daemon, pacing the requests below the bank's rate limits: token buckets
+# of scheduler_host_rate requests per second per host, in bursts of up to scheduler_host_burst, and likewise per
+# account; 0 not to limit. Background requests (historic) are rejected at once while scheduler_queue_limit requests
+# wait for their host, and any request after waiting scheduler_max_wait seconds
+scheduler_host_rate = 10
+scheduler_host_burst = 20
+scheduler_account_rate = 5
+scheduler_account_burst = 15
+scheduler_queue_limit = 50
+scheduler_max_wait = 60
+
+# HAR file of the http exchanges of the verbose runs (-v), e.g. os.path.expanduser('~/.cache/ecartebleue/http.har'),
+# None not to capture them. The passwords, PaRes, otp codes and cvv are redacted, not the e-numbers nor the card owner.
+# The file is rotated over http_capture_max_bytes and at each run, keeping http_capture_backups older files
+http_capture_path = None
+http_capture_max_bytes = 10 * 1024 * 1024
+http_capture_backups = 3
+# write buffer of the fixtures recorded by --record, whose response bodies are encoded by chunks of this size
+http_record_buffer_size = 256 * 1024
+
+# session cache (--session-cache), sessions are encrypted with a key derived from the card's password
+session_cache_dir = os.path.expanduser('~/.cache/ecartebleue')
+session_cache_ttl = 10 * 60
+
+# 3D Secure mobile app authentication, maximum time to wait for the approval in seconds
+mobile_app_auth_deadline = 5 * 60
+# 3D Secure sms codes, typed in the terminal or pushed by another process, e.g. an sms forwarder (see ecard_otp.py):
+# terminal, socket (unix socket), fifo (named pipe), webhook (on localhost) or file, polled every otp_poll_interval
+# seconds. A code is awaited otp_timeout seconds
+otp_provider = 'terminal'
+otp_timeout = 5 * 60
+otp_socket_path = os.path.expanduser('~/.cache/ecartebleue/otp.sock')
+otp_fifo_path = os.path.expanduser('~/.cache/ecartebleue/otp.fifo')
+otp_webhook_port = 8765
+otp_file_path = os.path.expanduser('~/.cache/ecartebleue/otp')
+otp_poll_interval = 0.5
+
+# local historic store (ecard_historic.py), generated e-numbers are recorded in it once it exists
+historic_store_path = os.path.expanduser('~/.local/share/ecartebleue/historic.db')
+
+# session pools (ecard_daemon.py serve), authenticated sessions per card, and idle time in seconds after which a
+# session is pinged to keep it alive, below the bank's session timeout
+session_pool_size = 1
+session_keepalive_interval = 4 * 60
+
+# daemon (ecard_daemon.py serve), unix socket of its requests
+daemon_socket_path = os.path.expanduser('~/.cache/ecartebleue/daemon.sock')
 # --- END CONFIGURATION ---
 
 # global vars
+service_url = 'https://service.e-cartebleue.com/fr/'
 t3ds_host = 'https://natixispaymentsolutions-3ds-vdm.wlp-acs.com'
-
-
-class ECard:
-    def __init__(self, number, expired_at, cvv, owner):
-        self.number = number
-        self.expired_at = expired_at
-        self.cvv = cvv
-        self.owner = owner
-
-    def __str__(self):
-        return 'Card number : ' + str(self.number) \
-               + '\nExpired at  : ' + str(self.expired_at) \
-               + '\nCVV         : ' + str(self.cvv) \
-               + '\nOwner       : ' + str(self.owner)
+expire_in = ['3', '6', '9', '12', '15', '18', '21', '24']
+euro = '1.000000'
+output_formats = ['table', 'json', 'ndjson', 'csv']
+otp_providers = ['terminal', 'socket', 'fifo', 'webhook', 'file']
 
 
 class TableFormatter:
@@ -62,372 +130,75 @@ class TableFormatter:
         return ' ' * (self.rows_length[num] - len(value)) + value
 
     def generate_separator(self, start, middle, end):
-        result = start
-        for length in self.rows_length.values():
-            result = result + '─' * (length + 2) + middle
-        return result[:-1] + end
+        return start + middle.join('─' * (length + 2) for length in self.rows_length.values()) + end
 
     def __str__(self):
-        result = self.generate_separator('╭', '┬', '╮') + '\n'
-        header = True
-        for row in self.rows:
-            result_row = ''
-            for num, value in enumerate(row, start=0):
-                result_row = result_row + self.format_value(num, value) + ' │ '
-            result = result + '│ ' + result_row + '\n'
-            if header:
-                result = result + self.generate_separator('├', '┼', '┤') + '\n'
-                header = False
-
-        return result + self.generate_separator('╰', '┴', '╯')
-
-
-class ECardManager:
-    def __init__(self):
-        self.host = 'https://service.e-cartebleue.com/fr/' + bank
-        self.token = None
-        self.jsessionid = None
-
-        self.auth_3ds_needed = None
-        self.auth_3ds_md = None
-        self.auth_3ds_pareq = None
-        self.auth_3ds_termurl = None
-
-    def do_login(self, login, password):
-        logger.debug('HEADER LOGIN')
-
-        headers = ECardManager.get_common_headers({})
-        payload = {
-            'request': 'login',
-            'identifiantCrypte': '',
-            'app': '',
-            'identifiant': login,
-            'memorize': 'false',
-            'password': password,
-            'token': '9876543210'
-        }
-        response = ECardManager._post_form(self.host + '/login', headers, payload)
-        dom = html_parser.document_fromstring(response.text)
-        ECardManager.check_error(dom)
-
-        logger.debug('\n# LoginInfo')
-
-        # get jsessionid
-        self.jsessionid = response.cookies['JSESSIONID']
-        logger.debug('jsessionid: ' + self.jsessionid)
-
-        # get token
-        self.token = dom.xpath('//input[@name="token"]')[0].attrib['value'].strip()
-        logger.debug('token: ' + self.token)
-
-        # check if D secure is needed
-        auth_3ds_form = dom.xpath('//form[@id="form-3ds-authentificate"]')
-        self.auth_3ds_needed = len(auth_3ds_form) > 0
-        logger.debug('need3dsecure: ' + str(self.auth_3ds_needed))
-
-        if self.auth_3ds_needed:
-            self.auth_3ds_md = dom.xpath('//input[@name="MD"]')[0].attrib['value'].strip()
-            self.auth_3ds_pareq = dom.xpath('//input[@name="PaReq"]')[0].attrib['value'].strip()
-            self.auth_3ds_termurl = dom.xpath('//input[@name="TermUrl"]')[0].attrib['value'].strip()
-
-        return True
-
-    def auth_3ds(self):
-        print('3D Secure authentication required. Loading...')
-
-        # 1.1 PaRequest...
-        url = t3ds_host + '/acs-pa-service/pa/paRequest'
-        headers = ECardManager.get_common_headers({})
-        payload = {
-            'MD': self.auth_3ds_md,
-            'PaReq': self.auth_3ds_pareq,
-            'TermUrl': self.host + '/receive3ds'
-        }
-        response = ECardManager._post_form(url, headers, payload, allow_redirects=False)
-        redirect_url = response.headers['Location']
-        logger.debug('##### redirect url\n' + redirect_url)
-
-        index = redirect_url.rfind('/')
-        auth_3ds_id = redirect_url[index + 1:]
-        logger.debug('##### auth 3ds id\n' + auth_3ds_id)
-
-        # 1.2 ...do the redirection
-        headers = ECardManager.get_common_headers({})
-        ECardManager._get(redirect_url, headers)
-
-        # 2. get session
-        url = t3ds_host + '/acs-auth-pages/authent/pages/getSession/' + auth_3ds_id
-        headers = ECardManager.get_common_headers({})
-        payload = {
-            'inIframe': False,
-            'parentUrl': None
-        }
-        response = ECardManager._post_json(url, headers, payload)
-        account_id = json.loads(response.text)['accountId']
-        transaction_id = json.loads(response.text)['hubSessionId']
-        logger.debug('##### account id\n' + account_id)
-
-        # 3. start authentication
-        url = t3ds_host + '/acs-auth-pages/authent/pages/startAuthent'
-        payload = {
-            'accountId': account_id,
-            'language': 'fr',
-            'region': 'FR',
-            'hubAuthenticationInput': {
-                'transactionContext': {}
-            }
-        }
-        response = ECardManager._post_json(url, headers, payload)
-
-        # Check authentication type: OTP_SMS or MOBILE_APP
-        means_to_use = json.loads(response.text)['meansToUse']
-        if means_to_use == 'OTP_SMS':
-            self.auth_by_otp_sms(headers, account_id)
-        elif means_to_use == 'MOBILE_APP':
-            auth_id = json.loads(response.text)['hubAuthenticationOutput']['id']
-            self.auth_by_mobile_app(headers, account_id, transaction_id, auth_id)
+        lines = [self.generate_separator('╭', '┬', '╮')]
+        for num, row in enumerate(self.rows):
+            lines.append('│ ' + ' │ '.join(self.format_value(i, value) for i, value in enumerate(row)) + ' │ ')
+            if num == 0:
+                lines.append(self.generate_separator('├', '┼', '┤'))
+        lines.append(self.generate_separator('╰', '┴', '╯'))
+        return '\n'.join(lines)
+
+
+def csv_value(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def write_records(records, fields: tuple, output_format: str, file=None) -> None:
+    """Write records, with an as_dict method, as a json array, json lines or csv with a header row.
+
+    Each record is written and flushed as soon as it is read from records, so a long historic is printed while its
+    page is parsed instead of held in memory.
+    """
+    file = file or sys.stdout
+    if output_format == 'csv':
+        import csv
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(fields)
+    elif output_format == 'json':
+        file.write('[')
+    for num, record in enumerate(records):
+        values = record.as_dict()
+        if output_format == 'csv':
+            writer.writerow([csv_value(values[field]) for field in fields])
+        elif output_format == 'json':
+            file.write((',\n ' if num else '\n ') + json.dumps(values, ensure_ascii=False, default=str))
         else:
-            print('Unknown authentication mode: ' + means_to_use)
-            return
-        self.auth_end(headers, account_id)
-
-    def auth_by_otp_sms(self, headers, account_id):
-        # 4.1 ask for OTP_SMS code
-        print('Authentication by SMS')
-        otp_code = input('Enter code: ')
-
-        # 4.2 update authentication with OTP code
-        url = t3ds_host + '/acs-auth-pages/authent/pages/updateAuthent'
-        payload = {
-            'accountId': account_id,
-            'language': 'fr',
-            'step': 'otp_validating_3',
-            'skipCurrentHubCall': False,
-            'hubAuthenticationInput': {
-                'otp': otp_code,
-                'merchantWhitelistedByUser': False
-            }
-        }
-        response = ECardManager._post_json(url, headers, payload)
-        if json.loads(response.text)['hubAuthenticationOutput']['authenticationSuccess'] is False:
-            raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nWrong authentication code.')
-
-    def auth_by_mobile_app(self, headers, account_id, transaction_id, auth_id):
-        # 4.1 polling for success
-        print('Authentication by mobile')
-        print('Waiting for auth...')
-
-        url = t3ds_host + '/acs-auth-pages/authent/pages/startPolling'
-        payload = {
-            'accountId': account_id,
-            'hubAuthenticationInput': {
-                'authenticationId': auth_id,
-                'transactionId': transaction_id
-            }
-        }
-        # continue_polling = True
-        while True:
-            time.sleep(5)
-            response = ECardManager._post_json(url, headers, payload)
-            auth_success = json.loads(response.text)['hubAuthenticationOutput']['authenticationSuccess']
-            auth_canceled = json.loads(response.text)['hubAuthenticationOutput']['authenticationCanceled']
-            auth_blocked = json.loads(response.text)['hubAuthenticationOutput']['authenticationBlocked']
-            auth_failed = json.loads(response.text)['hubAuthenticationOutput']['authenticationFailed']
-            auth_timeout = json.loads(response.text)['hubAuthenticationOutput']['authenticationTimeOut']
-
-            if auth_success:
-                print('Authentication succeeded')
-                break
-
-            if auth_canceled:
-                raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nAuthentication canceled.')
-            if auth_blocked:
-                raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nAuthentication blocked.')
-            if auth_failed:
-                raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nAuthentication failed.')
-            if auth_timeout:
-                raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nAuthentication time out.')
-
-    def auth_end(self, headers, account_id):
-        # 5. end authentication
-        url = t3ds_host + '/acs-auth-pages/authent/pages/endAuthent'
-        payload = {
-            'accountId': account_id,
-            'hubAuthenticationInput': {}
-        }
-        ECardManager._post_json(url, headers, payload)
-
-        # 6 get paResponse
-        url = t3ds_host + '/acs-pa-service/pa/paRequestFromAuthPages'
-        headers = ECardManager.get_common_headers({
-            'Upgrade-Insecure-Requests': '1'
-        })
-        payload = {
-            'accountId': account_id,
-        }
-        response = ECardManager._post_form(url, headers, payload)
-        dom = html_parser.document_fromstring(response.text)
-        md = dom.xpath('//input[@name="MD"]')[0].attrib['value'].strip()
-        pares = dom.xpath('//input[@name="PaRes"]')[0].attrib['value'].strip()
-        logger.debug('##### md\n' + md)
-        logger.debug('##### PaResp\n' + pares)
-
-        # finally, send the PaRes code to the bank
-        url = self.host + '/receive3ds'
-        headers = ECardManager.get_common_headers({
-            'Cookie': 'JSESSIONID=' + self.jsessionid + '; eCarteBleue-pref=open',
-            'Upgrade-Insecure-Requests': '1'
-        })
-        payload = {
-            'MD': md,
-            'PaRes': pares
-        }
-        response = ECardManager._post_form(url, headers, payload)
-        dom = html_parser.document_fromstring(response.text)
-        ECardManager.check_error(dom)
-
-    def generate_ecard(self, amount: str, currency: str, validity: str) -> ECard:
-        logger.debug('HEADER generate ecard')
-
-        headers = ECardManager.get_common_headers({
-            'Cookie': 'JSESSIONID=' + self.jsessionid + '; eCarteBleue-pref=open'
-        })
-        payload = {
-            'request': 'ocode',
-            'token': self.token,
-            'montant': amount,
-            'devise': currency,
-            'dateValidite': validity
-        }
-
-        response = ECardManager._post_form(self.host + '/cpn', headers, payload)
-        dom = html_parser.document_fromstring(response.text)
-        ECardManager.check_error(dom)
-
-        number = dom.xpath('//dd[@id="generated-code-dd"]/span[@data-drag-txt]')[0].attrib['data-drag-txt'].strip()
-        expired_at = dom.xpath('//dl[@id="content-expiration-date"]/dd')[0].text.strip()
-        cvv = dom.xpath('//dl[@id="content-cryptogramme"]//span[@class="restricted-only"]')[0].text.strip()
-        owner = dom.xpath('//dl[@id="content-card-owner"]//span[@class="restricted-only"]')[0].text.strip()
-
-        e_card = ECard(number, expired_at, cvv, owner)
-        return e_card
-
-    def list_historic(self):
-        logger.debug('HEADER historic')
-
-        headers = ECardManager.get_common_headers({
-            'Cookie': 'JSESSIONID=' + self.jsessionid + '; eCarteBleue-pref=open'
-        })
-        payload = {
-            'token': self.token,
-        }
-
-        response = ECardManager._post_form(self.host + '/historic', headers, payload)
-        html = response.text
-
-        dom = html_parser.document_fromstring(html)
-        ECardManager.check_error(dom)
-
-        used = dom.xpath('//div[@id="history-panes-used-numbers-print"]//table/tr')
-        unused = dom.xpath('//div[@id="history-panes-unused-numbers-print"]//table/tr')
-
-        items = []
-        for row in used + unused:
-            item = []
-            cols = row.getchildren()
-            # remove last column (status)
-            cols.pop(5)
-            for col in cols:
-                value = col.text.strip()
-                value = '─' if value == '-----------' else value
-                item.append(value)
-            items.append(item)
-
-        # sort by date
-        items.sort(key=lambda date: datetime.strptime(date[0], '%d/%m/%Y'), reverse=True)
-
-        # add headers
-        items.insert(0, ['DATE   ', 'COMMERCANT', 'E-NUMERO     ', 'PLAFOND', 'TRANSACTION'])
-        return items
-
-    def do_logout(self):
-        logger.debug('HEADER logout')
-        headers = ECardManager.get_common_headers({
-            'Cookie': 'JSESSIONID=' + self.jsessionid + '; eCarteBleue-pref=open'
-        })
-        ECardManager._get(self.host + '/logout', headers=headers)
+            file.write(json.dumps(values, ensure_ascii=False, default=str) + '\n')
+        file.flush()
+    if output_format == 'json':
+        file.write('\n]\n')
 
-    @staticmethod
-    def _post_form(url: str, headers: dict, payload: dict, allow_redirects=True) -> Response:
-        headers.update({'Content-Type': 'application/x-www-form-urlencoded'})
-        return ECardManager._post(url, headers, urllib.parse.urlencode(payload), allow_redirects)
-
-    @staticmethod
-    def _post_json(url: str, headers: dict, payload: dict, allow_redirects=True) -> Response:
-        headers.update({'Content-Type': 'application/json'})
-        return ECardManager._post(url, headers, json.dumps(payload), allow_redirects)
 
-    @staticmethod
-    def _post(url: str, headers: dict, payload: str, allow_redirects=True) -> Response:
-        response = requests.post(url, headers=headers, data=payload, allow_redirects=allow_redirects)
-        ECardManager._process_response(response)
-        return response
+class ColourFormatter(logging.Formatter):
+    """Colours the messages by level, and turns their HEADER prefix into a section title.
 
-    @staticmethod
-    def _get(url: str, headers: dict, allow_redirects=True) -> Response:
-        response = requests.get(url, headers=headers, allow_redirects=allow_redirects)
-        ECardManager._process_response(response)
-        return response
-
-    @staticmethod
-    def _process_response(response: Response):
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug('HEADER REQUESTS')
-            logger.debug('\n##### url\nPOST ' + response.url)
-            logger.debug('\n##### request headers\n' + str(response.request.headers))
-            logger.debug('\n##### request body\n' + str(response.request.body))
-            logger.debug('\n##### response code\n' + str(response.status_code))
-            logger.debug('\n##### response headers\n' + str(response.headers))
-            # remove empty lines
-            text = os.linesep.join([s for s in response.text.splitlines() if s.strip()])
-            text = text.replace('\t', '  ')
-            logger.debug('\n# response body\n' + text)
-
-        if response.status_code >= 400:
-            raise Exception(
-                '\n\033[91m/!\\ ERROR /!\\\033[0m\nSomething went wrong when calling ' + response.url + '.\n'
-                + str(response))
+    Unlike a filter, it only runs for the records that are emitted."""
 
-    @staticmethod
-    def get_common_headers(extra_headers: dict) -> dict:
-        headers = {
-            'User-Agent': 'ecartebleue-python/' + __version__,
-            'Accept': '*/*'
-        }
-        headers.update(extra_headers)
-        return headers
-
-    @staticmethod
-    def check_error(dom: html_parser) -> None:
-        errors = dom.xpath('//form[@id="form-error-confirmation"]//p[@role="alert"]')
-        if len(errors) > 0:
-            # convert <br> to \n
-            for br in errors[0].xpath('//br'):
-                br.tail = '\n' + br.tail if br.tail else '\n'
-            raise Exception(errors[0].text_content().strip())
-
-
-class ColourFilter(logging.Filter):
     colours = {'DEBUG': '\033[32m',
                'INFO': '\033[34m',
                'WARNING': '\033[93m',
                'ERROR': '\033[91m',
                'CRITICAL': '\033[4m\033[1m\033[91m'}
 
-    def filter(self, record):
-        msg = record.msg.replace('HEADER', '\n########################## ')
-        record.msg = ColourFilter.colours[record.levelname] + msg + '\033[0m'
-        return True
+    def format(self, record):
+        msg = super().format(record).replace('HEADER', '\n########################## ', 1)
+        return ColourFormatter.colours[record.levelname] + msg + '\033[0m'
+
+
+def set_verbose(verbose: bool) -> None:
+    """DEBUG level if verbose, INFO otherwise; the http exchanges of the verbose runs are captured to a HAR file."""
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+    if verbose and http_capture_path:
+        import ecard_har
+        ecard_har.capture(http_capture_path)
+        logger.debug('http exchanges captured in %s', http_capture_path)
 
 
 class ChoicesFormatter(argparse.RawTextHelpFormatter):
@@ -435,33 +206,53 @@ class ChoicesFormatter(argparse.RawTextHelpFormatter):
         return super(ChoicesFormatter, self)._format_action_invocation(action).replace(' ,', ',')
 
 
-# run bash command
-def bash(bash_command):
-    try:
-        process = subprocess.run(bash_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        error = process.stderr.decode('utf-8').strip()
-        if error:
-            sys.stderr.write(error)
-            sys.exit(1)
-        return process.stdout.decode('utf-8').strip().split('\n', 1)[0]
-    except subprocess.CalledProcessError:
-        print("error run command: " + bash_command)
-        sys.exit(1)
-
-
 def amount_type(x):
     if float(x) <= 0.0:
         raise argparse.ArgumentTypeError("amount must be greater than 0")
     return x
 
 
-def action_generate(args, e_card_manager: ECardManager):
+def action_generate(args, e_card_manager: 'ECardManager'):
     # params
-    logger.debug('expire-in: ' + args.expire_in)
-    logger.debug('amount: ' + args.amount)
+    logger.debug('expire-in: %s', args.expire_in)
+    logger.debug('amount: %s', args.amount)
+
+    e_card = e_card_manager.generate_ecard(args.amount, euro, args.expire_in)
+    if args.format == 'table':
+        print('\n' + str(e_card) + '\n')
+    else:
+        write_records([e_card], e_card.__slots__, args.format)
 
-    e_card = e_card_manager.generate_ecard(args.amount, '1.000000', args.expire_in)
-    print('\n' + str(e_card) + '\n')
+
+class ActionBatch(argparse.Action):
+
+    def __call__(self, _parser, namespace, values, option_string=None):
+        # values is the file already opened by argparse.FileType, so a wrong path fails before the login
+        setattr(namespace, self.dest, values)
+        run(namespace, ActionBatch.do_action)
+
+    @staticmethod
+    def do_action(args, e_card_manager: 'ECardManager'):
+        from ecard_client import generate_batch
+        logger.debug('HEADER batch')
+
+        generated = 0
+        failed = 0
+        start = time.perf_counter()
+        try:
+            for result in generate_batch(e_card_manager, args.batch, args.expire_in):
+                if 'error' in result:
+                    failed += 1
+                else:
+                    generated += 1
+                print(json.dumps(result), flush=True)
+        finally:
+            if args.batch is not sys.stdin:
+                args.batch.close()
+        elapsed = time.perf_counter() - start
+
+        sys.stderr.write('%d e-numbers generated, %d failed, in %.2f s (%.2f cards/s)\n'
+                         % (generated, failed, elapsed, generated / elapsed if elapsed else 0))
 
 
 class ActionHistoric(argparse.Action):
@@ -471,61 +262,135 @@ class ActionHistoric(argparse.Action):
         # _parser.exit()
 
     @staticmethod
-    def do_action(args, e_card_manager: ECardManager):
-        logger.debug('HEADER historic')
-        all_historic = e_card_manager.list_historic()
+    def do_action(args, e_card_manager: 'ECardManager'):
+        if args.format != 'table':
+            from ecard_pages import HistoricEntry
+            write_records(e_card_manager.iter_historic(), HistoricEntry.__slots__, args.format)
+            return
         table_formatter = TableFormatter()
-        table_formatter.set_rows(all_historic)
+        table_formatter.set_rows(e_card_manager.list_historic())
         print(table_formatter)
 
 
 def run(args, action):
-    # set logger level
-    level = logging.DEBUG if args.verbose else logging.INFO
-    logger.setLevel(level)
+    # the http client is only loaded for the actions that need it
+    import ecard_credentials
+    from ecard_client import ECardManager, HistoricStore, SessionCache
 
-    # gopass
-    login = bash('gopass ' + login_gopass_location.format(card=args.card))
-    logger.debug('login: ' + login)
+    # set logger level
+    set_verbose(args.verbose)
 
-    password = bash('gopass ' + password_gopass_location.format(card=args.card))
+    # credentials, looked up while connecting to the bank
+    e_card_manager = ECardManager()
+    e_card_manager.card = args.card
+    try:
+        with e_card_manager.preconnecting():
+            login, password = ecard_credentials.get_provider().get(args.card)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+    logger.debug('login: %s', login)
     logger.debug('password: ')
 
-    e_card_manager = ECardManager()
+    # record the generated e-numbers, once the local historic has been synced
+    if os.path.exists(historic_store_path):
+        e_card_manager.store = HistoricStore(args.card)
+    # timings of each http step, as json lines
+    if args.trace:
+        import ecard_trace
+        e_card_manager.hooks.append(ecard_trace.JSONLinesSink(open(args.trace, 'a')))
+    # the sms code of the 3D Secure authentication; ecard_historic.py sync has neither --otp nor --record
+    if getattr(args, 'otp', None):
+        import ecard_otp
+        e_card_manager.otp = ecard_otp.get_provider(args.otp)
+    # the exchanges, as replayable fixtures
+    if getattr(args, 'record', None):
+        import ecard_har
+        e_card_manager.recorder = ecard_har.FixtureRecorder(args.record)
+    session_cache = None
     try:
-        # login
-        e_card_manager.do_login(login, password)
+        # reuse the cached session, if still alive
+        session = None
+        if args.session_cache:
+            session_cache = SessionCache()
+            session = session_cache.load(args.card, password)
+
+        if session is None or not e_card_manager.resume_session(session):
+            # login
+            e_card_manager.do_login(login, password)
 
-        # 3D Secure authentication, if needed
-        if e_card_manager.auth_3ds_needed:
-            e_card_manager.auth_3ds()
+            # 3D Secure authentication, if needed
+            if e_card_manager.auth_3ds_needed:
+                e_card_manager.auth_3ds()
 
         # run the action
         action(args, e_card_manager)
 
+        # keep the session alive for the next run
+        if session_cache and (e_card_manager.auth_3ds_completed or not e_card_manager.auth_3ds_needed):
+            session_cache.save(args.card, password, e_card_manager.get_session())
+
     except Exception as e:
         print(e)
+        if session_cache:
+            session_cache.delete(args.card)
+        session_cache = None
     finally:
-        e_card_manager.do_logout()
+        if session_cache is None:
+            e_card_manager.do_logout()
         sys.exit(1)
 
 
+def __getattr__(name):
+    # the client and page parsing classes, e.g. ecard.ECardManager, are loaded on first use
+    if not name.startswith('__'):
+        import ecard_client
+        import ecard_pages
+        for module in [ecard_client, ecard_pages]:
+            if hasattr(module, name):
+                return getattr(module, name)
+    raise AttributeError("module 'ecard' has no attribute '" + name + "'")
+
+
 # logger
-logging.basicConfig(format='%(message)s')
 logger = logging.getLogger('ecard')
-logger.addFilter(ColourFilter())
+_handler = logging.StreamHandler()
+_handler.setFormatter(ColourFormatter('%(message)s'))
+logger.addHandler(_handler)
+logger.propagate = False
 
 # MAIN
 if __name__ == '__main__':
+    # the client modules import ecard: let them share this module instead of loading the script a second time
+    sys.modules['ecard'] = sys.modules['__main__']
+
     # arguments
-    expire_in = ['3', '6', '9', '12', '15', '18', '21', '24']
     parser = argparse.ArgumentParser(formatter_class=ChoicesFormatter)
     parser.add_argument('amount', type=amount_type, help='amount in euro')
     parser.add_argument('-c', '--card', default=default_card, help='card''s name defined in gopass')
     parser.add_argument('-e', '--expire-in', choices=expire_in, default='3', metavar='',
                         help='expiration time in months, default is 3\nallowed values are ' + ', '.join(
                             expire_in) + '.')
+    parser.add_argument('-f', '--format', choices=output_formats, default='table', metavar='',
+                        help='output of the e-number and of the historic, default is table\n'
+                             'allowed values are ' + ', '.join(output_formats) + ', given before -l')
     parser.add_argument('-l', '--list', action=ActionHistoric, nargs=0, help='list historic of generated e-Carte Bleue')
+    parser.add_argument('-b', '--batch', action=ActionBatch, type=argparse.FileType('r'), metavar='FILE',
+                        help='generate an e-number for each line of FILE (- for stdin), with a single login\n'
+                             'lines are csv "amount,currency,validity" or json {"amount": ...}\n'
+                             'results are printed as json lines')
+    parser.add_argument('-s', '--session-cache', action='store_true', default=False,
+                        help='reuse the session of the previous run, and keep it alive instead of logging out')
+    parser.add_argument('-t', '--trace', metavar='FILE',
+                        help='append the timings of each http step to FILE, as json lines\n'
+                             'summarized by ecard_trace.py FILE')
+    parser.add_argument('-r', '--record', metavar='DIR',
+                        help='write each http exchange to DIR as a HAR fixture replayable by ecard_stub.py,\n'
+                             'secrets redacted, given before -l or -b')
+    parser.add_argument('-o', '--otp', choices=otp_providers, metavar='PROVIDER',
+                        help='source of the 3D Secure sms code, default is ' + otp_provider + '\n'
+                             'allowed values are ' + ', '.join(otp_providers) + ', given before -l or -b\n'
+                             'codes are sent to the waiting run by ecard_otp.py CODE')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose mode')
     parser.add_argument('-V', '--version', action='version', version=__version__, help='display version and quit')
     _args = parser.parse_args()
@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+
+import asyncio
+import importlib.util
+import json
+import time
+import urllib.parse
+from datetime import date
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+import ecard
+from ecard import logger
+from ecard_client import BankProfile, ECardManager, PollingScheduler
+from ecard_pages import ECard
+
+
+class AsyncHttpTransport:
+    """Asyncio counterpart of HttpTransport, on an httpx client.
+
+    Each transport has its own cookie jar, but several transports, one per account, can share the same connection
+    pool, created with AsyncHttpTransport.create_pool.
+    """
+
+    def __init__(self, pool=None, pool_size: int = None):
+        if httpx is None:
+            raise Exception('AsyncECardManager needs the httpx library: pip3 install httpx')
+        self.owns_pool = pool is None
+        self.pool = pool or AsyncHttpTransport.create_pool(pool_size)
+        self.client = httpx.AsyncClient(transport=self.pool)
+
+    @staticmethod
+    def create_pool(pool_size: int = None):
+        pool_size = pool_size or ecard.http_pool_size
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        # http/2 is only available with the h2 library installed
+        return httpx.AsyncHTTPTransport(limits=limits, http2=importlib.util.find_spec('h2') is not None)
+
+    async def post(self, url: str, headers: dict, data: str, allow_redirects=True):
+        return await self.client.post(url, headers=headers, content=data, follow_redirects=allow_redirects)
+
+    async def get(self, url: str, headers: dict, allow_redirects=True):
+        return await self.client.get(url, headers=headers, follow_redirects=allow_redirects)
+
+    def set_cookie(self, name: str, value: str, url: str) -> None:
+        parsed_url = urllib.parse.urlparse(url)
+        self.client.cookies.set(name, value, domain=parsed_url.hostname, path=parsed_url.path or '/')
+
+    def get_cookie(self, name: str, url: str):
+        parsed_url = urllib.parse.urlparse(url)
+        return self.client.cookies.get(name, domain=parsed_url.hostname, path=parsed_url.path or '/')
+
+    async def close(self) -> None:
+        # a shared pool is closed by its owner
+        if self.owns_pool:
+            await self.client.aclose()
+
+
+class AsyncECardManager:
+    """Asyncio counterpart of ECardManager, with the same methods as coroutines and the same page parsers."""
+
+    def __init__(self, transport: AsyncHttpTransport = None, host: str = None, polling: PollingScheduler = None,
+                 bank: BankProfile = None):
+        self.bank = bank or BankProfile.of_bank()
+        # the bank's url, unless overridden
+        self.host = host or self.bank.host
+        self.transport = transport or AsyncHttpTransport()
+        self.polling = polling or PollingScheduler()
+        self.transport.set_cookie('eCarteBleue-pref', 'open', self.host)
+        self.token = None
+        # HistoricStore recording the generated e-numbers, if any
+        self.store = None
+        # callables receiving an event dict for each http step, see ECardManager.http_event
+        self.hooks = []
+        # ecard_har.FixtureRecorder writing each exchange, if any
+        self.recorder = None
+        # ecard_otp provider of the sms codes, the configuration's by default, and the card whose code is awaited
+        self.otp = None
+        self.card = None
+
+        self.auth_3ds_needed = None
+        self.auth_3ds_completed = False
+        self.auth_3ds_md = None
+        self.auth_3ds_pareq = None
+        self.auth_3ds_termurl = None
+
+    async def do_login(self, login, password):
+        logger.debug('HEADER LOGIN')
+
+        headers = ECardManager.get_common_headers({})
+        payload = {
+            'request': 'login',
+            'identifiantCrypte': '',
+            'app': '',
+            'identifiant': login,
+            'memorize': 'false',
+            'password': password,
+            'token': '9876543210'
+        }
+        response = await self._post_form(self.url('login'), headers, payload)
+        login_page = ECardManager.parse_login_page(response.text)
+
+        self.jsessionid = response.cookies['JSESSIONID']
+        self.token = login_page['token']
+        self.auth_3ds_needed = login_page['auth_3ds_needed']
+        if self.auth_3ds_needed:
+            self.auth_3ds_md = login_page['md']
+            self.auth_3ds_pareq = login_page['pareq']
+            self.auth_3ds_termurl = login_page['termurl']
+        return True
+
+    # the url of an http step, at the bank or at its 3D Secure host
+    url = ECardManager.url
+    otp_provider = ECardManager.otp_provider
+
+    @property
+    def jsessionid(self):
+        return self.transport.get_cookie('JSESSIONID', self.host)
+
+    @jsessionid.setter
+    def jsessionid(self, value):
+        self.transport.set_cookie('JSESSIONID', value, self.host)
+
+    async def auth_3ds(self):
+        print('3D Secure authentication required. Loading...')
+
+        # 1.1 PaRequest...
+        url = self.url('paRequest')
+        headers = ECardManager.get_common_headers({})
+        payload = {
+            'MD': self.auth_3ds_md,
+            'PaReq': self.auth_3ds_pareq,
+            'TermUrl': self.url('receive3ds')
+        }
+        response = await self._post_form(url, headers, payload, allow_redirects=False)
+        redirect_url = response.headers['Location']
+        logger.debug('##### redirect url\n%s', redirect_url)
+
+        auth_3ds_id = redirect_url[redirect_url.rfind('/') + 1:]
+        logger.debug('##### auth 3ds id\n%s', auth_3ds_id)
+
+        # 1.2 ...do the redirection
+        headers = ECardManager.get_common_headers({})
+        await self._get(redirect_url, headers)
+
+        # 2. get session
+        url = self.url('getSession') + auth_3ds_id
+        headers = ECardManager.get_common_headers({})
+        payload = {
+            'inIframe': False,
+            'parentUrl': None
+        }
+        response = await self._post_json(url, headers, payload)
+        session = json.loads(response.text)
+        account_id = session['accountId']
+        transaction_id = session['hubSessionId']
+        logger.debug('##### account id\n%s', account_id)
+
+        # 3. start authentication
+        url = self.url('startAuthent')
+        payload = {
+            'accountId': account_id,
+            'language': 'fr',
+            'region': 'FR',
+            'hubAuthenticationInput': {
+                'transactionContext': {}
+            }
+        }
+        response = await self._post_json(url, headers, payload)
+
+        # Check authentication type: OTP_SMS or MOBILE_APP
+        authentication = json.loads(response.text)
+        means_to_use = authentication['meansToUse']
+        if means_to_use == 'OTP_SMS':
+            await self.auth_by_otp_sms(headers, account_id)
+        elif means_to_use == 'MOBILE_APP':
+            auth_id = authentication['hubAuthenticationOutput']['id']
+            await self.auth_by_mobile_app(headers, account_id, transaction_id, auth_id)
+        else:
+            print('Unknown authentication mode: ' + means_to_use)
+            return
+        await self.auth_end(headers, account_id)
+
+    async def auth_by_otp_sms(self, headers, account_id):
+        # 4.1 wait for the OTP_SMS code, up to otp_timeout, without blocking the event loop
+        print('Authentication by SMS')
+        otp_code = await self.otp_provider().wait_async(self.card)
+
+        # 4.2 update authentication with OTP code
+        url = self.url('updateAuthent')
+        payload = {
+            'accountId': account_id,
+            'language': 'fr',
+            'step': 'otp_validating_3',
+            'skipCurrentHubCall': False,
+            'hubAuthenticationInput': {
+                'otp': otp_code,
+                'merchantWhitelistedByUser': False
+            }
+        }
+        response = await self._post_json(url, headers, payload)
+        ECardManager.check_otp_authentication(json.loads(response.text)['hubAuthenticationOutput'])
+
+    async def auth_by_mobile_app(self, headers, account_id, transaction_id, auth_id):
+        # 4.1 polling for success
+        print('Authentication by mobile')
+        print('Waiting for auth...')
+
+        url = self.url('startPolling')
+        payload = {
+            'accountId': account_id,
+            'hubAuthenticationInput': {
+                'authenticationId': auth_id,
+                'transactionId': transaction_id
+            }
+        }
+        for delay in self.polling.delays():
+            await asyncio.sleep(delay)
+            self.polling.check_cancelled()
+            response = await self._post_json(url, headers, payload)
+            if ECardManager.check_mobile_app_authentication(json.loads(response.text)['hubAuthenticationOutput']):
+                print('Authentication succeeded')
+                return
+
+        raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nAuthentication time out.')
+
+    async def auth_end(self, headers, account_id):
+        # 5. end authentication
+        url = self.url('endAuthent')
+        payload = {
+            'accountId': account_id,
+            'hubAuthenticationInput': {}
+        }
+        await self._post_json(url, headers, payload)
+
+        # 6 get paResponse
+        url = self.url('paRequestFromAuthPages')
+        headers = ECardManager.get_common_headers({
+            'Upgrade-Insecure-Requests': '1'
+        })
+        payload = {
+            'accountId': account_id,
+        }
+        response = await self._post_form(url, headers, payload)
+        md, pares = ECardManager.parse_pa_response_page(response.text)
+        logger.debug('##### md\n%s', md)
+
+        # finally, send the PaRes code to the bank
+        url = self.url('receive3ds')
+        headers = ECardManager.get_common_headers({
+            'Upgrade-Insecure-Requests': '1'
+        })
+        payload = {
+            'MD': md,
+            'PaRes': pares
+        }
+        response = await self._post_form(url, headers, payload)
+        ECardManager.parse_page(response.text)
+        self.auth_3ds_completed = True
+
+    async def generate_ecard(self, amount: str, currency: str, validity: str) -> ECard:
+        logger.debug('HEADER generate ecard')
+
+        headers = ECardManager.get_common_headers({})
+        payload = {
+            'request': 'ocode',
+            'token': self.token,
+            'montant': amount,
+            'devise': currency,
+            'dateValidite': validity
+        }
+
+        response = await self._post_form(self.url('cpn'), headers, payload)
+        e_card, token = ECardManager.parse_ecard_page(response.text)
+
+        # keep the token of the result page for the next call
+        if token is not None:
+            self.token = token
+        if self.store is not None:
+            self.store.add_ecard(e_card, amount)
+        return e_card
+
+    async def list_historic(self):
+        return ECardManager.historic_table(await self.list_historic_entries())
+
+    async def list_historic_entries(self, since: date = None, limit: int = None) -> list:
+        logger.debug('HEADER historic')
+
+        headers = ECardManager.get_common_headers({})
+        payload = {
+            'token': self.token,
+        }
+
+        response = await self._post_form(self.url('historic'), headers, payload)
+        return list(ECardManager.iter_historic_entries(ECardManager.chunks(response.text), since, limit))
+
+    async def do_logout(self):
+        logger.debug('HEADER logout')
+        headers = ECardManager.get_common_headers({})
+        await self._get(self.url('logout'), headers=headers)
+
+    async def _post_form(self, url: str, headers: dict, payload: dict, allow_redirects=True):
+        headers.update({'Content-Type': 'application/x-www-form-urlencoded'})
+        return await self._post(url, headers, urllib.parse.urlencode(payload), allow_redirects)
+
+    async def _post_json(self, url: str, headers: dict, payload: dict, allow_redirects=True):
+        headers.update({'Content-Type': 'application/json'})
+        return await self._post(url, headers, json.dumps(payload), allow_redirects)
+
+    async def _post(self, url: str, headers: dict, payload: str, allow_redirects=True):
+        if not self.hooks:
+            response = await self.transport.post(url, headers, payload, allow_redirects)
+        else:
+            response = await self._traced('POST', url, payload,
+                                          self.transport.post(url, headers, payload, allow_redirects))
+        if self.recorder is not None:
+            self.recorder.record(response)
+        ECardManager._process_response(response)
+        return response
+
+    async def _get(self, url: str, headers: dict, allow_redirects=True):
+        if not self.hooks:
+            response = await self.transport.get(url, headers, allow_redirects)
+        else:
+            response = await self._traced('GET', url, None, self.transport.get(url, headers, allow_redirects))
+        if self.recorder is not None:
+            self.recorder.record(response)
+        ECardManager._process_response(response)
+        return response
+
+    async def _traced(self, method: str, url: str, payload, request):
+        """Await the request, and emit its event to the hooks, even if it failed."""
+        timestamp = time.time()
+        start = time.perf_counter()
+        response = None
+        error = None
+        try:
+            response = await request
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            event = ECardManager.http_event(method, url, payload, response, timestamp, time.perf_counter() - start,
+                                            error)
+            for hook in self.hooks:
+                hook(event)
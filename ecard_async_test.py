@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+
+import unittest
+from unittest import mock
+from unittest.mock import patch, AsyncMock
+
+import ecard
+from ecard_async import AsyncECardManager, AsyncHttpTransport
+from ecard_test import mocked_requests_response
+
+
+class AsyncECardTest(unittest.IsolatedAsyncioTestCase):
+    bank_host = 'https://service.e-cartebleue.com/fr/caisse-epargne'
+    t3ds_host = 'https://natixispaymentsolutions-3ds-vdm.wlp-acs.com'
+
+    def e_card_manager_logged_in(self):
+        e_card_manager = AsyncECardManager()
+        e_card_manager.jsessionid = '1234567890ABCDEF1234567890ABCDEF'
+        e_card_manager.token = '9876543210'
+        e_card_manager.auth_3ds_needed = True
+        e_card_manager.auth_3ds_md = 'MD123456789012345678'
+        e_card_manager.auth_3ds_pareq = 'PaReqABCDEF1234567890ABCDEF1234567890'
+        e_card_manager.auth_3ds_termurl = '/fr/caisse-epargne/receive3ds'
+        return e_card_manager
+
+    @patch('httpx.AsyncClient.post', new_callable=AsyncMock,
+           side_effect=[mocked_requests_response('login_success_auth_3ds_needed')])
+    async def test_do_login_success_auth_3ds_needed(self, mock_post):
+
+        # Given
+        e_card_manager = AsyncECardManager()
+
+        # When
+        succeed = await e_card_manager.do_login('login', 'password')
+
+        # Then
+        self.assertEqual(succeed, True)
+        self.assertEqual('1234567890ABCDEF1234567890ABCDEF', e_card_manager.jsessionid)
+        self.assertEqual('9876543210', e_card_manager.token)
+        self.assertEqual(True, e_card_manager.auth_3ds_needed)
+        self.assertEqual('MD123456789012345678', e_card_manager.auth_3ds_md)
+        self.assertEqual('PaReqABCDEF1234567890ABCDEF1234567890', e_card_manager.auth_3ds_pareq)
+        self.assertEqual('/fr/caisse-epargne/receive3ds', e_card_manager.auth_3ds_termurl)
+
+        expected_url = self.bank_host + '/login'
+        expected_data = 'request=login&identifiantCrypte=&app=&identifiant=login&memorize=false&password=password&token=9876543210'
+        expected_headers = {
+            'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
+        self.assertEqual(mock.call(expected_url, follow_redirects=True, content=expected_data, headers=expected_headers),
+                         mock_post.call_args_list[0])
+
+    @patch('httpx.AsyncClient.post', new_callable=AsyncMock, side_effect=[mocked_requests_response('login_failed')])
+    async def test_do_login_failed(self, mock_post):
+
+        # Given
+        e_card_manager = AsyncECardManager()
+
+        # When
+        with self.assertRaises(Exception) as context:
+            await e_card_manager.do_login('login', 'password')
+
+        # Then
+        self.assertEqual('Votre identification est incorrecte.', str(context.exception))
+        self.assertEqual(None, e_card_manager.jsessionid)
+        self.assertEqual(None, e_card_manager.token)
+
+    @patch('builtins.input', return_value='12345678')
+    @patch('httpx.AsyncClient.get', new_callable=AsyncMock,
+           side_effect=[mocked_requests_response('auth_3ds_1_parequest_redirect')])
+    @patch('httpx.AsyncClient.post', new_callable=AsyncMock,
+           side_effect=[mocked_requests_response('auth_3ds_1_parequest'),
+                        mocked_requests_response('auth_3ds_2_getsession'),
+                        mocked_requests_response('auth_3ds_3_startauthent'),
+                        mocked_requests_response('auth_3ds_4_updateauthent'),
+                        mocked_requests_response('auth_3ds_5_endauthent'),
+                        mocked_requests_response('auth_3ds_6_parequestfromauthpages'),
+                        mocked_requests_response('receive3ds')])
+    async def test_auth_3ds_otp_sms(self, mock_post, mock_get, mock_input):
+
+        # Given
+        e_card_manager = self.e_card_manager_logged_in()
+
+        # When
+        await e_card_manager.auth_3ds()
+
+        # Then
+        self.assertEqual(True, e_card_manager.auth_3ds_completed)
+        self.assertEqual(7, mock_post.call_count)
+        self.assertEqual(mock.call('Enter code: '), mock_input.call_args)
+
+        expected_url = self.t3ds_host + '/acs-auth-pages/authent/pages/3ds1234567890abcdef1234567890abcdef'
+        self.assertEqual(expected_url, mock_get.call_args_list[0][0][0])
+
+        expected_url = self.t3ds_host + '/acs-auth-pages/authent/pages/updateAuthent'
+        expected_data = '{"accountId": "accid1234567890-1234567890", "language": "fr", "step": "otp_validating_3", ' \
+                        '"skipCurrentHubCall": false, "hubAuthenticationInput": {"otp": "12345678", "merchantWhitelistedByUser": false}}'
+        expected_headers = {
+            'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
+            'Content-Type': 'application/json'
+        }
+        self.assertEqual(mock.call(expected_url, follow_redirects=True, headers=expected_headers, content=expected_data),
+                         mock_post.call_args_list[3])
+
+        expected_url = self.bank_host + '/receive3ds'
+        expected_data = 'MD=MDRESP1234567890&PaRes=PARES12345678901234567890'
+        self.assertEqual(expected_url, mock_post.call_args_list[6][0][0])
+        self.assertEqual(expected_data, mock_post.call_args_list[6][1]['content'])
+
+    @patch('asyncio.sleep', new_callable=AsyncMock)
+    @patch('httpx.AsyncClient.get', new_callable=AsyncMock,
+           side_effect=[mocked_requests_response('auth_3ds_1_parequest_redirect')])
+    @patch('httpx.AsyncClient.post', new_callable=AsyncMock,
+           side_effect=[mocked_requests_response('auth_3ds_1_parequest'),
+                        mocked_requests_response('auth_3ds_2_getsession'),
+                        mocked_requests_response('auth_3ds_31_startauthent'),
+                        mocked_requests_response('auth_3ds_41_startpolling_waiting'),
+                        mocked_requests_response('auth_3ds_41_startpolling_ko')])
+    async def test_auth_3ds_mobile_app_failed(self, mock_post, mock_get, mock_sleep):
+
+        # Given
+        e_card_manager = self.e_card_manager_logged_in()
+
+        # When
+        with self.assertRaises(Exception) as context:
+            await e_card_manager.auth_3ds()
+
+        # Then
+        self.assertIn('AUTHENTICATION ERROR', str(context.exception))
+        self.assertEqual(False, e_card_manager.auth_3ds_completed)
+        self.assertEqual(2, mock_sleep.await_count)
+
+        expected_url = self.t3ds_host + '/acs-auth-pages/authent/pages/startPolling'
+        expected_data = '{"accountId": "accid1234567890-1234567890", "hubAuthenticationInput": ' \
+                        '{"authenticationId": "hubao-1234567890", "transactionId": "hubsessid-1234567890"}}'
+        self.assertEqual(mock.call(expected_url, follow_redirects=True, headers=mock.ANY, content=expected_data),
+                         mock_post.call_args_list[4])
+
+    @patch('httpx.AsyncClient.post', new_callable=AsyncMock,
+           side_effect=[mocked_requests_response('generate_ecard_success')])
+    async def test_generate_ecard_success(self, mock_post):
+
+        # Given
+        e_card_manager = self.e_card_manager_logged_in()
+
+        # When
+        e_card = await e_card_manager.generate_ecard('10.54', '1.000000', '3')
+
+        # Then
+        self.assertEqual('1234567890123456', e_card.number)
+        self.assertEqual('01/23', e_card.expired_at)
+        self.assertEqual('123', e_card.cvv)
+        self.assertEqual('M XXXXX YYYYY', e_card.owner)
+
+        expected_url = self.bank_host + '/cpn'
+        expected_data = 'request=ocode&token=9876543210&montant=10.54&devise=1.000000&dateValidite=3'
+        expected_headers = {
+            'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
+        self.assertEqual(mock.call(expected_url, follow_redirects=True, content=expected_data, headers=expected_headers),
+                         mock_post.call_args_list[0])
+
+    @patch('httpx.AsyncClient.post', new_callable=AsyncMock, side_effect=[mocked_requests_response('historic')])
+    async def test_historic(self, mock_post):
+
+        # Given
+        e_card_manager = self.e_card_manager_logged_in()
+
+        # When
+        all_historic = await e_card_manager.list_historic()
+
+        # Then
+        self.assertEqual(len(all_historic), 9)
+        self.assertEqual(self.bank_host + '/historic', mock_post.call_args_list[0][0][0])
+
+    @patch('httpx.AsyncClient.get', new_callable=AsyncMock, side_effect=[mocked_requests_response('logout')])
+    async def test_do_logout(self, mock_get):
+
+        # Given
+        e_card_manager = self.e_card_manager_logged_in()
+
+        # When
+        await e_card_manager.do_logout()
+
+        # Then
+        expected_headers = {
+            'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*'
+        }
+        self.assertEqual(mock.call(self.bank_host + '/logout', follow_redirects=True, headers=expected_headers),
+                         mock_get.call_args_list[0])
+
+    async def test_shared_pool_keeps_cookies_apart(self):
+
+        # Given
+        pool = AsyncHttpTransport.create_pool()
+        first = AsyncECardManager(AsyncHttpTransport(pool))
+        second = AsyncECardManager(AsyncHttpTransport(pool))
+
+        # When
+        first.jsessionid = '1111111111ABCDEF1234567890ABCDEF'
+        second.jsessionid = '2222222222ABCDEF1234567890ABCDEF'
+
+        # Then
+        self.assertIs(first.transport.client._transport, second.transport.client._transport)
+        self.assertEqual('1111111111ABCDEF1234567890ABCDEF', first.jsessionid)
+        self.assertEqual('2222222222ABCDEF1234567890ABCDEF', second.jsessionid)
+        await first.transport.close()
+        await second.transport.close()
+        await pool.aclose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,598 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import io
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest.mock import patch
+
+import lxml.html as html_parser
+import requests
+
+import ecard
+from ecard import TableFormatter
+from ecard_client import BankProfile, BankRegistry, ECardManager, HttpTransport, PollingScheduler, RequestScheduler, \
+    generate_batch
+from ecard_credentials import EnvProvider
+from ecard_fixtures import synthesize_historic, synthetic_historic, write_fixture
+from ecard_har import HarFileHandler
+from ecard_pages import ECard, HistoricBatch, HistoricEntry
+from ecard_orchestrator import CardProfile, orchestrate
+from ecard_stub import StubServer, bank_routes, load_mock, t3ds_mobile_routes, t3ds_routes
+
+
+class OneShotTransport(HttpTransport):
+    """Former behaviour: module level requests calls, opening a new connection for each request."""
+
+    def post(self, url: str, headers: dict, data: str, allow_redirects=True):
+        return requests.post(url, headers=headers, data=data, allow_redirects=allow_redirects,
+                             cookies=self.session.cookies)
+
+    def get(self, url: str, headers: dict, allow_redirects=True):
+        return requests.get(url, headers=headers, allow_redirects=allow_redirects, cookies=self.session.cookies)
+
+
+def dom_historic_entries(html: str) -> list:
+    """Former historic parser: the whole page as a DOM, then two xpath scans over it."""
+    dom = ECardManager.parse_page(html)
+    entries = []
+    for used, pane in [(True, 'history-panes-used-numbers-print'), (False, 'history-panes-unused-numbers-print')]:
+        for row in dom.xpath('//div[@id="' + pane + '"]//table/tr'):
+            values = [col.text.strip() for col in row.getchildren()]
+            entries.append(HistoricEntry.from_page(values, used))
+    return entries
+
+
+def former_parse_login_page(html: str) -> dict:
+    dom = ECardManager.parse_page(html)
+    login_page = {
+        'token': dom.xpath('//input[@name="token"]')[0].attrib['value'].strip(),
+        'auth_3ds_needed': len(dom.xpath('//form[@id="form-3ds-authentificate"]')) > 0
+    }
+    if login_page['auth_3ds_needed']:
+        login_page['md'] = dom.xpath('//input[@name="MD"]')[0].attrib['value'].strip()
+        login_page['pareq'] = dom.xpath('//input[@name="PaReq"]')[0].attrib['value'].strip()
+        login_page['termurl'] = dom.xpath('//input[@name="TermUrl"]')[0].attrib['value'].strip()
+    return login_page
+
+
+def former_parse_pa_response_page(html: str) -> tuple:
+    dom = html_parser.document_fromstring(html)
+    return dom.xpath('//input[@name="MD"]')[0].attrib['value'].strip(), \
+        dom.xpath('//input[@name="PaRes"]')[0].attrib['value'].strip()
+
+
+def former_parse_ecard_page(html: str) -> tuple:
+    dom = ECardManager.parse_page(html)
+    number = dom.xpath('//dd[@id="generated-code-dd"]/span[@data-drag-txt]')[0].attrib['data-drag-txt'].strip()
+    expired_at = dom.xpath('//dl[@id="content-expiration-date"]/dd')[0].text.strip()
+    cvv = dom.xpath('//dl[@id="content-cryptogramme"]//span[@class="restricted-only"]')[0].text.strip()
+    owner = dom.xpath('//dl[@id="content-card-owner"]//span[@class="restricted-only"]')[0].text.strip()
+    tokens = dom.xpath('//input[@name="token"]')
+    return ECard(number, expired_at, cvv, owner), tokens[0].attrib['value'].strip() if len(tokens) > 0 else None
+
+
+def former_check_error(html: str) -> None:
+    dom = html_parser.document_fromstring(html)
+    errors = dom.xpath('//form[@id="form-error-confirmation"]//p[@role="alert"]')
+    if len(errors) > 0:
+        for br in errors[0].xpath('//br'):
+            br.tail = '\n' + br.tail if br.tail else '\n'
+        raise Exception(errors[0].text_content().strip())
+
+
+def synthetic_rows(rows: int) -> list:
+    """The texts and status of rows historic rows, one e-number per hour, unused every tenth."""
+    start = datetime(2020, 12, 8)
+    texts = []
+    for n in range(rows):
+        ceiling = '%d,%02d €' % (n % 500 + 1, n % 100)
+        used = n % 10 != 0
+        merchant = 'SHOP %d' % (n % 100) if used else '-----------'
+        texts.append(([(start - timedelta(hours=n)).strftime('%d/%m/%Y'), merchant,
+                       '1234 5678 %04d %04d' % (n // 10000, n % 10000), ceiling, ceiling if used else '-----------'],
+                      used))
+    return texts
+
+
+def former_sort(rows: list) -> list:
+    return sorted(rows, key=lambda row: datetime.strptime(row[0][0], '%d/%m/%Y'), reverse=True)
+
+
+def former_spend_by(rows: list, key) -> dict:
+    """Former aggregation over the page's texts, each amount parsed again."""
+    totals = {}
+    for values, used in rows:
+        if used:
+            name = key(values)
+            totals[name] = totals.get(name, Decimal(0)) + Decimal(
+                values[4].replace('€', '').replace(' ', '').replace(',', '.'))
+    return totals
+
+
+def former_process_response(response):
+    """Former debug output: every header dict and full body formatted for the console."""
+    if ecard.logger.isEnabledFor(logging.DEBUG):
+        ecard.logger.debug('HEADER REQUESTS')
+        ecard.logger.debug('\n##### url\n' + response.request.method + ' ' + str(response.url))
+        ecard.logger.debug('\n##### request headers\n' + str(response.request.headers))
+        ecard.logger.debug('\n##### request body\n' + str(response.request.body))
+        ecard.logger.debug('\n##### response code\n' + str(response.status_code))
+        ecard.logger.debug('\n##### response headers\n' + str(response.headers))
+        text = os.linesep.join([s for s in response.text.splitlines() if s.strip()])
+        text = text.replace('\t', '  ')
+        ecard.logger.debug('\n# response body\n' + text)
+    if response.status_code >= 400:
+        raise Exception('Something went wrong when calling ' + str(response.url))
+
+
+def measure(function, *args) -> tuple:
+    """Run function in a forked process, and return its latency and how much it raised the peak RSS."""
+    def child(connection):
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        connection.send((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before))
+
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=child, args=(sender,))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+# latency of the stubs for the flows benchmark, in seconds, and probability of a 503 error
+flow_latency = 0.02
+flow_jitter = 0.005
+flow_error_rate = 0.0
+# prefetch benchmark: duration of the tcp and tls handshakes of a new connection, keep-alive timeout of the servers,
+# and time to type the sms code, all in seconds
+handshake_latency = 0.06
+server_keepalive = 0.1
+otp_typing = 0.2
+
+
+@contextlib.contextmanager
+def stub_servers(delay=0.0, jitter=0.0, error_rate=0.0, t3ds=None, handshake=0.0, keepalive=None):
+    with StubServer(bank_routes, delay=delay, jitter=jitter, error_rate=error_rate, seed=1, handshake=handshake,
+                    keepalive=keepalive) as bank_server, \
+            StubServer(t3ds or t3ds_routes, delay=delay, jitter=jitter, error_rate=error_rate, seed=2,
+                       handshake=handshake, keepalive=keepalive) as t3ds_server:
+        with patch.object(ecard, 't3ds_host', t3ds_server.url), \
+                patch.object(ecard, 'service_url', bank_server.url + '/fr/'), \
+                patch('builtins.input', return_value='12345678'):
+            yield bank_server, t3ds_server
+
+
+def full_flow(e_card_manager: ECardManager):
+    with contextlib.redirect_stdout(io.StringIO()):
+        e_card_manager.do_login('login', 'password')
+        if e_card_manager.auth_3ds_needed:
+            e_card_manager.auth_3ds()
+        e_card_manager.generate_ecard('10.54', '1.000000', '3')
+        e_card_manager.do_logout()
+
+
+def percentile(values: list, rank: int) -> float:
+    """Nearest-rank percentile."""
+    values = sorted(values)
+    return values[max(0, -(-len(values) * rank // 100) - 1)]
+
+
+def flow_login(e_card_manager: ECardManager):
+    e_card_manager.do_login('login', 'password')
+
+
+def flow_login_3ds(e_card_manager: ECardManager):
+    e_card_manager.do_login('login', 'password')
+    e_card_manager.auth_3ds()
+
+
+def bench_flows(runs: int) -> list:
+    """Each flow runs times against stubs answering in flow_latency ± flow_jitter, with flow_error_rate 503 errors.
+
+    Login flows start with a new client and end with a logout; generate and historic run in an authenticated session.
+    """
+    rows = [['FLOW', 'RUNS', 'FAILED', 'P50', 'P95', 'P99', 'REQUESTS/FLOW']]
+    flows = [
+        ('login', t3ds_routes, None, flow_login),
+        ('login + otp 3ds', t3ds_routes, None, flow_login_3ds),
+        ('login + mobile 3ds', t3ds_mobile_routes, None, flow_login_3ds),
+        ('generate', t3ds_routes, flow_login_3ds, lambda e_card_manager: e_card_manager.generate_ecard(
+            '10.54', '1.000000', '3')),
+        ('historic', t3ds_routes, flow_login_3ds, lambda e_card_manager: e_card_manager.list_historic()),
+    ]
+    for name, t3ds, session, flow in flows:
+        with stub_servers(flow_latency, flow_jitter, flow_error_rate, t3ds) as (bank_server, t3ds_server), \
+                contextlib.redirect_stdout(io.StringIO()):
+            host = bank_server.url + '/fr/' + ecard.bank
+            # the mobile app approval is polled right away
+            polling = PollingScheduler(first_interval=0.001, jitter=0)
+            e_card_manager = ECardManager(host=host, polling=polling)
+            while session:
+                try:
+                    session(e_card_manager)
+                    break
+                except Exception:
+                    # injected error, login again
+                    e_card_manager = ECardManager(host=host, polling=polling)
+            requests_before = bank_server.requests + t3ds_server.requests
+
+            timings = []
+            failed = 0
+            for _ in range(runs):
+                if not session:
+                    e_card_manager = ECardManager(host=host, polling=polling)
+                start = time.perf_counter()
+                try:
+                    flow(e_card_manager)
+                    timings.append(time.perf_counter() - start)
+                except Exception:
+                    failed += 1
+                if not session:
+                    with contextlib.suppress(Exception):
+                        e_card_manager.do_logout()
+                    e_card_manager.transport.close()
+            requests_count = bank_server.requests + t3ds_server.requests - requests_before
+
+        rows.append([name, str(runs), str(failed)]
+                    + ['%.1f ms' % (percentile(timings, rank) * 1000) if timings else '─' for rank in [50, 95, 99]]
+                    + ['%.1f' % (requests_count / runs)])
+    return rows
+
+
+def bench_prefetch(runs: int) -> list:
+    """Login + OTP 3D Secure + generate, with and without the connections opened ahead of their first request.
+
+    The stubs answer in flow_latency, a new connection costs handshake_latency more, and they close the connections
+    idle for server_keepalive, shorter than the otp_typing of the sms code. Typing the code isn't counted.
+    """
+    rows = [['PREFETCH', 'RUNS', 'P50', 'P95', 'CONNECTIONS/FLOW', 'REQUESTS/FLOW']]
+    for prefetch in [False, True]:
+        with stub_servers(flow_latency, flow_jitter, t3ds=t3ds_routes, handshake=handshake_latency,
+                          keepalive=server_keepalive) as (bank_server, t3ds_server), \
+                patch.object(ecard, 'prefetch_connections', prefetch), \
+                patch('builtins.input', side_effect=lambda prompt: time.sleep(otp_typing) or '12345678'):
+            timings = []
+            for _ in range(runs):
+                e_card_manager = ECardManager()
+                start = time.perf_counter()
+                full_flow(e_card_manager)
+                timings.append(time.perf_counter() - start - otp_typing)
+                e_card_manager.transport.close()
+            connections = bank_server.connections + t3ds_server.connections
+            requests_count = bank_server.requests + t3ds_server.requests
+
+        rows.append(['on' if prefetch else 'off', str(runs)]
+                    + ['%.1f ms' % (percentile(timings, rank) * 1000) for rank in [50, 95]]
+                    + ['%.1f' % (connections / runs), '%.1f' % (requests_count / runs)])
+    return rows
+
+
+def import_times(*args) -> dict:
+    """Cumulative import time in microseconds of each module, from python -X importtime run with args."""
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + list(args), stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    times = {}
+    for line in process.stderr.decode('utf-8').splitlines():
+        if line.startswith('import time:') and '|' in line and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def bench_startup(runs: int) -> list:
+    """Wall time of the CLI that doesn't need the network (-V), versus loading the http client, and their imports."""
+    rows = [['COMMAND', 'WALL TIME', 'ECARD IMPORT', 'REQUESTS', 'LXML']]
+    commands = [
+        ('ecard.py -V', ['ecard.py', '-V']),
+        ('ecard.py -h', ['ecard.py', '-h']),
+        ('import ecard_client', ['-c', 'import ecard_client']),
+    ]
+    for name, args in commands:
+        start = time.perf_counter()
+        for _ in range(runs):
+            subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, check=True,
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+        elapsed = (time.perf_counter() - start) / runs
+        times = import_times(*args)
+        ecard_import = times.get('ecard_client', 0) + times.get('ecard', 0)
+        rows.append([name, '%.1f ms' % (elapsed * 1000), '%.1f ms' % (ecard_import / 1000)]
+                    + ['%.1f ms' % (times[module] / 1000) if module in times else '─'
+                       for module in ['requests', 'lxml']])
+    return rows
+
+
+def bench_transport(runs: int) -> list:
+    """do_login -> auth_3ds -> generate_ecard -> do_logout, with and without connection pooling."""
+    rows = [['TRANSPORT', 'RUNS', 'WALL TIME', 'PER RUN', 'REQUESTS', 'CONNECTIONS']]
+    for name, transport_class in [('one-shot', OneShotTransport), ('pooled', HttpTransport)]:
+        with stub_servers() as (bank_server, t3ds_server):
+            start = time.perf_counter()
+            for _ in range(runs):
+                transport = transport_class()
+                full_flow(ECardManager(transport, host=bank_server.url + '/fr/' + ecard.bank))
+                transport.close()
+            elapsed = time.perf_counter() - start
+            rows.append([name, str(runs), '%.3f s' % elapsed, '%.1f ms' % (elapsed * 1000 / runs),
+                         str(bank_server.requests + t3ds_server.requests),
+                         str(bank_server.connections + t3ds_server.connections)])
+    return rows
+
+
+def bench_banks(runs: int) -> list:
+    """Full flows of 3 banks in turn, in a single process: a new transport per session versus the shared pools of a
+    BankRegistry, against stubs whose new connections cost a simulated tcp and tls handshake."""
+    banks = ['caisse-epargne', 'sg', 'labanquepostale']
+    rows = [['TRANSPORTS', 'RUNS', 'PER RUN', 'REQUESTS', 'CONNECTIONS']]
+    for name, registry in [('per session', None), ('pool per bank', BankRegistry())]:
+        with stub_servers(handshake=handshake_latency) as (bank_server, t3ds_server):
+            start = time.perf_counter()
+            for run in range(runs):
+                bank = banks[run % len(banks)]
+                e_card_manager = ECardManager(bank=BankProfile.of_bank(bank)) if registry is None \
+                    else registry.manager(bank)
+                full_flow(e_card_manager)
+                e_card_manager.transport.close()
+            elapsed = time.perf_counter() - start
+            if registry is not None:
+                registry.close()
+            rows.append([name, str(runs), '%.1f ms' % (elapsed * 1000 / runs),
+                         str(bank_server.requests + t3ds_server.requests),
+                         str(bank_server.connections + t3ds_server.connections)])
+    return rows
+
+
+def bench_logging(runs: int) -> list:
+    """Login, 3D Secure, generate, historic and logout against the stubs, at the INFO and DEBUG levels: the former
+    console dump of each exchange, the current one-line summary, and the summary with the HAR capture."""
+    rows = [['LOGGING', 'PER RUN', 'VS INFO']]
+    console = ecard.logger.handlers[0]
+    levels = [
+        ('info', logging.INFO, None, None),
+        ('debug, former dump', logging.DEBUG, former_process_response, None),
+        ('debug', logging.DEBUG, None, None),
+        ('debug + har capture', logging.DEBUG, None, True),
+    ]
+    baseline = None
+    with stub_servers() as (bank_server, t3ds_server), tempfile.TemporaryDirectory() as directory:
+        host = bank_server.url + '/fr/' + ecard.bank
+        for name, level, process_response, capture in levels:
+            with contextlib.ExitStack() as stack:
+                stack.callback(ecard.logger.setLevel, ecard.logger.level)
+                ecard.logger.setLevel(level)
+                stack.callback(console.setStream, console.setStream(io.StringIO()))
+                if process_response:
+                    stack.enter_context(patch.object(ECardManager, '_process_response', process_response))
+                if capture:
+                    handler = HarFileHandler(os.path.join(directory, 'http.har'))
+                    logging.getLogger('ecard.http').addHandler(handler)
+                    stack.callback(logging.getLogger('ecard.http').removeHandler, handler)
+                    stack.callback(handler.close)
+                start = time.perf_counter()
+                for _ in range(runs):
+                    e_card_manager = ECardManager(host=host)
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        e_card_manager.do_login('login', 'password')
+                        e_card_manager.auth_3ds()
+                        e_card_manager.generate_ecard('10.54', '1.000000', '3')
+                        e_card_manager.list_historic()
+                        e_card_manager.do_logout()
+                    e_card_manager.transport.close()
+                elapsed = (time.perf_counter() - start) / runs
+            baseline = baseline or elapsed
+            rows.append([name, '%.1f ms' % (elapsed * 1000), '%+.0f %%' % ((elapsed / baseline - 1) * 100)])
+    return rows
+
+
+def bench_batch(runs: int) -> list:
+    """A single login and 3D Secure authentication, then one /cpn call per card."""
+    rows = [['CARDS', 'GENERATED', 'WALL TIME', 'CARDS/S', 'REQUESTS', 'CONNECTIONS']]
+    lines = ['%d.00,1.000000,3' % (amount + 1) for amount in range(runs)]
+    with stub_servers() as (bank_server, t3ds_server):
+        start = time.perf_counter()
+        e_card_manager = ECardManager(host=bank_server.url + '/fr/' + ecard.bank)
+        with contextlib.redirect_stdout(io.StringIO()):
+            e_card_manager.do_login('login', 'password')
+            e_card_manager.auth_3ds()
+            results = list(generate_batch(e_card_manager, lines, '3'))
+            e_card_manager.do_logout()
+        elapsed = time.perf_counter() - start
+        generated = len([result for result in results if 'error' not in result])
+        rows.append([str(runs), str(generated), '%.3f s' % elapsed, '%.1f' % (generated / elapsed),
+                     str(bank_server.requests + t3ds_server.requests),
+                     str(bank_server.connections + t3ds_server.connections)])
+    return rows
+
+
+def bench_accounts(runs: int) -> list:
+    """N accounts run in parallel by the orchestrator, with 50 ms of latency per request and 8 requests per host, not
+    paced by a scheduler."""
+    rows = [['ACCOUNTS', 'WORKERS', 'WALL TIME', 'ACCOUNTS/S', 'SPEEDUP', 'FAILED']]
+    os.environ.update({'ECARD_BENCH_LOGIN': 'login', 'ECARD_BENCH_PASSWORD': 'password'})
+    credentials = EnvProvider('ECARD_BENCH_LOGIN', 'ECARD_BENCH_PASSWORD')
+    single = None
+    accounts = 1
+    while accounts <= runs:
+        profiles = [CardProfile('card%d' % account, credentials=credentials, amount='10.00')
+                    for account in range(accounts)]
+        with stub_servers(delay=0.05), contextlib.redirect_stdout(io.StringIO()):
+            report = orchestrate(profiles, workers=accounts, requests_per_host=8,
+                                 scheduler=RequestScheduler(host_rate=0, account_rate=0))
+        throughput = accounts / report['elapsed']
+        single = single or throughput
+        rows.append([str(accounts), str(accounts), '%.3f s' % report['elapsed'], '%.1f' % throughput,
+                     '%.1fx' % (throughput / single), str(report['failed'])])
+        accounts *= 2
+    return rows
+
+
+def bench_ratelimit(runs: int) -> list:
+    """min(runs, 32) accounts generating an e-number at once, with 20 ms of latency per request, against a bank
+    blocking the requests past 40 per second in bursts of up to 10: unpaced, then paced by the request scheduler at 30
+    per second per host, the 3D Secure one included."""
+    rows = [['SCHEDULER', 'ACCOUNTS', 'SUCCEEDED', 'BLOCKED', 'WALL TIME', 'REQUESTS/S', 'MEAN WAIT', 'MAX WAIT']]
+    os.environ.update({'ECARD_BENCH_LOGIN': 'login', 'ECARD_BENCH_PASSWORD': 'password'})
+    credentials = EnvProvider('ECARD_BENCH_LOGIN', 'ECARD_BENCH_PASSWORD')
+    accounts = min(runs, 32)
+    profiles = [CardProfile('card%d' % account, credentials=credentials, amount='10.00') for account in range(accounts)]
+    for name, scheduler in [('none', RequestScheduler(host_rate=0, account_rate=0)),
+                            ('30/s per host', RequestScheduler(host_rate=30, host_burst=10))]:
+        with StubServer(bank_routes, delay=0.02, rate_limit=40, rate_burst=10) as bank_server, \
+                StubServer(t3ds_routes, delay=0.02) as t3ds_server, \
+                patch.object(ecard, 't3ds_host', t3ds_server.url), \
+                patch.object(ecard, 'service_url', bank_server.url + '/fr/'), \
+                patch('builtins.input', return_value='12345678'), contextlib.redirect_stdout(io.StringIO()):
+            report = orchestrate(profiles, workers=accounts, requests_per_host=8, scheduler=scheduler)
+            # both hosts are paced
+            hosts = scheduler.stats().values()
+            requests = sum(stats['requests'] for stats in hosts)
+            rows.append([name, str(accounts), str(report['succeeded']), str(bank_server.blocked),
+                         '%.3f s' % report['elapsed'],
+                         '%.1f' % ((bank_server.requests + t3ds_server.requests) / report['elapsed']),
+                         '%.0f ms' % (sum(stats['wait_seconds'] for stats in hosts) * 1000 / max(requests, 1)),
+                         '%.0f ms' % (max([stats['max_wait'] for stats in hosts] or [0]) * 1000)])
+    return rows
+
+
+def bench_pages(runs: int) -> list:
+    """Parse and extract each page runs x 100 times, with the former per-call xpath strings and the page schemas."""
+    rows = [['PAGE', 'FORMER', 'SCHEMA', 'SPEEDUP']]
+    pages = [
+        ('login', 'login_success_auth_3ds_needed', former_parse_login_page, ECardManager.parse_login_page),
+        ('3ds response', 'auth_3ds_6_parequestfromauthpages', former_parse_pa_response_page,
+         ECardManager.parse_pa_response_page),
+        ('cpn result', 'generate_ecard_success', former_parse_ecard_page, ECardManager.parse_ecard_page),
+        ('error', 'login_blocked', former_check_error, ECardManager.parse_page),
+    ]
+    for name, mock, former, current in pages:
+        html = load_mock(mock)[2].decode('utf-8')
+        timings = []
+        for parser in [former, current]:
+            start = time.perf_counter()
+            for _ in range(runs * 100):
+                try:
+                    parser(html)
+                except Exception:
+                    pass
+            timings.append((time.perf_counter() - start) / (runs * 100))
+        rows.append([name, '%.1f µs' % (timings[0] * 1e6), '%.1f µs' % (timings[1] * 1e6),
+                     '%.2fx' % (timings[0] / timings[1])])
+    return rows
+
+
+def bench_historic(runs: int) -> list:
+    """Parsing synthetic historic pages of 1k, 10k and 100k rows, and fetching them from a stub, best latency of runs
+    (at most 5)."""
+    rows = [['ROWS', 'PARSER', 'LATENCY', 'PEAK RSS', 'ENTRIES']]
+    parsers = [
+        ('dom', lambda html: dom_historic_entries(html)),
+        ('streaming', lambda html: list(ECardManager.iter_historic_entries(ECardManager.chunks(html)))),
+        ('streaming, last 30 days', lambda html: list(ECardManager.iter_historic_entries(
+            ECardManager.chunks(html), since=date(2020, 11, 8)))),
+        ('streaming, 100 rows', lambda html: list(ECardManager.iter_historic_entries(
+            ECardManager.chunks(html), limit=100))),
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        for size in [1000, 10000, 100000]:
+            html = synthetic_historic(size)
+            for name, parser in parsers:
+                measures = [measure(parser, html) for _ in range(max(1, min(runs, 5)))]
+                rows.append([str(size), name, '%.1f ms' % (min(elapsed for elapsed, _ in measures) * 1000),
+                             '%.1f MB' % (max(rss for _, rss in measures) / 1024), str(len(parser(html)))])
+
+            # end to end: the synthesized fixture served by a stub, fetched and parsed by the client
+            path = os.path.join(directory, 'historic_%d' % size)
+            write_fixture(path + '.json', synthesize_historic(size))
+            with StubServer([('POST', r'/historic$', path)]) as server:
+                def fetch():
+                    return ECardManager(host=server.url + '/fr/caisse-epargne').list_historic_entries()
+                measures = [measure(fetch) for _ in range(max(1, min(runs, 5)))]
+                rows.append([str(size), 'http + streaming',
+                             '%.1f ms' % (min(elapsed for elapsed, _ in measures) * 1000),
+                             '%.1f MB' % (max(rss for _, rss in measures) / 1024), str(len(fetch()))])
+    return rows
+
+
+def bench_entries(runs: int) -> list:
+    """Sorting and aggregating a synthetic 100k rows historic, from the page's texts versus typed entries and their
+    columnar batch, best latency of runs (at most 5)."""
+    texts = synthetic_rows(100000)
+    entries = [HistoricEntry.from_page(values, used) for values, used in texts]
+    batch = HistoricBatch(entries)
+    operations = [
+        ('parse entries', None, lambda: [HistoricEntry.from_page(values, used) for values, used in texts]),
+        ('columnar batch', None, lambda: HistoricBatch(entries)),
+        ('sort by date', lambda: former_sort(texts),
+         lambda: sorted(entries, key=lambda entry: entry.date, reverse=True)),
+        ('spend per merchant', lambda: former_spend_by(texts, lambda values: values[1]), batch.spend_by_merchant),
+        ('spend per month', lambda: former_spend_by(
+            texts, lambda values: datetime.strptime(values[0], '%d/%m/%Y').strftime('%Y-%m')), batch.spend_by_month),
+        ('stats per merchant', None, lambda: batch.stats('merchant')),
+        ('stats per month', None, lambda: batch.stats('month')),
+    ]
+    rows = [['100k ROWS', 'TEXTS', 'TYPED', 'SPEEDUP']]
+    for name, former, typed in operations:
+        timings = []
+        for function in [former, typed]:
+            if function is None:
+                timings.append(None)
+                continue
+            best = None
+            for _ in range(max(1, min(runs, 5))):
+                start = time.perf_counter()
+                function()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best)
+        rows.append([name, '─' if timings[0] is None else '%.1f ms' % (timings[0] * 1000),
+                     '%.1f ms' % (timings[1] * 1000),
+                     '─' if timings[0] is None else '%.1fx' % (timings[0] / timings[1])])
+    return rows
+
+
+benchmarks = {
+    'flows': bench_flows,
+    'transport': bench_transport,
+    'banks': bench_banks,
+    'batch': bench_batch,
+    'accounts': bench_accounts,
+    'ratelimit': bench_ratelimit,
+    'historic': bench_historic,
+    'entries': bench_entries,
+    'pages': bench_pages,
+    'prefetch': bench_prefetch,
+    'startup': bench_startup,
+    'logging': bench_logging,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ecard benchmarks against local stub servers')
+    parser.add_argument('benchmark', nargs='*', choices=[[]] + list(benchmarks), help='benchmarks to run, default all')
+    parser.add_argument('-n', '--runs', type=int, default=50, help='number of runs, default is 50')
+    parser.add_argument('--latency', type=float, default=flow_latency * 1000,
+                        help='flows: stubs latency in ms, default is %g' % (flow_latency * 1000))
+    parser.add_argument('--jitter', type=float, default=flow_jitter * 1000,
+                        help='flows: stubs latency jitter in ms, default is %g' % (flow_jitter * 1000))
+    parser.add_argument('--error-rate', type=float, default=flow_error_rate,
+                        help='flows: probability of a 503 error per request, default is %g' % flow_error_rate)
+    _args = parser.parse_args()
+    flow_latency, flow_jitter, flow_error_rate = _args.latency / 1000, _args.jitter / 1000, _args.error_rate
+
+    for benchmark in _args.benchmark or list(benchmarks):
+        table_formatter = TableFormatter()
+        table_formatter.set_rows(benchmarks[benchmark](_args.runs))
+        print(benchmark)
+        print(table_formatter)
@@ -0,0 +1,1551 @@
+#!/usr/bin/python3
+
+import argparse
+import base64
+import collections
+import contextlib
+import csv
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+from datetime import date
+from decimal import Decimal
+
+import requests
+from requests import Response
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+import ecard
+import ecard_pages
+from ecard import logger
+from ecard_pages import ECard, HistoricBatch, HistoricEntry
+
+# http exchanges, logged at the DEBUG level (see ecard_har.capture)
+http_logger = logging.getLogger('ecard.http')
+
+# http steps of the hook events, by url path
+http_steps = [(step, re.compile(pattern)) for step, pattern in [
+    ('login', r'/login$'),
+    ('payer', r'/payer$'),
+    ('paRequest', r'/pa/paRequest$'),
+    ('paRequestFromAuthPages', r'/pa/paRequestFromAuthPages$'),
+    ('getSession', r'/authent/pages/getSession/\w+$'),
+    ('startAuthent', r'/authent/pages/startAuthent$'),
+    ('updateAuthent', r'/authent/pages/updateAuthent$'),
+    ('startPolling', r'/authent/pages/startPolling$'),
+    ('endAuthent', r'/authent/pages/endAuthent$'),
+    ('authentPage', r'/authent/pages/\w+$'),
+    ('receive3ds', r'/receive3ds$'),
+    ('cpn', r'/cpn$'),
+    ('historic', r'/historic$'),
+    ('logout', r'/logout$'),
+]]
+
+
+# paths of the http steps, relative to the bank's url and to its 3D Secure host; getSession is followed by the id of
+# the 3D Secure session
+bank_endpoints = {
+    'login': '/login',
+    'payer': '/payer',
+    'receive3ds': '/receive3ds',
+    'cpn': '/cpn',
+    'historic': '/historic',
+    'logout': '/logout',
+}
+t3ds_endpoints = {
+    'paRequest': '/acs-pa-service/pa/paRequest',
+    'getSession': '/acs-auth-pages/authent/pages/getSession/',
+    'startAuthent': '/acs-auth-pages/authent/pages/startAuthent',
+    'updateAuthent': '/acs-auth-pages/authent/pages/updateAuthent',
+    'startPolling': '/acs-auth-pages/authent/pages/startPolling',
+    'endAuthent': '/acs-auth-pages/authent/pages/endAuthent',
+    'paRequestFromAuthPages': '/acs-pa-service/pa/paRequestFromAuthPages',
+}
+
+# statuses of the failed requests that can succeed if retried
+retry_statuses = (500, 502, 503, 504)
+
+
+def http_step(url: str) -> str:
+    """The http step of a url, None if unknown."""
+    path = urllib.parse.urlparse(url).path
+    return next((step for step, pattern in http_steps if pattern.search(path)), None)
+
+
+class PollingScheduler:
+    """Delays between polling requests: short at first, then growing exponentially with jitter, until a deadline.
+
+    Waiting can be cancelled from another thread with cancel(); a cancelled scheduler stays cancelled.
+    """
+
+    def __init__(self, first_interval=0.5, max_interval=5.0, factor=1.5, jitter=0.2, deadline: float = None,
+                 clock=time.monotonic, sleep=None):
+        self.first_interval = first_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.deadline = ecard.mobile_app_auth_deadline if deadline is None else deadline
+        self.clock = clock
+        self.cancelled = threading.Event()
+        self.sleep = sleep or self.cancelled.wait
+
+    def delays(self):
+        """Yield the delay to wait before each request, and stop once the deadline is reached."""
+        start = self.clock()
+        interval = self.first_interval
+        while True:
+            remaining = self.deadline - (self.clock() - start)
+            if remaining <= 0:
+                return
+            delay = min(interval, self.max_interval) * random.uniform(1 - self.jitter, 1 + self.jitter)
+            yield min(delay, remaining)
+            interval *= self.factor
+
+    def wait(self, delay: float) -> None:
+        self.sleep(delay)
+        self.check_cancelled()
+
+    def check_cancelled(self) -> None:
+        if self.cancelled.is_set():
+            raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nAuthentication canceled.')
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+
+class HostLimiter:
+    """Bounds the number of concurrent requests to each host, for all the transports sharing it."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self.semaphores[host]
+
+
+class RetryPolicy:
+    """Timeouts and retries of the requests of an http step, the configuration's unless overridden."""
+
+    def __init__(self, connect_timeout: float = None, read_timeout: float = None, retries: int = None,
+                 backoff: float = None, idempotent: bool = False, jitter: float = 0.2):
+        self.connect_timeout = ecard.http_connect_timeout if connect_timeout is None else connect_timeout
+        self.read_timeout = ecard.http_read_timeout if read_timeout is None else read_timeout
+        self.retries = ecard.http_retries if retries is None else retries
+        self.backoff = ecard.http_retry_backoff if backoff is None else backoff
+        # a request of an idempotent step is retried even if the server may have processed it
+        self.idempotent = idempotent
+        self.jitter = jitter
+
+    @property
+    def timeout(self) -> tuple:
+        return self.connect_timeout, self.read_timeout
+
+    def delay(self, attempt: int) -> float:
+        """Delay before the retry following the attempt, counted from 0."""
+        return self.backoff * 2 ** attempt * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    @staticmethod
+    def of_step(step: str) -> 'RetryPolicy':
+        return RetryPolicy(**ecard.http_step_policies.get(step, {}))
+
+
+class CircuitBreaker:
+    """Per host circuit breaker, shared by the transports: fails the requests to a host at once while it is down.
+
+    After failures failed requests in a row (connection error, timeout or 5xx status), the circuit of the host opens and
+    its requests are rejected for reset_timeout seconds. Then a single trial request is let through: its success closes
+    the circuit, its failure opens it for another period. Also counts the requests, failures and retries of each host.
+    """
+
+    def __init__(self, failures: int = None, reset_timeout: float = None, clock=time.monotonic):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host(self, host: str) -> dict:
+        if host not in self.hosts:
+            self.hosts[host] = {'state': 'closed', 'failures_in_row': 0, 'opened_at': None, 'requests': 0,
+                                'failures': 0, 'timeouts': 0, 'retries': 0, 'rejected': 0, 'opens': 0}
+        return self.hosts[host]
+
+    def check(self, host: str) -> None:
+        """Raise if the circuit of the host is open, or half-open with its trial request in flight."""
+        with self.lock:
+            stats = self.host(host)
+            if stats['state'] == 'open':
+                remaining = self.get_reset_timeout() - (self.clock() - stats['opened_at'])
+                if remaining <= 0:
+                    stats['state'] = 'half-open'
+                    stats['requests'] += 1
+                    return
+            elif stats['state'] == 'closed':
+                stats['requests'] += 1
+                return
+            else:
+                remaining = 0
+            stats['rejected'] += 1
+        raise Exception('Circuit breaker open for ' + host + ' after ' + str(stats['failures_in_row'])
+                        + ' failed requests, retry in %.0f s' % max(remaining, 1))
+
+    def release(self, host: str) -> None:
+        """The request let through by check wasn't sent: the trial of a half-open circuit is left to the next one."""
+        with self.lock:
+            stats = self.host(host)
+            stats['requests'] -= 1
+            if stats['state'] == 'half-open':
+                stats['state'] = 'open'
+
+    def success(self, host: str) -> None:
+        with self.lock:
+            stats = self.host(host)
+            stats['failures_in_row'] = 0
+            stats['state'] = 'closed'
+
+    def failure(self, host: str, timeout: bool = False) -> None:
+        with self.lock:
+            stats = self.host(host)
+            stats['failures'] += 1
+            stats['timeouts'] += timeout
+            stats['failures_in_row'] += 1
+            if stats['state'] == 'half-open' or stats['state'] == 'closed' \
+                    and stats['failures_in_row'] >= self.get_failures():
+                if stats['state'] == 'closed':
+                    logger.warning('circuit breaker open for %s after %d failed requests', host,
+                                   stats['failures_in_row'])
+                stats['state'] = 'open'
+                stats['opened_at'] = self.clock()
+                stats['opens'] += 1
+
+    def retry(self, host: str) -> None:
+        with self.lock:
+            self.host(host)['retries'] += 1
+
+    def stats(self) -> dict:
+        """Counters and state of each host."""
+        with self.lock:
+            return {host: {name: value for name, value in stats.items() if name != 'opened_at'}
+                    for host, stats in self.hosts.items()}
+
+    def get_failures(self) -> int:
+        return ecard.breaker_failures if self.failures is None else self.failures
+
+    def get_reset_timeout(self) -> float:
+        return ecard.breaker_reset_timeout if self.reset_timeout is None else self.reset_timeout
+
+
+# shared by the transports, so all the sessions of a daemon or orchestrator stop calling a host that is down
+circuit_breaker = CircuitBreaker()
+
+
+# priority classes of the requests, highest first, see RequestScheduler
+interactive = 'interactive'
+background = 'background'
+priority_classes = [interactive, background]
+
+
+class TokenBucket:
+    """rate tokens per second, up to burst, taken one per request."""
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds before a token is available, 0 if one is."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class RequestScheduler:
+    """Paces the requests of the transports sharing it, below the rate limits of the bank.
+
+    A request waits for a token of its host's bucket and of its account's bucket. The waiting requests of a host are
+    dispatched by priority class (interactive before background), and in turn between the accounts of a class, so an
+    account's burst doesn't delay the others; a request whose account has no token lets the next one go. The caller
+    gets backpressure as an exception: a background request is rejected at once while queue_limit requests are waiting
+    for the host, and any request after waiting max_wait seconds. Counts the requests and their waits per host.
+    """
+
+    def __init__(self, host_rate: float = None, host_burst: float = None, account_rate: float = None,
+                 account_burst: float = None, queue_limit: int = None, max_wait: float = None, clock=time.monotonic):
+        self.host_rate = ecard.scheduler_host_rate if host_rate is None else host_rate
+        self.host_burst = ecard.scheduler_host_burst if host_burst is None else host_burst
+        self.account_rate = ecard.scheduler_account_rate if account_rate is None else account_rate
+        self.account_burst = ecard.scheduler_account_burst if account_burst is None else account_burst
+        self.queue_limit = ecard.scheduler_queue_limit if queue_limit is None else queue_limit
+        self.max_wait = ecard.scheduler_max_wait if max_wait is None else max_wait
+        self.clock = clock
+        self.hosts = {}
+        self.accounts = {}
+        self.condition = threading.Condition()
+
+    def host(self, host: str) -> dict:
+        if host not in self.hosts:
+            self.hosts[host] = {
+                'bucket': TokenBucket(self.host_rate, self.host_burst, self.clock()) if self.host_rate else None,
+                # waiting requests, by priority class then account, the next account to serve first
+                'queues': {priority: collections.OrderedDict() for priority in priority_classes},
+                'queued': 0, 'requests': 0, 'wait_seconds': 0.0, 'max_wait': 0.0, 'rejected': 0, 'expired': 0}
+        return self.hosts[host]
+
+    def account_bucket(self, account: str):
+        if not self.account_rate or account is None:
+            return None
+        if account not in self.accounts:
+            self.accounts[account] = TokenBucket(self.account_rate, self.account_burst, self.clock())
+        return self.accounts[account]
+
+    def acquire(self, host: str, account: str = None, priority: str = interactive) -> float:
+        """Wait for the turn of a request to the host, and return how long it waited, in seconds."""
+        with self.condition:
+            stats = self.host(host)
+            if priority != interactive and stats['queued'] >= self.queue_limit:
+                stats['rejected'] += 1
+                raise Exception('Too many requests waiting for %s: %d, retry later' % (host, stats['queued']))
+            ticket = object()
+            stats['queues'][priority].setdefault(account, collections.deque()).append(ticket)
+            stats['queued'] += 1
+            start = self.clock()
+            try:
+                while True:
+                    now = self.clock()
+                    chosen, delay = self.next_request(stats, now)
+                    if chosen is ticket:
+                        break
+                    if now - start >= self.max_wait:
+                        stats['expired'] += 1
+                        raise Exception('Rate limited: request to %s waited more than %g s' % (host, self.max_wait))
+                    # another request goes first, or none can until delay
+                    self.condition.notify_all()
+                    self.condition.wait(min(delay, self.max_wait - (now - start)) if chosen is None
+                                        else self.max_wait - (now - start))
+            except BaseException:
+                RequestScheduler.dequeue(stats, priority, account, ticket)
+                self.condition.notify_all()
+                raise
+            RequestScheduler.dequeue(stats, priority, account, ticket, served=True)
+            if stats['bucket'] is not None:
+                stats['bucket'].take()
+            if self.account_bucket(account) is not None:
+                self.account_bucket(account).take()
+            waited = now - start
+            stats['requests'] += 1
+            stats['wait_seconds'] += waited
+            stats['max_wait'] = max(stats['max_wait'], waited)
+            self.condition.notify_all()
+            return waited
+
+    def next_request(self, stats: dict, now: float) -> tuple:
+        """The next request to dispatch and 0, or None and the delay before one can be."""
+        if stats['bucket'] is not None:
+            delay = stats['bucket'].delay(now)
+            if delay > 0:
+                return None, delay
+        delay = None
+        for priority in priority_classes:
+            for account, tickets in stats['queues'][priority].items():
+                bucket = self.account_bucket(account)
+                account_delay = bucket.delay(now) if bucket is not None else 0.0
+                if account_delay == 0:
+                    return tickets[0], 0.0
+                delay = account_delay if delay is None else min(delay, account_delay)
+        return None, delay
+
+    @staticmethod
+    def dequeue(stats: dict, priority: str, account: str, ticket, served: bool = False) -> None:
+        queue = stats['queues'][priority]
+        tickets = queue[account]
+        tickets.remove(ticket)
+        if not tickets:
+            del queue[account]
+        elif served:
+            # the next request of the account waits for the turn of the others
+            queue.move_to_end(account)
+        stats['queued'] -= 1
+
+    def stats(self) -> dict:
+        """Counters of each host: requests dispatched, waiting, rejected or expired, and their waits in seconds."""
+        with self.condition:
+            return {host: {name: value for name, value in stats.items() if name not in ('bucket', 'queues')}
+                    for host, stats in self.hosts.items()}
+
+
+class ConnectionTimings(threading.local):
+    """Time spent opening connections by the current thread's request, filled by the timed connections."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.connections = 0
+        # name resolution and tcp handshake
+        self.connect = 0.0
+        self.tls = 0.0
+
+
+connection_timings = ConnectionTimings()
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        start = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            connection_timings.connections += 1
+            connection_timings.connect += time.perf_counter() - start
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+        start = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            connection_timings.connections += 1
+            connection_timings.connect += time.perf_counter() - start
+
+    def connect(self):
+        start = time.perf_counter()
+        connect = connection_timings.connect
+        try:
+            super().connect()
+        finally:
+            connection_timings.tls += time.perf_counter() - start - (connection_timings.connect - connect)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections record their connect and TLS handshake durations in connection_timings."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+class HttpTransport:
+    """Keep-alive http transport backed by a pooled requests session.
+
+    Connections to the bank and to the 3D Secure host are reused between calls, and cookies set by the servers
+    (JSESSIONID...) are kept in the session's cookie jar and sent back automatically.
+    """
+
+    def __init__(self, pool_size: int = None, limiter: HostLimiter = None, breaker: CircuitBreaker = None,
+                 pool: TimedHTTPAdapter = None, scheduler: RequestScheduler = None, account: str = None):
+        self.session = requests.Session()
+        self.owns_pool = pool is None
+        self.pool = pool or HttpTransport.create_pool(pool_size)
+        self.session.mount('https://', self.pool)
+        self.session.mount('http://', self.pool)
+        self.limiter = limiter
+        self.breaker = breaker or circuit_breaker
+        # paces the requests of the account, and of the other transports sharing it, if any
+        self.scheduler = scheduler
+        self.account = account
+        self.priority = interactive
+        # retry policies, by http step
+        self.policies = {}
+        self.sleep = time.sleep
+        # connections opened in the background, by host
+        self.prefetches = {}
+
+    @staticmethod
+    def create_pool(pool_size: int = None) -> TimedHTTPAdapter:
+        """A connection pool that several transports, one per account, can share, each keeping its own cookies."""
+        pool_size = pool_size or ecard.http_pool_size
+        return TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+    def post(self, url: str, headers: dict, data: str, allow_redirects=True) -> Response:
+        return self.send(self.session.post, url, headers=headers, data=data, allow_redirects=allow_redirects)
+
+    def get(self, url: str, headers: dict, allow_redirects=True) -> Response:
+        return self.send(self.session.get, url, headers=headers, allow_redirects=allow_redirects)
+
+    def send(self, method, url: str, **kwargs) -> Response:
+        """Send the request with the timeouts and retries of its step's policy, unless the host's circuit is open.
+
+        The response of the last attempt is returned, even with a 5xx status; a POST is retried after an error
+        response or a timeout only if its step is idempotent, since the server may have processed it.
+        """
+        self.wait_prefetch(url)
+        policy = self.policy(url)
+        post = method == self.session.post
+        host = urllib.parse.urlparse(url).netloc
+        attempt = 0
+        while True:
+            self.breaker.check(host)
+            if self.scheduler is not None:
+                try:
+                    self.scheduler.acquire(host, self.account, self.priority)
+                except Exception:
+                    self.breaker.release(host)
+                    raise
+            try:
+                if self.limiter is None:
+                    response = method(url, timeout=policy.timeout, **kwargs)
+                else:
+                    with self.limiter.semaphore(url):
+                        response = method(url, timeout=policy.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.breaker.failure(host, timeout=isinstance(e, requests.Timeout))
+                if attempt >= policy.retries or post and not policy.idempotent and not HttpTransport.not_sent(e):
+                    raise
+                logger.debug('retrying %s after: %s', url, e)
+            except Exception:
+                # e.g. a truncated body or too many redirects, not retried, but the outcome of a trial request too
+                self.breaker.failure(host)
+                raise
+            else:
+                if response.status_code not in retry_statuses:
+                    self.breaker.success(host)
+                    return response
+                self.breaker.failure(host)
+                if attempt >= policy.retries or post and not policy.idempotent:
+                    return response
+                logger.debug('retrying %s after a %d status', url, response.status_code)
+            self.breaker.retry(host)
+            self.sleep(policy.delay(attempt))
+            attempt += 1
+
+    @contextlib.contextmanager
+    def prioritized(self, priority: str):
+        """Send the requests of the block with this priority class, see RequestScheduler."""
+        previous = self.priority
+        self.priority = priority
+        try:
+            yield
+        finally:
+            self.priority = previous
+
+    def policy(self, url: str) -> RetryPolicy:
+        step = http_step(url)
+        if step not in self.policies:
+            self.policies[step] = RetryPolicy.of_step(step)
+        return self.policies[step]
+
+    @staticmethod
+    def not_sent(error: Exception) -> bool:
+        """Whether the request failed before being sent, while connecting."""
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(error, requests.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+    def preconnect(self, url: str) -> None:
+        """Open a keep-alive connection to the url's host, TLS handshake included, for the next request."""
+        adapter = self.session.get_adapter(url)
+        # the connection pool of the requests, with the ca bundle and proxies of the environment
+        settings = self.session.merge_environment_settings(url, {}, None, None, None)
+        if hasattr(adapter, 'get_connection_with_tls_context'):
+            pool = adapter.get_connection_with_tls_context(requests.Request('GET', url).prepare(), settings['verify'],
+                                                           settings['proxies'], settings['cert'])
+        else:
+            pool = adapter.get_connection(url, settings['proxies'])
+        connection = pool._get_conn()
+        try:
+            # an idle connection kept alive by the pool is already open
+            if not connection.is_connected:
+                connection.connect()
+        finally:
+            pool._put_conn(connection)
+
+    def prefetch(self, url: str) -> None:
+        """Open a connection to the url's host in the background; the next request to this host waits for it."""
+        host = urllib.parse.urlparse(url).netloc
+        if host not in self.prefetches:
+            self.prefetches[host] = threading.Thread(target=self.preconnect_quietly, args=(url,), daemon=True)
+            self.prefetches[host].start()
+
+    def wait_prefetch(self, url: str) -> None:
+        if self.prefetches:
+            thread = self.prefetches.pop(urllib.parse.urlparse(url).netloc, None)
+            if thread is not None:
+                thread.join()
+
+    def preconnect_quietly(self, url: str) -> None:
+        try:
+            self.preconnect(url)
+        except Exception as e:
+            # the request connects anyway
+            logger.debug('preconnect to %s failed: %s', url, e)
+
+    def set_cookie(self, name: str, value: str, url: str) -> None:
+        parsed_url = urllib.parse.urlparse(url)
+        self.session.cookies.set(name, value, domain=parsed_url.hostname, path=parsed_url.path or '/',
+                                 secure=parsed_url.scheme == 'https')
+
+    def get_cookie(self, name: str, url: str):
+        parsed_url = urllib.parse.urlparse(url)
+        return self.session.cookies.get(name, domain=parsed_url.hostname, path=parsed_url.path or '/')
+
+    def close(self) -> None:
+        # a shared pool is closed by its owner
+        if self.owns_pool:
+            self.session.close()
+
+
+class BankProfile:
+    """A bank of the e-cartebleue service: the url of its pages, the 3D Secure (ACS) host of its cards, and its paths
+    differing from bank_endpoints and t3ds_endpoints, by http step. Defaults are the global vars of the configuration.
+    """
+
+    def __init__(self, name: str, service_url: str = None, t3ds_host: str = None, endpoints: dict = None):
+        self.name = name
+        self.host = (service_url or ecard.service_url) + name
+        self.t3ds_host = t3ds_host or ecard.t3ds_host
+        self.endpoints = dict(bank_endpoints, **t3ds_endpoints)
+        self.endpoints.update(endpoints or {})
+        unknown = set(self.endpoints) - set(bank_endpoints) - set(t3ds_endpoints)
+        if unknown:
+            raise Exception('Unknown endpoints for bank ' + name + ': ' + ', '.join(sorted(unknown)))
+
+    @staticmethod
+    def of_bank(name: str = None) -> 'BankProfile':
+        """The profile of a bank, the configuration's by default, with its bank_profiles settings."""
+        name = name or ecard.bank
+        return BankProfile(name, **ecard.bank_profiles.get(name, {}))
+
+
+class BankRegistry:
+    """The profiles of the banks a process talks to, each with a connection pool shared by all its sessions.
+
+    A long-running process serving many banks builds each profile and pool once: its sessions then only differ by their
+    transport's cookies, and reuse the connections opened by the previous ones to the bank and its 3D Secure host.
+    """
+
+    def __init__(self, pool_size: int = None, scheduler: RequestScheduler = None):
+        self.pool_size = pool_size
+        # paces the requests of all the sessions, if any
+        self.scheduler = scheduler
+        self.profiles = {}
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def profile(self, name: str = None) -> BankProfile:
+        name = name or ecard.bank
+        with self.lock:
+            if name not in self.profiles:
+                self.profiles[name] = BankProfile.of_bank(name)
+                self.pools[name] = HttpTransport.create_pool(self.pool_size)
+            return self.profiles[name]
+
+    def transport(self, name: str = None, limiter: HostLimiter = None, card: str = None) -> HttpTransport:
+        """A transport of the bank, with its own cookies, on the bank's pool."""
+        profile = self.profile(name)
+        return HttpTransport(limiter=limiter, pool=self.pools[profile.name], scheduler=self.scheduler,
+                             account=profile.name + '/' + card if card else None)
+
+    def manager(self, name: str = None, limiter: HostLimiter = None, card: str = None) -> 'ECardManager':
+        """A new session of the bank, whose requests are paced as the ones of the card's account at the bank."""
+        e_card_manager = ECardManager(self.transport(name, limiter, card), bank=self.profile(name))
+        # its sms code, among the ones of the other cards waiting for theirs
+        e_card_manager.card = card
+        return e_card_manager
+
+    def close(self) -> None:
+        with self.lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            pool.close()
+
+
+class ECardManager:
+    def __init__(self, transport: HttpTransport = None, host: str = None, polling: PollingScheduler = None,
+                 bank: BankProfile = None):
+        self.bank = bank or BankProfile.of_bank()
+        # the bank's url, unless overridden
+        self.host = host or self.bank.host
+        self.transport = transport or HttpTransport()
+        self.polling = polling or PollingScheduler()
+        self.transport.set_cookie('eCarteBleue-pref', 'open', self.host)
+        self.token = None
+        # HistoricStore recording the generated e-numbers, if any
+        self.store = None
+        # callables receiving an event dict for each http step, see http_event
+        self.hooks = []
+        # ecard_har.FixtureRecorder writing each exchange, if any
+        self.recorder = None
+        # ecard_otp provider of the sms codes, the configuration's by default, and the card whose code is awaited
+        self.otp = None
+        self.card = None
+
+        self.auth_3ds_needed = None
+        self.auth_3ds_completed = False
+        self.auth_3ds_md = None
+        self.auth_3ds_pareq = None
+        self.auth_3ds_termurl = None
+
+    def do_login(self, login, password):
+        logger.debug('HEADER LOGIN')
+
+        headers = ECardManager.get_common_headers({})
+        payload = {
+            'request': 'login',
+            'identifiantCrypte': '',
+            'app': '',
+            'identifiant': login,
+            'memorize': 'false',
+            'password': password,
+            'token': '9876543210'
+        }
+        # most logins need 3D Secure: connect to its host during the login request
+        if ecard.prefetch_connections:
+            self.transport.prefetch(self.bank.t3ds_host)
+        response = self._post_form(self.url('login'), headers, payload)
+        login_page = ECardManager.parse_login_page(response.text)
+
+        logger.debug('\n# LoginInfo')
+
+        # get jsessionid
+        self.jsessionid = response.cookies['JSESSIONID']
+        logger.debug('jsessionid: %s', self.jsessionid)
+
+        # get token
+        self.token = login_page['token']
+        logger.debug('token: %s', self.token)
+
+        # check if D secure is needed
+        self.auth_3ds_needed = login_page['auth_3ds_needed']
+        logger.debug('need3dsecure: %s', self.auth_3ds_needed)
+
+        if self.auth_3ds_needed:
+            self.auth_3ds_md = login_page['md']
+            self.auth_3ds_pareq = login_page['pareq']
+            self.auth_3ds_termurl = login_page['termurl']
+
+        return True
+
+    def url(self, step: str) -> str:
+        """The url of an http step, at the bank or at its 3D Secure host."""
+        if step in t3ds_endpoints:
+            return self.bank.t3ds_host + self.bank.endpoints[step]
+        return self.host + self.bank.endpoints[step]
+
+    @contextlib.contextmanager
+    def preconnecting(self):
+        """Connect to the bank in the background while the block runs, e.g. while the credentials are looked up."""
+        if not ecard.prefetch_connections:
+            yield
+            return
+        self.transport.prefetch(self.host)
+        try:
+            yield
+        finally:
+            self.transport.wait_prefetch(self.host)
+
+    def get_session(self) -> dict:
+        return {
+            'jsessionid': self.jsessionid,
+            'token': self.token,
+            'auth_3ds_completed': self.auth_3ds_completed
+        }
+
+    def resume_session(self, session: dict) -> bool:
+        """Restore a session saved by get_session, and probe the bank to check it is still alive."""
+        logger.debug('HEADER resume session')
+        if session['jsessionid'] is None:
+            return False
+        self.jsessionid = session['jsessionid']
+        self.token = session['token']
+        self.auth_3ds_completed = session['auth_3ds_completed']
+        self.auth_3ds_needed = False
+        return self.refresh_token()
+
+    def refresh_token(self) -> bool:
+        """Reload the payment page to get the current token, return False if the session is no longer authenticated."""
+        logger.debug('HEADER refresh token')
+
+        # the payment page only holds the e-number form while the session is authenticated
+        response = self._get(self.url('payer'), ECardManager.get_common_headers({}))
+        token = ECardManager.parse_payer_page(response.text)
+        if token is None:
+            logger.debug('session expired')
+            return False
+
+        self.token = token
+        logger.debug('token: %s', self.token)
+        return True
+
+    @property
+    def jsessionid(self):
+        return self.transport.get_cookie('JSESSIONID', self.host)
+
+    @jsessionid.setter
+    def jsessionid(self, value):
+        self.transport.set_cookie('JSESSIONID', value, self.host)
+
+    def auth_3ds(self):
+        print('3D Secure authentication required. Loading...')
+
+        # 1.1 PaRequest...
+        url = self.url('paRequest')
+        headers = ECardManager.get_common_headers({})
+        payload = {
+            'MD': self.auth_3ds_md,
+            'PaReq': self.auth_3ds_pareq,
+            'TermUrl': self.url('receive3ds')
+        }
+        response = self._post_form(url, headers, payload, allow_redirects=False)
+        redirect_url = response.headers['Location']
+        logger.debug('##### redirect url\n%s', redirect_url)
+
+        index = redirect_url.rfind('/')
+        auth_3ds_id = redirect_url[index + 1:]
+        logger.debug('##### auth 3ds id\n%s', auth_3ds_id)
+
+        # 1.2 ...do the redirection
+        headers = ECardManager.get_common_headers({})
+        self._get(redirect_url, headers)
+
+        # 2. get session
+        url = self.url('getSession') + auth_3ds_id
+        headers = ECardManager.get_common_headers({})
+        payload = {
+            'inIframe': False,
+            'parentUrl': None
+        }
+        response = self._post_json(url, headers, payload)
+        account_id = json.loads(response.text)['accountId']
+        transaction_id = json.loads(response.text)['hubSessionId']
+        logger.debug('##### account id\n%s', account_id)
+
+        # 3. start authentication
+        url = self.url('startAuthent')
+        payload = {
+            'accountId': account_id,
+            'language': 'fr',
+            'region': 'FR',
+            'hubAuthenticationInput': {
+                'transactionContext': {}
+            }
+        }
+        response = self._post_json(url, headers, payload)
+
+        # Check authentication type: OTP_SMS or MOBILE_APP
+        means_to_use = json.loads(response.text)['meansToUse']
+        if means_to_use == 'OTP_SMS':
+            self.auth_by_otp_sms(headers, account_id)
+        elif means_to_use == 'MOBILE_APP':
+            auth_id = json.loads(response.text)['hubAuthenticationOutput']['id']
+            self.auth_by_mobile_app(headers, account_id, transaction_id, auth_id)
+        else:
+            print('Unknown authentication mode: ' + means_to_use)
+            return
+        self.auth_end(headers, account_id)
+
+    def auth_by_otp_sms(self, headers, account_id):
+        # 4.1 wait for the OTP_SMS code, up to otp_timeout
+        print('Authentication by SMS')
+        otp_code = self.otp_provider().wait(self.card)
+
+        # 4.2 update authentication with OTP code
+        url = self.url('updateAuthent')
+        payload = {
+            'accountId': account_id,
+            'language': 'fr',
+            'step': 'otp_validating_3',
+            'skipCurrentHubCall': False,
+            'hubAuthenticationInput': {
+                'otp': otp_code,
+                'merchantWhitelistedByUser': False
+            }
+        }
+        response = self._post_json(url, headers, payload)
+        ECardManager.check_otp_authentication(json.loads(response.text)['hubAuthenticationOutput'])
+
+    def otp_provider(self):
+        if self.otp is None:
+            import ecard_otp
+            self.otp = ecard_otp.get_provider()
+        return self.otp
+
+    def auth_by_mobile_app(self, headers, account_id, transaction_id, auth_id):
+        # 4.1 polling for success
+        print('Authentication by mobile')
+        print('Waiting for auth...')
+
+        url = self.url('startPolling')
+        payload = {
+            'accountId': account_id,
+            'hubAuthenticationInput': {
+                'authenticationId': auth_id,
+                'transactionId': transaction_id
+            }
+        }
+        for delay in self.polling.delays():
+            self.polling.wait(delay)
+            response = self._post_json(url, headers, payload)
+            if ECardManager.check_mobile_app_authentication(json.loads(response.text)['hubAuthenticationOutput']):
+                print('Authentication succeeded')
+                return
+
+        raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nAuthentication time out.')
+
+    def auth_end(self, headers, account_id):
+        # the bank's keep-alive connection of the login has likely been closed while authenticating: open the one of
+        # receive3ds during the last two 3D Secure requests
+        if ecard.prefetch_connections:
+            self.transport.prefetch(self.host)
+
+        # 5. end authentication
+        url = self.url('endAuthent')
+        payload = {
+            'accountId': account_id,
+            'hubAuthenticationInput': {}
+        }
+        self._post_json(url, headers, payload)
+
+        # 6 get paResponse
+        url = self.url('paRequestFromAuthPages')
+        headers = ECardManager.get_common_headers({
+            'Upgrade-Insecure-Requests': '1'
+        })
+        payload = {
+            'accountId': account_id,
+        }
+        response = self._post_form(url, headers, payload)
+        md, pares = ECardManager.parse_pa_response_page(response.text)
+        logger.debug('##### md\n%s', md)
+
+        # finally, send the PaRes code to the bank
+        url = self.url('receive3ds')
+        headers = ECardManager.get_common_headers({
+            'Upgrade-Insecure-Requests': '1'
+        })
+        payload = {
+            'MD': md,
+            'PaRes': pares
+        }
+        response = self._post_form(url, headers, payload)
+        ECardManager.parse_page(response.text)
+        self.auth_3ds_completed = True
+
+    def generate_ecard(self, amount: str, currency: str, validity: str) -> ECard:
+        logger.debug('HEADER generate ecard')
+
+        headers = ECardManager.get_common_headers({})
+        payload = {
+            'request': 'ocode',
+            'token': self.token,
+            'montant': amount,
+            'devise': currency,
+            'dateValidite': validity
+        }
+
+        response = self._post_form(self.url('cpn'), headers, payload)
+        e_card, token = ECardManager.parse_ecard_page(response.text)
+
+        # keep the token of the result page for the next call
+        if token is not None:
+            self.token = token
+        if self.store is not None:
+            self.store.add_ecard(e_card, amount)
+        return e_card
+
+    def list_historic(self):
+        return ECardManager.historic_table(self.list_historic_entries())
+
+    def list_historic_entries(self, since: date = None, limit: int = None) -> list:
+        return list(self.iter_historic(since, limit))
+
+    def iter_historic(self, since: date = None, limit: int = None):
+        """Yield the HistoricEntry rows of the historic page while it is parsed."""
+        logger.debug('HEADER historic')
+
+        headers = ECardManager.get_common_headers({})
+        payload = {
+            'token': self.token,
+        }
+
+        response = self._post_form(self.url('historic'), headers, payload)
+        yield from ECardManager.iter_historic_entries(ECardManager.chunks(response.text), since, limit)
+
+    def do_logout(self):
+        logger.debug('HEADER logout')
+        headers = ECardManager.get_common_headers({})
+        self._get(self.url('logout'), headers=headers)
+
+    def _post_form(self, url: str, headers: dict, payload: dict, allow_redirects=True) -> Response:
+        headers.update({'Content-Type': 'application/x-www-form-urlencoded'})
+        return self._post(url, headers, urllib.parse.urlencode(payload), allow_redirects)
+
+    def _post_json(self, url: str, headers: dict, payload: dict, allow_redirects=True) -> Response:
+        headers.update({'Content-Type': 'application/json'})
+        return self._post(url, headers, json.dumps(payload), allow_redirects)
+
+    def _post(self, url: str, headers: dict, payload: str, allow_redirects=True) -> Response:
+        if not self.hooks:
+            response = self.transport.post(url, headers, payload, allow_redirects)
+        else:
+            response = self._traced('POST', url, payload, self.transport.post, url, headers, payload, allow_redirects)
+        if self.recorder is not None:
+            self.recorder.record(response)
+        ECardManager._process_response(response)
+        return response
+
+    def _get(self, url: str, headers: dict, allow_redirects=True) -> Response:
+        if not self.hooks:
+            response = self.transport.get(url, headers, allow_redirects)
+        else:
+            response = self._traced('GET', url, None, self.transport.get, url, headers, allow_redirects)
+        if self.recorder is not None:
+            self.recorder.record(response)
+        ECardManager._process_response(response)
+        return response
+
+    def _traced(self, method: str, url: str, payload, send, *args) -> Response:
+        """Send the request, and emit its event to the hooks, even if it failed."""
+        connection_timings.reset()
+        timestamp = time.time()
+        start = time.perf_counter()
+        response = None
+        error = None
+        try:
+            response = send(*args)
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            event = ECardManager.http_event(method, url, payload, response, timestamp, time.perf_counter() - start,
+                                            error, connection_timings)
+            for hook in self.hooks:
+                hook(event)
+
+    @staticmethod
+    def http_event(method: str, url: str, payload, response, timestamp: float, total: float, error=None,
+                   timings: ConnectionTimings = None) -> dict:
+        """Build the event of an http step. Durations are in seconds; connect includes the name resolution, and
+        connect and tls are 0 when a pooled connection was reused, None without timings (asyncio client)."""
+        event = {
+            'step': http_step(url),
+            'method': method,
+            'url': url,
+            'status': response.status_code if response is not None else None,
+            'timestamp': timestamp,
+            'total': total,
+            'connect': None,
+            'tls': None,
+            'ttfb': None,
+            'connections': None,
+            'request_bytes': len(payload.encode('utf-8')) if payload else 0,
+            'response_bytes': len(response.content) if response is not None else 0,
+            'error': str(error).strip() if error is not None else None
+        }
+        if timings is not None:
+            event.update({'connect': timings.connect, 'tls': timings.tls, 'connections': timings.connections})
+            if response is not None:
+                # requests' elapsed is measured up to the first response's headers, connection included
+                first = response.history[0] if response.history else response
+                event['ttfb'] = max(0.0, first.elapsed.total_seconds() - timings.connect - timings.tls)
+        return event
+
+    @staticmethod
+    def _process_response(response: Response):
+        if http_logger.isEnabledFor(logging.DEBUG):
+            # a line on the console, the whole exchange for the HAR capture, if any
+            http_logger.debug('%s %s %s', response.request.method, response.url, response.status_code,
+                              extra={'exchange': response})
+
+        if response.status_code >= 400:
+            raise Exception(
+                '\n\033[91m/!\\ ERROR /!\\\033[0m\nSomething went wrong when calling ' + str(response.url) + '.\n'
+                + str(response))
+
+    @staticmethod
+    def get_common_headers(extra_headers: dict) -> dict:
+        headers = {
+            'User-Agent': 'ecartebleue-python/' + ecard.__version__,
+            'Accept': '*/*'
+        }
+        headers.update(extra_headers)
+        return headers
+
+    # Page parsers, shared with AsyncECardManager
+    parse_page = staticmethod(ecard_pages.parse_page)
+    parse_login_page = staticmethod(ecard_pages.parse_login_page)
+    parse_payer_page = staticmethod(ecard_pages.parse_payer_page)
+    parse_pa_response_page = staticmethod(ecard_pages.parse_pa_response_page)
+    parse_ecard_page = staticmethod(ecard_pages.parse_ecard_page)
+    parse_historic_page = staticmethod(ecard_pages.parse_historic_page)
+    parse_historic_entries = staticmethod(ecard_pages.parse_historic_entries)
+    iter_historic_entries = staticmethod(ecard_pages.iter_historic_entries)
+    chunks = staticmethod(ecard_pages.chunks)
+    historic_table = staticmethod(ecard_pages.historic_table)
+    check_error = staticmethod(ecard_pages.check_error)
+
+    @staticmethod
+    def check_otp_authentication(hub_output: dict) -> None:
+        if hub_output['authenticationSuccess'] is False:
+            raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nWrong authentication code.')
+
+    @staticmethod
+    def check_mobile_app_authentication(hub_output: dict) -> bool:
+        """Return True once the authentication succeeded, False while still waiting for it."""
+        if hub_output['authenticationSuccess']:
+            return True
+
+        if hub_output['authenticationCanceled']:
+            raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nAuthentication canceled.')
+        if hub_output['authenticationBlocked']:
+            raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nAuthentication blocked.')
+        if hub_output['authenticationFailed']:
+            raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nAuthentication failed.')
+        if hub_output['authenticationTimeOut']:
+            raise Exception('\n\033[91m/!\\ AUTHENTICATION ERROR /!\\\033[0m\nAuthentication time out.')
+        return False
+
+
+class SessionCache:
+    """Encrypted on-disk cache of authenticated sessions, one file per card, expiring after ttl seconds."""
+
+    iterations = 100000
+
+    def __init__(self, directory: str = None, ttl: int = None):
+        if Fernet is None:
+            raise Exception('Session cache needs the cryptography library: pip3 install cryptography')
+        self.directory = directory or ecard.session_cache_dir
+        self.ttl = ecard.session_cache_ttl if ttl is None else ttl
+
+    def path(self, card: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(card.encode('utf-8')).hexdigest() + '.session')
+
+    def load(self, card: str, password: str):
+        try:
+            with open(self.path(card)) as cache_file:
+                data = json.load(cache_file)
+            fernet = SessionCache.fernet(password, base64.b64decode(data['salt']))
+            return json.loads(fernet.decrypt(data['session'].encode('ascii'), ttl=self.ttl))
+        except (OSError, ValueError, KeyError, InvalidToken):
+            # missing, corrupted, expired or encrypted with another password
+            return None
+
+    def save(self, card: str, password: str, session: dict) -> None:
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        salt = os.urandom(16)
+        data = {
+            'salt': base64.b64encode(salt).decode('ascii'),
+            'session': SessionCache.fernet(password, salt).encrypt(json.dumps(session).encode('utf-8')).decode('ascii')
+        }
+        path = self.path(card)
+        with open(os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_file:
+            json.dump(data, cache_file)
+        os.replace(path + '.tmp', path)
+
+    def delete(self, card: str) -> None:
+        try:
+            os.remove(self.path(card))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def fernet(password: str, salt: bytes):
+        key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, SessionCache.iterations)
+        return Fernet(base64.urlsafe_b64encode(key))
+
+
+class SessionPool:
+    """Authenticated sessions of a card, handed out to callers without waiting for a login.
+
+    connect() returns a logged in ECardManager, 3D Secure authenticated if needed, and the pool holds up to size of
+    them. Idle sessions are kept in a deque, the most recently used handed out first; a background thread pings those
+    idle for keepalive_interval seconds by reloading the payment page, and evicts the expired ones. Once warm_up has
+    been called, it also logs in again to keep size sessions.
+    """
+
+    def __init__(self, connect, size: int = None, keepalive_interval: float = None):
+        self.connect = connect
+        self.size = size or ecard.session_pool_size
+        self.keepalive_interval = ecard.session_keepalive_interval if keepalive_interval is None \
+            else keepalive_interval
+        # (last use, session) of the idle sessions, the least recently used at the left
+        self.idle = collections.deque()
+        # idle and handed out sessions, and logins in progress
+        self.sessions = 0
+        self.warm = False
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+
+        self.hits = 0
+        self.misses = 0
+        self.logins = 0
+        self.login_time = 0.0
+        self.keepalives = 0
+        self.evictions = 0
+
+        self.keeper = threading.Thread(target=self.keep_alive, daemon=True)
+        self.keeper.start()
+
+    def acquire(self, timeout: float = None) -> ECardManager:
+        """Hand out an idle session, or log in a new one if the pool isn't full, or wait for one to be released."""
+        with self.condition:
+            if self.idle:
+                self.hits += 1
+                return self.idle.pop()[1]
+            self.misses += 1
+            if not self.condition.wait_for(lambda: self.idle or self.sessions < self.size, timeout):
+                raise Exception('No session of the pool available after ' + str(timeout) + ' s')
+            if self.idle:
+                return self.idle.pop()[1]
+            self.sessions += 1
+        return self.open()
+
+    def release(self, e_card_manager: ECardManager) -> None:
+        with self.condition:
+            if not self.stopped.is_set():
+                self.idle.append((time.monotonic(), e_card_manager))
+                self.condition.notify()
+                return
+            self.sessions -= 1
+        SessionPool.close_session(e_card_manager)
+
+    def evict(self, e_card_manager: ECardManager) -> None:
+        with self.condition:
+            self.sessions -= 1
+            self.evictions += 1
+            self.condition.notify()
+        e_card_manager.transport.close()
+
+    def run(self, function):
+        """Return function(e_card_manager) on a session of the pool, on a new one if the session was found expired."""
+        for attempt in range(2):
+            e_card_manager = self.acquire()
+            try:
+                result = function(e_card_manager)
+            except Exception:
+                if SessionPool.ping(e_card_manager):
+                    # the session is alive, the call itself failed
+                    self.release(e_card_manager)
+                    raise
+                self.evict(e_card_manager)
+                if attempt:
+                    raise
+                logger.info('session expired, login again')
+                continue
+            self.release(e_card_manager)
+            return result
+
+    def warm_up(self) -> None:
+        """Log in until the pool holds size sessions, and keep it so."""
+        self.warm = True
+        while True:
+            with self.condition:
+                if self.sessions >= self.size or self.stopped.is_set():
+                    return
+                self.sessions += 1
+            self.release(self.open())
+
+    def open(self) -> ECardManager:
+        # the session is already counted in self.sessions
+        start = time.perf_counter()
+        try:
+            e_card_manager = self.connect()
+        except Exception:
+            with self.condition:
+                self.sessions -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.logins += 1
+            self.login_time += time.perf_counter() - start
+        return e_card_manager
+
+    def keep_alive(self) -> None:
+        while not self.stopped.wait(self.keepalive_interval / 4 or 1):
+            try:
+                self.ping_idle()
+                if self.warm:
+                    self.warm_up()
+            except Exception as e:
+                logger.debug('session pool keepalive failed: %s', e)
+
+    def ping_idle(self) -> None:
+        """Ping the sessions idle for keepalive_interval seconds, and evict the expired ones."""
+        # the pinged sessions are released as used now, after the deadline
+        deadline = time.monotonic() - self.keepalive_interval
+        while True:
+            with self.condition:
+                if not self.idle or self.idle[0][0] > deadline:
+                    return
+                e_card_manager = self.idle.popleft()[1]
+            if SessionPool.ping(e_card_manager):
+                with self.condition:
+                    self.keepalives += 1
+                self.release(e_card_manager)
+            else:
+                self.evict(e_card_manager)
+
+    def stats(self) -> dict:
+        with self.condition:
+            acquired = self.hits + self.misses
+            return {
+                'size': self.size,
+                'sessions': self.sessions,
+                'idle': len(self.idle),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / acquired, 3) if acquired else None,
+                'logins': self.logins,
+                'warm_up': round(self.login_time / self.logins, 3) if self.logins else None,
+                'keepalives': self.keepalives,
+                'evictions': self.evictions
+            }
+
+    def close(self) -> None:
+        """Stop the keepalive, and log out the idle sessions; the handed out ones are logged out once released."""
+        self.stopped.set()
+        with self.condition:
+            idle = [e_card_manager for _, e_card_manager in self.idle]
+            self.idle.clear()
+            self.sessions -= len(idle)
+        for e_card_manager in idle:
+            SessionPool.close_session(e_card_manager)
+
+    @staticmethod
+    def ping(e_card_manager: ECardManager) -> bool:
+        try:
+            return e_card_manager.refresh_token()
+        except Exception as e:
+            logger.debug('session ping failed: %s', e)
+            return False
+
+    @staticmethod
+    def close_session(e_card_manager: ECardManager) -> None:
+        try:
+            e_card_manager.do_logout()
+        except Exception as e:
+            logger.debug('logout failed: %s', e)
+        finally:
+            e_card_manager.transport.close()
+
+
+class HistoricStore:
+    """Local SQLite copy of a card's historic, to query it without logging in.
+
+    Dates are stored as yyyy-mm-dd and amounts in cents, so filters and sorting run in SQLite. A used e-number's row
+    doesn't change anymore and is inserted once; unused rows no longer on the page are removed at each sync.
+    """
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS historic ('
+        ' card TEXT NOT NULL, key TEXT NOT NULL, date TEXT NOT NULL, merchant TEXT, number TEXT NOT NULL,'
+        ' ceiling INTEGER NOT NULL, amount INTEGER, used INTEGER NOT NULL, UNIQUE (card, key))',
+        'CREATE INDEX IF NOT EXISTS historic_date ON historic (card, date)',
+        'CREATE INDEX IF NOT EXISTS historic_merchant ON historic (card, merchant)',
+        'CREATE INDEX IF NOT EXISTS historic_number ON historic (card, number)',
+    ]
+
+    def __init__(self, card: str, path: str = None):
+        self.card = card
+        self.path = path or ecard.historic_store_path
+        if self.path != ':memory:':
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        # the daemon uses a card's store from its request threads, one at a time
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            for statement in HistoricStore.schema:
+                self.connection.execute(statement)
+
+    def sync(self, entries: list) -> int:
+        """Store the entries of the historic page, and return the number of rows that weren't stored yet."""
+        rows = []
+        occurrences = {}
+        for entry in entries:
+            row = HistoricStore.to_row(entry)
+            # the same e-number can have identical rows, e.g. two purchases of the same amount on the same day
+            identity = (row['date'], row['merchant'], row['number'], row['ceiling'], row['amount'], row['used'])
+            occurrences[identity] = occurrences.get(identity, -1) + 1
+            row['key'] = HistoricStore.key(row, occurrences[identity])
+            rows.append(row)
+
+        unused_keys = {row['key'] for row in rows if not row['used']}
+        with self.connection:
+            stored_unused = self.connection.execute('SELECT key FROM historic WHERE card = ? AND used = 0',
+                                                    (self.card,)).fetchall()
+            self.connection.executemany('DELETE FROM historic WHERE card = ? AND key = ?',
+                                        [(self.card, row['key']) for row in stored_unused
+                                         if row['key'] not in unused_keys])
+            changes = self.connection.total_changes
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO historic (card, key, date, merchant, number, ceiling, amount, used)'
+                ' VALUES (:card, :key, :date, :merchant, :number, :ceiling, :amount, :used)',
+                [dict(row, card=self.card) for row in rows])
+            return self.connection.total_changes - changes
+
+    def add_ecard(self, e_card: ECard, amount: str, day: date = None) -> None:
+        """Record a new e-number as an unused row, as the historic page will show it."""
+        row = {'date': (day or date.today()).isoformat(), 'merchant': None, 'number': e_card.number,
+               'ceiling': HistoricStore.cents(amount), 'amount': None, 'used': False}
+        row['key'] = HistoricStore.key(row, 0)
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO historic (card, key, date, merchant, number, ceiling, amount, used)'
+                ' VALUES (:card, :key, :date, :merchant, :number, :ceiling, :amount, :used)',
+                dict(row, card=self.card))
+
+    def query(self, start: date = None, end: date = None, merchant: str = None, min_amount: int = None,
+              max_amount: int = None, used: bool = None) -> list:
+        """Return the matching rows, most recent first. Amounts are in cents, and are the transaction's amount for a
+        used e-number, its ceiling otherwise."""
+        sql = 'SELECT date, merchant, number, ceiling, amount, used FROM historic WHERE card = ?'
+        params = [self.card]
+        if start is not None:
+            sql += ' AND date >= ?'
+            params.append(start.isoformat())
+        if end is not None:
+            sql += ' AND date <= ?'
+            params.append(end.isoformat())
+        if merchant is not None:
+            sql += ' AND merchant LIKE ?'
+            params.append('%' + merchant + '%')
+        if min_amount is not None:
+            sql += ' AND COALESCE(amount, ceiling) >= ?'
+            params.append(min_amount)
+        if max_amount is not None:
+            sql += ' AND COALESCE(amount, ceiling) <= ?'
+            params.append(max_amount)
+        if used is not None:
+            sql += ' AND used = ?'
+            params.append(used)
+        sql += ' ORDER BY date DESC, number DESC'
+        return [dict(row) for row in self.connection.execute(sql, params)]
+
+    def batch(self, start: date = None, end: date = None, all_cards: bool = False) -> HistoricBatch:
+        """The stored rows of the card, or of all the cards, as a HistoricBatch for aggregations."""
+        sql = 'SELECT card, date, merchant, ceiling, amount, used FROM historic WHERE 1'
+        params = []
+        if not all_cards:
+            sql += ' AND card = ?'
+            params.append(self.card)
+        if start is not None:
+            sql += ' AND date >= ?'
+            params.append(start.isoformat())
+        if end is not None:
+            sql += ' AND date <= ?'
+            params.append(end.isoformat())
+        batch = HistoricBatch()
+        # plain tuples, faster than sqlite3.Row for many rows
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        for card, day, merchant, ceiling, amount, used in cursor.execute(sql, params):
+            batch.add(date.fromisoformat(day), merchant, ceiling, amount or 0, bool(used), card)
+        return batch
+
+    def close(self) -> None:
+        self.connection.close()
+
+    @staticmethod
+    def key(row: dict, occurrence: int) -> str:
+        return '|'.join(str(row[name]) for name in ['date', 'merchant', 'number', 'ceiling', 'amount', 'used']) \
+            + '|' + str(occurrence)
+
+    @staticmethod
+    def to_row(entry: HistoricEntry) -> dict:
+        """Convert an entry of the historic page to a row of the store."""
+        return {
+            'date': entry.date.isoformat(),
+            'merchant': entry.merchant,
+            'number': entry.number.replace(' ', ''),
+            'ceiling': int(entry.ceiling * 100),
+            'amount': None if entry.amount is None else int(entry.amount * 100),
+            'used': entry.used
+        }
+
+    @staticmethod
+    def to_entry(row: dict) -> HistoricEntry:
+        """Convert a row of the store back to an entry, as shown by the historic page."""
+        return HistoricEntry(
+            date.fromisoformat(row['date']),
+            row['merchant'],
+            ' '.join(row['number'][i:i + 4] for i in range(0, len(row['number']), 4)),
+            Decimal(row['ceiling']).scaleb(-2),
+            None if row['amount'] is None else Decimal(row['amount']).scaleb(-2),
+            bool(row['used'])
+        )
+
+    @staticmethod
+    def cents(value: str) -> int:
+        """'1012,00 €' or '1012.00' to 101200."""
+        value = value.replace('€', '').replace('\xa0', '').replace(' ', '').replace(',', '.')
+        return int(Decimal(value) * 100)
+
+
+def parse_batch_line(line: str, default_validity: str) -> tuple:
+    """Parse a batch line, either csv (amount,currency,validity) or json ({"amount": ..., ...})."""
+    if line.startswith('{'):
+        item = json.loads(line)
+    else:
+        item = dict(zip(['amount', 'currency', 'validity'], next(csv.reader([line]))))
+
+    amount = ecard.amount_type(str(item['amount']).strip())
+    currency = str(item.get('currency') or ecard.euro).strip()
+    validity = str(item.get('validity') or default_validity).strip()
+    if validity not in ecard.expire_in:
+        raise ValueError('validity must be one of ' + ', '.join(ecard.expire_in))
+    return amount, currency, validity
+
+
+def generate_batch(e_card_manager: ECardManager, lines, default_validity: str):
+    """Generate an e-number for each line of the batch, yielding one result dict per line.
+
+    A failing line doesn't stop the batch: its error is reported in the result, and the token is reloaded before the
+    next line, in case the failure left it outdated.
+    """
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        # skip empty lines and csv header
+        if not line or line.startswith('amount'):
+            continue
+
+        result = {'line': line_number}
+        try:
+            amount, currency, validity = parse_batch_line(line, default_validity)
+            result.update({'amount': amount, 'currency': currency, 'validity': validity})
+        except (ValueError, KeyError, argparse.ArgumentTypeError) as e:
+            result['error'] = 'invalid line: ' + str(e)
+            yield result
+            continue
+
+        try:
+            e_card = e_card_manager.generate_ecard(amount, currency, validity)
+            result.update(e_card.as_dict())
+        except Exception as e:
+            result['error'] = str(e).strip()
+            if not e_card_manager.refresh_token():
+                raise Exception('Session expired, batch stopped at line ' + str(line_number) + '.')
+        yield result
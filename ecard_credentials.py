@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+
+import argparse
+import base64
+import getpass
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+try:
+    import keyring
+except ImportError:
+    keyring = None
+
+import ecard
+
+
+class CredentialProvider:
+    """Source of the login and password of a card."""
+
+    def get(self, card: str) -> tuple:
+        """Return (login, password) of the card."""
+        raise NotImplementedError
+
+
+class GopassProvider(CredentialProvider):
+    """Credentials stored in gopass, at the locations of the configuration.
+
+    The login is read from the login_gopass_field of the password's entry, so a single gopass call returns both, or
+    from login_gopass_location by a second call if the entry has no such field.
+    """
+
+    def __init__(self, login_location: str = None, password_location: str = None, login_field: str = None):
+        self.login_location = login_location or ecard.login_gopass_location
+        self.password_location = password_location or ecard.password_gopass_location
+        self.login_field = login_field or ecard.login_gopass_field
+
+    def get(self, card: str) -> tuple:
+        password, fields = GopassProvider.show(self.password_location.format(card=card))
+        login = fields.get(self.login_field)
+        if login is None:
+            login = GopassProvider.show(self.login_location.format(card=card))[0]
+        return login, password
+
+    @staticmethod
+    def show(key: str) -> tuple:
+        """Return the first line of a gopass entry, and the "name: value" fields of the following lines."""
+        process = subprocess.run(['gopass', 'show', '-f', key], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise Exception(process.stderr.decode('utf-8').strip())
+        lines = process.stdout.decode('utf-8').split('\n')
+        fields = {}
+        for line in lines[1:]:
+            name, separator, value = line.partition(':')
+            if separator and name.strip():
+                fields.setdefault(name.strip(), value.strip())
+        return lines[0].strip(), fields
+
+
+class EnvProvider(CredentialProvider):
+    """Credentials read from environment variables, ECARD_<CARD>_LOGIN and ECARD_<CARD>_PASSWORD by default."""
+
+    def __init__(self, login_variable: str = 'ECARD_{card}_LOGIN', password_variable: str = 'ECARD_{card}_PASSWORD'):
+        self.login_variable = login_variable
+        self.password_variable = password_variable
+
+    def get(self, card: str) -> tuple:
+        name = re.sub(r'\W', '_', card).upper()
+        return EnvProvider.read(self.login_variable.format(card=name)), \
+            EnvProvider.read(self.password_variable.format(card=name))
+
+    @staticmethod
+    def read(variable: str) -> str:
+        if variable not in os.environ:
+            raise Exception('Environment variable ' + variable + ' is not set.')
+        return os.environ[variable]
+
+
+class KeyringProvider(CredentialProvider):
+    """Credentials stored in the system keyring: the password as the card's name, the login as "<card> user"."""
+
+    def __init__(self, service: str = 'e-cartebleue.com'):
+        if keyring is None:
+            raise Exception('Keyring credentials need the keyring library: pip3 install keyring')
+        self.service = service
+
+    def get(self, card: str) -> tuple:
+        login = keyring.get_password(self.service, card + ' user')
+        password = keyring.get_password(self.service, card)
+        if login is None or password is None:
+            raise Exception('No credentials of ' + card + ' in the keyring, for the service ' + self.service)
+        return login, password
+
+    def save(self, card: str, login: str, password: str) -> None:
+        keyring.set_password(self.service, card + ' user', login)
+        keyring.set_password(self.service, card, password)
+
+
+class EncryptedFileProvider(CredentialProvider):
+    """Credentials of all the cards in a single file, encrypted with a key derived from a passphrase.
+
+    The passphrase is read from the ECARD_CREDENTIALS_PASSPHRASE environment variable, or prompted once. Needs the
+    cryptography library, as the session cache.
+    """
+
+    def __init__(self, path: str = None, passphrase: str = None):
+        self.path = path or ecard.credentials_file_path
+        self.passphrase = passphrase
+
+    def get(self, card: str) -> tuple:
+        credentials = self.load()
+        if card not in credentials:
+            raise Exception('No credentials of ' + card + ' in ' + self.path)
+        return credentials[card]['login'], credentials[card]['password']
+
+    def load(self) -> dict:
+        import ecard_client
+        try:
+            with open(self.path) as credentials_file:
+                data = json.load(credentials_file)
+        except FileNotFoundError:
+            return {}
+        fernet = self.fernet(base64.b64decode(data['salt']))
+        try:
+            return json.loads(fernet.decrypt(data['credentials'].encode('ascii')))
+        except ecard_client.InvalidToken:
+            raise Exception('Wrong passphrase for ' + self.path)
+
+    def save(self, card: str, login: str, password: str) -> None:
+        credentials = self.load()
+        credentials[card] = {'login': login, 'password': password}
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        salt = os.urandom(16)
+        data = {
+            'salt': base64.b64encode(salt).decode('ascii'),
+            'credentials': self.fernet(salt).encrypt(json.dumps(credentials).encode('utf-8')).decode('ascii')
+        }
+        with open(os.open(self.path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as credentials_file:
+            json.dump(data, credentials_file)
+        os.replace(self.path + '.tmp', self.path)
+
+    def fernet(self, salt: bytes):
+        import ecard_client
+        if ecard_client.Fernet is None:
+            raise Exception('Encrypted credentials need the cryptography library: pip3 install cryptography')
+        if self.passphrase is None:
+            self.passphrase = os.environ.get('ECARD_CREDENTIALS_PASSPHRASE') \
+                or getpass.getpass('Passphrase of ' + self.path + ': ')
+        return ecard_client.SessionCache.fernet(self.passphrase, salt)
+
+
+class CachedProvider(CredentialProvider):
+    """In-memory cache of another provider's credentials, for ttl seconds, for the long-running modes."""
+
+    def __init__(self, provider: CredentialProvider, ttl: float = None):
+        self.provider = provider
+        self.ttl = ecard.credentials_cache_ttl if ttl is None else ttl
+        self.credentials = {}
+        # future of the card's lookup in progress, shared by its concurrent misses
+        self.lookups = {}
+        self.lock = threading.Lock()
+
+    def get(self, card: str) -> tuple:
+        # the lock only guards the dicts: the lookups of different cards run concurrently
+        with self.lock:
+            cached = self.credentials.get(card)
+            if cached is not None and time.monotonic() - cached[0] < self.ttl:
+                return cached[1]
+            lookup = self.lookups.get(card)
+            waiting = lookup is not None
+            if not waiting:
+                lookup = self.lookups[card] = Future()
+        if waiting:
+            return lookup.result()
+        try:
+            credentials = self.provider.get(card)
+        except Exception as e:
+            with self.lock:
+                del self.lookups[card]
+            lookup.set_exception(e)
+            raise
+        with self.lock:
+            self.credentials[card] = (time.monotonic(), credentials)
+            del self.lookups[card]
+        lookup.set_result(credentials)
+        return credentials
+
+    def clear(self, card: str = None) -> None:
+        with self.lock:
+            if card is None:
+                self.credentials.clear()
+            else:
+                self.credentials.pop(card, None)
+
+
+providers = {
+    'gopass': GopassProvider,
+    'env': EnvProvider,
+    'keyring': KeyringProvider,
+    'file': EncryptedFileProvider,
+}
+
+
+def get_provider(name: str = None) -> CredentialProvider:
+    """The provider of the configuration, or the named one."""
+    name = name or ecard.credentials_provider
+    if name not in providers:
+        raise Exception('Unknown credentials provider: ' + name + ', expected one of ' + ', '.join(providers))
+    return providers[name]()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='store the credentials of a card, for the keyring and file providers')
+    parser.add_argument('provider', choices=['keyring', 'file'], help='where to store the credentials')
+    parser.add_argument('-c', '--card', default=ecard.default_card, help='card''s name')
+    _args = parser.parse_args()
+
+    try:
+        _login = input('Login of ' + _args.card + ': ')
+        get_provider(_args.provider).save(_args.card, _login, getpass.getpass('Password of ' + _args.card + ': '))
+    except Exception as e:
+        print(e)
+        sys.exit(1)
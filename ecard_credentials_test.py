@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+import os
+import subprocess
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from ecard_credentials import CachedProvider, EncryptedFileProvider, EnvProvider, GopassProvider, get_provider
+
+
+def mocked_gopass(entries):
+    def run(args, stdout=None, stderr=None):
+        key = args[-1]
+        if key not in entries:
+            return subprocess.CompletedProcess(args, 11, b'', ('Entry \'' + key + '\' not found').encode('utf-8'))
+        return subprocess.CompletedProcess(args, 0, entries[key].encode('utf-8'), b'')
+    return run
+
+
+class CredentialsTest(unittest.TestCase):
+
+    def test_gopass_single_call(self):
+
+        # Given
+        entries = {'me/sites/e-cartebleue.com/joint': 'p4ssw0rd\nlogin: 12345678\nurl: https://e-cartebleue.com\n'}
+
+        # When
+        with patch('subprocess.run', side_effect=mocked_gopass(entries)) as mock_run:
+            credentials = GopassProvider().get('joint')
+
+        # Then
+        self.assertEqual(('12345678', 'p4ssw0rd'), credentials)
+        mock_run.assert_called_once()
+        self.assertEqual(['gopass', 'show', '-f', 'me/sites/e-cartebleue.com/joint'], mock_run.call_args[0][0])
+
+    def test_gopass_login_entry(self):
+
+        # Given, the login in its own entry
+        entries = {'me/sites/e-cartebleue.com/joint': 'p4ssw0rd\n', 'me/sites/e-cartebleue.com/joint user': '12345678'}
+
+        # When
+        with patch('subprocess.run', side_effect=mocked_gopass(entries)) as mock_run:
+            credentials = GopassProvider().get('joint')
+            with self.assertRaises(Exception) as context:
+                GopassProvider().get('pro')
+
+        # Then
+        self.assertEqual(('12345678', 'p4ssw0rd'), credentials)
+        self.assertEqual(3, mock_run.call_count)
+        self.assertEqual('Entry \'me/sites/e-cartebleue.com/pro\' not found', str(context.exception))
+
+    @patch.dict(os.environ, {'ECARD_JOINT_LOGIN': 'login', 'ECARD_JOINT_PASSWORD': 'password',
+                             'ECARD_PRO_2_LOGIN': 'login'})
+    def test_env(self):
+        self.assertEqual(('login', 'password'), EnvProvider().get('joint'))
+        with self.assertRaises(Exception) as context:
+            EnvProvider().get('pro-2')
+        self.assertEqual('Environment variable ECARD_PRO_2_PASSWORD is not set.', str(context.exception))
+
+    def test_encrypted_file(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Given
+            path = os.path.join(directory, 'ecartebleue', 'credentials')
+
+            # When
+            EncryptedFileProvider(path, 'passphrase').save('joint', 'login', 'password')
+            EncryptedFileProvider(path, 'passphrase').save('pro', 'pro login', 'pro password')
+
+            # Then
+            self.assertEqual(('login', 'password'), EncryptedFileProvider(path, 'passphrase').get('joint'))
+            self.assertEqual(('pro login', 'pro password'), EncryptedFileProvider(path, 'passphrase').get('pro'))
+            with self.assertRaises(Exception) as context:
+                EncryptedFileProvider(path, 'wrong passphrase').get('joint')
+            self.assertEqual('Wrong passphrase for ' + path, str(context.exception))
+            with open(path) as credentials_file:
+                self.assertNotIn('password', credentials_file.read())
+            self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+
+    def test_cache(self):
+
+        # Given
+        provider = EnvProvider()
+        cached = CachedProvider(provider, ttl=3600)
+
+        # When
+        with patch.object(provider, 'get', return_value=('login', 'password')) as mock_get:
+            credentials = [cached.get('joint'), cached.get('joint'), cached.get('pro')]
+            cached.clear('joint')
+            cached.get('joint')
+            CachedProvider(provider, ttl=0).get('joint')
+
+        # Then
+        self.assertEqual([('login', 'password')] * 3, credentials)
+        self.assertEqual(['joint', 'pro', 'joint', 'joint'], [call[0][0] for call in mock_get.call_args_list])
+
+    def test_cache_concurrent_lookups(self):
+
+        def slow_get(card: str) -> tuple:
+            time.sleep(0.5)
+            return card + '-login', 'password'
+
+        # Given
+        provider = EnvProvider()
+        cached = CachedProvider(provider, ttl=3600)
+        cards = ['joint', 'pro', 'travel', 'online', 'joint', 'pro']
+
+        # When, the lookups of 4 cards, two of them missed twice at once
+        with patch.object(provider, 'get', side_effect=slow_get) as mock_get:
+            start = time.monotonic()
+            with ThreadPoolExecutor(len(cards)) as executor:
+                credentials = list(executor.map(cached.get, cards))
+            elapsed = time.monotonic() - start
+
+        # Then, the cards looked up in parallel, each once
+        self.assertEqual([(card + '-login', 'password') for card in cards], credentials)
+        self.assertEqual(['joint', 'online', 'pro', 'travel'], sorted(call[0][0] for call in mock_get.call_args_list))
+        self.assertLess(elapsed, 1.5)
+
+    def test_unknown_provider(self):
+        with self.assertRaises(Exception) as context:
+            get_provider('vault')
+        self.assertEqual('Unknown credentials provider: vault, expected one of gopass, env, keyring, file',
+                         str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+
+import argparse
+import functools
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+import ecard
+from ecard import TableFormatter, logger
+
+
+def action_generate(e_card_manager, request: dict):
+    amount = ecard.amount_type(str(request.get('amount')))
+    validity = str(request.get('validity') or '3')
+    if validity not in ecard.expire_in:
+        raise Exception('expiration time must be one of ' + ', '.join(ecard.expire_in))
+    return e_card_manager.generate_ecard(amount, request.get('currency') or ecard.euro, validity).as_dict()
+
+
+def action_historic(e_card_manager, request: dict):
+    from ecard_client import background
+    # after the e-numbers waiting for the same hosts
+    with e_card_manager.transport.prioritized(background):
+        return e_card_manager.list_historic()
+
+
+actions = {
+    'generate': action_generate,
+    'historic': action_historic,
+}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """A json request per line, answered by a json line: {"result": ...} or {"error": "..."}."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {'result': self.server.handle_request(json.loads(line))}
+            except Exception as e:
+                response = {'error': str(e).strip()}
+            self.wfile.write((json.dumps(response, ensure_ascii=False) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class ECardDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server generating e-numbers on warm sessions, with a SessionPool per bank and card.
+
+    The pools keep their idle sessions alive, so they don't expire between two requests: a request then costs a single
+    round trip to the bank, instead of the credentials lookup, login, 3D Secure and logout. The sessions of a bank share
+    its BankRegistry connection pool.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str = None, pool_size: int = None, keepalive_interval: float = None, hooks=(),
+                 credentials=None, banks=None):
+        import ecard_credentials
+        from ecard_client import BankRegistry, RequestScheduler
+        self.path = path or ecard.daemon_socket_path
+        # looked up once per card, and again after credentials_cache_ttl
+        self.credentials = credentials or ecard_credentials.CachedProvider(ecard_credentials.get_provider())
+        self.pool_size = pool_size
+        self.keepalive_interval = keepalive_interval
+        self.hooks = list(hooks)
+        self.banks = banks or BankRegistry(scheduler=RequestScheduler())
+        # session pools, by bank and card
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path) or '.', mode=0o700, exist_ok=True)
+        ECardDaemon.remove_stale_socket(self.path)
+        super().__init__(self.path, RequestHandler)
+        os.chmod(self.path, 0o600)
+
+    def pool(self, card: str, bank: str = None):
+        from ecard_client import SessionPool
+        key = (bank or ecard.bank, card)
+        with self.pools_lock:
+            if key not in self.pools:
+                self.pools[key] = SessionPool(functools.partial(self.connect, card, key[0]), self.pool_size,
+                                              self.keepalive_interval)
+            return self.pools[key]
+
+    def connect(self, card: str, bank: str = None):
+        """Log in a new session of the card at its bank, 3D Secure prompts included."""
+        from ecard_client import HistoricStore
+
+        e_card_manager = self.banks.manager(bank, card=card)
+        e_card_manager.hooks.extend(self.hooks)
+        if os.path.exists(ecard.historic_store_path):
+            e_card_manager.store = HistoricStore(card)
+        try:
+            with e_card_manager.preconnecting():
+                login, password = self.credentials.get(card)
+            e_card_manager.do_login(login, password)
+            if e_card_manager.auth_3ds_needed:
+                e_card_manager.auth_3ds()
+        except Exception:
+            e_card_manager.transport.close()
+            raise
+        logger.info('new session of %s at %s ready', card, e_card_manager.bank.name)
+        return e_card_manager
+
+    def handle_request(self, request: dict):
+        action = request.get('action')
+        if action == 'status':
+            with self.pools_lock:
+                return [dict(bank=bank, card=card, **pool.stats()) for (bank, card), pool in self.pools.items()]
+        if action == 'metrics':
+            import ecard_client
+            import ecard_trace
+            with self.pools_lock:
+                metrics = ecard_trace.pool_metrics({key: pool.stats() for key, pool in self.pools.items()})
+            metrics += ecard_trace.breaker_metrics(ecard_client.circuit_breaker.stats())
+            if self.banks.scheduler is not None:
+                metrics += ecard_trace.scheduler_metrics(self.banks.scheduler.stats())
+            return metrics
+        if action == 'stop':
+            # answer before the daemon stops
+            threading.Thread(target=self.shutdown).start()
+            return 'stopping'
+        if action not in actions:
+            raise Exception('Unknown action: ' + str(action))
+        pool = self.pool(request.get('card') or ecard.default_card, request.get('bank'))
+        return pool.run(functools.partial(actions[action], request=request))
+
+    def server_close(self) -> None:
+        super().server_close()
+        with self.pools_lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            pool.close()
+        self.banks.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def remove_stale_socket(path: str) -> None:
+        # the socket of a daemon that didn't stop cleanly
+        if not os.path.exists(path):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(path)
+                return
+        raise Exception('A daemon is already listening on ' + path)
+
+
+def send_request(request: dict, path: str = None):
+    """Send a request to the daemon, and return its result."""
+    path = path or ecard.daemon_socket_path
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            raise Exception('No daemon listening on ' + path + ', start it with: ecard_daemon.py serve')
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with client.makefile('r', encoding='utf-8') as response_file:
+            line = response_file.readline()
+    if not line:
+        raise Exception('The daemon closed the connection without answering')
+    response = json.loads(line)
+    if 'error' in response:
+        raise Exception(response['error'])
+    return response['result']
+
+
+def serve(args) -> None:
+    hooks = []
+    if args.trace:
+        import ecard_trace
+        hooks.append(ecard_trace.JSONLinesSink(open(args.trace, 'a')))
+
+    daemon = ECardDaemon(args.socket, args.pool_size, hooks=hooks)
+    try:
+        # log in the sessions of the cards to warm up now, 3D Secure prompts included
+        for card in args.warm:
+            try:
+                daemon.pool(card, args.bank).warm_up()
+            except Exception as e:
+                logger.error('login failed for %s: %s', card, str(e).strip())
+        logger.info('listening on %s', daemon.path)
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='daemon keeping e-Carte Bleue sessions warm, and its client')
+    parser.add_argument('-S', '--socket', default=ecard.daemon_socket_path,
+                        help='unix socket of the daemon, default is ' + ecard.daemon_socket_path)
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose mode')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', formatter_class=argparse.RawTextHelpFormatter,
+                                       help='run the daemon, until stopped or interrupted')
+    serve_parser.add_argument('-w', '--warm', action='append', default=[], metavar='CARD',
+                              help='card whose POOL_SIZE sessions are logged in at startup and kept so, instead of\n'
+                                   'at its first request (repeatable)')
+    serve_parser.add_argument('-k', '--pool-size', type=int, default=ecard.session_pool_size,
+                              help='authenticated sessions per card, default is ' + str(ecard.session_pool_size))
+    serve_parser.add_argument('-t', '--trace', metavar='FILE', help='append the timings of each http step to FILE')
+    serve_parser.add_argument('-B', '--bank', default=ecard.bank,
+                              help='bank of the cards to warm up, default is ' + ecard.bank)
+
+    generate_parser = commands.add_parser('generate', help="generate an e-number on the daemon's session of the card")
+    generate_parser.add_argument('amount', type=ecard.amount_type, help='amount in euro')
+    generate_parser.add_argument('-c', '--card', default=ecard.default_card, help='card''s name defined in gopass')
+    generate_parser.add_argument('-B', '--bank', default=ecard.bank, help='bank of the card, default is ' + ecard.bank)
+    generate_parser.add_argument('-e', '--expire-in', choices=ecard.expire_in, default='3', metavar='',
+                                 help='expiration time in months, default is 3')
+
+    historic_parser = commands.add_parser('historic', help='list historic of generated e-Carte Bleue')
+    historic_parser.add_argument('-c', '--card', default=ecard.default_card, help='card''s name defined in gopass')
+    historic_parser.add_argument('-B', '--bank', default=ecard.bank, help='bank of the card, default is ' + ecard.bank)
+
+    commands.add_parser('status', help="list the daemon's session pools")
+    commands.add_parser('metrics', help="print the daemon's session pool metrics, in the Prometheus text format")
+    commands.add_parser('stop', help='stop the daemon, logging out its sessions')
+    _args = parser.parse_args()
+
+    ecard.set_verbose(_args.verbose)
+    if _args.command == 'serve':
+        serve(_args)
+        sys.exit(0)
+
+    try:
+        if _args.command == 'generate':
+            from ecard_pages import ECard
+            result = send_request({'action': 'generate', 'card': _args.card, 'bank': _args.bank,
+                                   'amount': _args.amount, 'validity': _args.expire_in}, _args.socket)
+            print('\n' + str(ECard(**result)) + '\n')
+        elif _args.command == 'historic':
+            table_formatter = TableFormatter()
+            table_formatter.set_rows(send_request({'action': 'historic', 'card': _args.card, 'bank': _args.bank},
+                                                  _args.socket))
+            print(table_formatter)
+        elif _args.command == 'status':
+            table_formatter = TableFormatter()
+            table_formatter.set_rows([['BANK', 'CARD', 'SESSIONS', 'IDLE', 'HIT RATE', 'WARM-UP', 'KEEPALIVES',
+                                       'EVICTIONS']] + [
+                [pool['bank'], pool['card'], '%d/%d' % (pool['sessions'], pool['size']), str(pool['idle']),
+                 '─' if pool['hit_rate'] is None else '%.0f %%' % (pool['hit_rate'] * 100),
+                 '─' if pool['warm_up'] is None else '%.1f s' % pool['warm_up'],
+                 str(pool['keepalives']), str(pool['evictions'])]
+                for pool in send_request({'action': 'status'}, _args.socket)])
+            print(table_formatter)
+        elif _args.command == 'metrics':
+            print(send_request({'action': 'metrics'}, _args.socket), end='')
+        else:
+            send_request({'action': 'stop'}, _args.socket)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
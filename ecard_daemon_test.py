@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import ecard
+from ecard_credentials import CachedProvider, EnvProvider
+from ecard_daemon import ECardDaemon, send_request
+from ecard_stub import StubServer, bank_routes, t3ds_routes
+
+
+class ECardDaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        stack = contextlib.ExitStack()
+        self.addCleanup(stack.close)
+        self.bank_server = stack.enter_context(StubServer(bank_routes))
+        self.t3ds_server = stack.enter_context(StubServer(t3ds_routes))
+        directory = stack.enter_context(tempfile.TemporaryDirectory())
+        stack.enter_context(patch.object(ecard, 'service_url', self.bank_server.url + '/fr/'))
+        stack.enter_context(patch.object(ecard, 't3ds_host', self.t3ds_server.url))
+        stack.enter_context(patch.object(ecard, 'historic_store_path', os.path.join(directory, 'historic.db')))
+        stack.enter_context(patch('builtins.input', return_value='12345678'))
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+
+        self.path = os.path.join(directory, 'daemon.sock')
+        self.credentials = EnvProvider()
+        stack.enter_context(patch.dict(os.environ, {'ECARD_JOINT_LOGIN': 'login', 'ECARD_JOINT_PASSWORD': 'password'}))
+        self.daemon = ECardDaemon(self.path, credentials=CachedProvider(self.credentials))
+        thread = threading.Thread(target=self.daemon.serve_forever)
+        thread.start()
+        stack.callback(self.daemon.server_close)
+        stack.callback(thread.join)
+        stack.callback(self.daemon.shutdown)
+
+    def test_generate_on_warm_session(self):
+
+        # When
+        e_cards = [send_request({'action': 'generate', 'card': 'joint', 'amount': '10.54'}, self.path)
+                   for _ in range(3)]
+
+        # Then, a single login and 3D Secure authentication, then a single request per e-number
+        self.assertEqual('1234567890123456', e_cards[0]['number'])
+        self.assertEqual(3, len(e_cards))
+        self.assertEqual(2 + 3, self.bank_server.requests)
+        status = send_request({'action': 'status'}, self.path)
+        self.assertEqual([('joint', 1, 2, 1, 1)],
+                         [(pool['card'], pool['sessions'], pool['hits'], pool['misses'], pool['logins'])
+                          for pool in status])
+        metrics = send_request({'action': 'metrics'}, self.path)
+        self.assertIn('ecard_session_pool_hits_total{bank="caisse-epargne",card="joint"} 2\n', metrics)
+        self.assertIn('ecard_http_requests_total{host="' + self.bank_server.url[len('http://'):] + '"} 5\n', metrics)
+
+    def test_historic(self):
+
+        # When
+        rows = send_request({'action': 'historic', 'card': 'joint'}, self.path)
+
+        # Then
+        self.assertEqual('COMMERCANT', rows[0][1])
+        self.assertEqual(9, len(rows))
+
+    def test_errors(self):
+
+        # When
+        with self.assertRaises(Exception) as unknown_action:
+            send_request({'action': 'delete'}, self.path)
+        with self.assertRaises(Exception) as invalid_validity:
+            send_request({'action': 'generate', 'amount': '10', 'validity': '5'}, self.path)
+
+        # Then
+        self.assertEqual('Unknown action: delete', str(unknown_action.exception))
+        self.assertEqual('expiration time must be one of 3, 6, 9, 12, 15, 18, 21, 24', str(invalid_validity.exception))
+        with self.assertRaises(Exception):
+            ECardDaemon(self.path)
+
+    def test_banks(self):
+
+        with StubServer(t3ds_routes) as sg_t3ds_server, \
+                patch.object(ecard, 'bank_profiles', {'sg': {'t3ds_host': sg_t3ds_server.url}}):
+            # When
+            e_cards = [send_request({'action': 'generate', 'card': 'joint', 'bank': bank, 'amount': '10.54'}, self.path)
+                       for bank in ['caisse-epargne', 'sg', 'caisse-epargne', 'sg']]
+
+            # Then, a warm session per bank, authenticated by the bank's 3D Secure host
+            self.assertEqual(4, len([e_card for e_card in e_cards if e_card['number'] == '1234567890123456']))
+            self.assertEqual([('caisse-epargne', 'joint', 1, 1), ('sg', 'joint', 1, 1)],
+                             sorted((pool['bank'], pool['card'], pool['logins'], pool['hits'])
+                                    for pool in send_request({'action': 'status'}, self.path)))
+            self.assertEqual(7, self.t3ds_server.requests)
+            self.assertEqual(7, sg_t3ds_server.requests)
+
+    def test_keepalive(self):
+
+        # Given
+        send_request({'action': 'generate', 'amount': '10.54'}, self.path)
+        pool = self.daemon.pool(ecard.default_card)
+        requests = self.bank_server.requests
+
+        # When
+        pool.ping_idle()
+        pool.keepalive_interval = 0
+        pool.ping_idle()
+
+        # Then, only the idle session is pinged, by reloading the payment page
+        self.assertEqual(requests + 1, self.bank_server.requests)
+        self.assertEqual(1, pool.stats()['keepalives'])
+        self.assertEqual(1, pool.stats()['idle'])
+
+    def test_no_daemon(self):
+        with self.assertRaises(Exception) as context:
+            send_request({'action': 'status'}, self.path + '.missing')
+        self.assertEqual('No daemon listening on ' + self.path + '.missing, start it with: ecard_daemon.py serve',
+                         str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
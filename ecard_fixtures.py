@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import sys
+from datetime import date, timedelta
+
+import ecard
+from ecard_har import write_entry
+from ecard_stub import mocks_dir
+
+
+def load_fixture(path: str) -> dict:
+    """The HAR entry of a fixture: a mock of mocks/ or a file recorded by --record."""
+    with open(path, encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+
+def write_fixture(path: str, entry: dict) -> None:
+    with open(path, 'w', encoding='utf-8', buffering=ecard.http_record_buffer_size) as fixture:
+        write_entry(fixture, entry, indent=2)
+        fixture.write('\n')
+
+
+def synthetic_historic(rows: int, html: str = None) -> str:
+    """The historic page html, the mocks' by default, with rows used e-numbers, one per day, most recent first."""
+    if html is None:
+        html = load_fixture(os.path.join(mocks_dir, 'historic.json'))['response']['content']['text']
+    pane = html.index('history-panes-used-numbers-print')
+    start = html.index('</thead>', pane) + len('</thead>')
+    end = html.index('</table>', start)
+    row = '<tr><td class="column1">%s</td><td class="column2">SHOP %d</td><td class="column3">%s</td>' \
+          '<td class="column4">%d,%02d &euro;</td><td class="column5">%d,%02d &euro;</td>' \
+          '<td class="column6">Utilisé</td></tr>\n'
+    day = date(2020, 12, 8)
+    lines = []
+    for n in range(rows):
+        number = '1234 5678 %04d %04d' % (n // 10000, n % 10000)
+        lines.append(row % ((day - timedelta(days=n)).strftime('%d/%m/%Y'), n % 100, number,
+                            n % 500, n % 100, n % 500, n % 100))
+    return html[:start] + ''.join(lines) + html[end:]
+
+
+def synthesize_historic(rows: int, source: str = None) -> dict:
+    """The historic fixture source, the mocks' by default, answering a page of rows used e-numbers."""
+    entry = load_fixture(source or os.path.join(mocks_dir, 'historic.json'))
+    response = entry['response']
+    text = synthetic_historic(rows, response['content']['text'])
+    size = len(text.encode('utf-8'))
+    response['content'].update({'text': text, 'size': size})
+    response['bodySize'] = size
+    return entry
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='scaled-up variants of the fixtures, for the parser and end-to-end '
+                                                 'benchmarks, replayable by ecard_stub.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    historic_parser = commands.add_parser('historic', help='historic pages of ROWS used e-numbers, written to '
+                                                           'DIR/historic_ROWS.json')
+    historic_parser.add_argument('rows', type=int, nargs='+', metavar='ROWS', help='rows of each page')
+    historic_parser.add_argument('-s', '--source', metavar='FILE',
+                                 help='historic fixture to scale up, e.g. recorded by ecard.py --record, default is '
+                                      'mocks/historic.json')
+    historic_parser.add_argument('-o', '--output', metavar='DIR', default='.', help='output directory, default is .')
+    _args = parser.parse_args()
+
+    try:
+        os.makedirs(_args.output, exist_ok=True)
+        for _rows in _args.rows:
+            _path = os.path.join(_args.output, 'historic_%d.json' % _rows)
+            write_fixture(_path, synthesize_historic(_rows, _args.source))
+            print(_path)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
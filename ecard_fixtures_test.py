@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+from datetime import date
+
+from ecard_client import ECardManager
+from ecard_fixtures import load_fixture, synthesize_historic, write_fixture
+from ecard_stub import StubServer
+
+
+class FixturesTest(unittest.TestCase):
+
+    def test_synthesize_historic(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Given
+            path = os.path.join(directory, 'historic_2500')
+            write_fixture(path + '.json', synthesize_historic(2500))
+
+            # When
+            with StubServer([('POST', r'/historic$', path)]) as server:
+                e_card_manager = ECardManager(host=server.url + '/fr/caisse-epargne')
+                entries = e_card_manager.list_historic_entries()
+                e_card_manager.transport.close()
+
+            # Then, the used e-numbers of the page, and the unused one of the mocks
+            entry = load_fixture(path + '.json')
+            self.assertEqual(len(entry['response']['content']['text'].encode('utf-8')),
+                             entry['response']['content']['size'])
+            self.assertEqual(2501, len(entries))
+            self.assertEqual(2500, sum(entry.used for entry in entries))
+            used = [entry for entry in entries if entry.used]
+            self.assertEqual((date(2020, 12, 8), 'SHOP 0', '1234 5678 0000 0000'),
+                             (used[0].date, used[0].merchant, used[0].number))
+            self.assertEqual('1234 5678 0000 2499', used[-1].number)
+
+
+if __name__ == '__main__':
+    unittest.main()
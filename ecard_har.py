@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+import ecard
+from ecard_client import http_step
+
+# replaces the secrets of the captured exchanges
+redacted = 'REDACTED'
+# form fields and json keys of the requests
+redacted_fields = ['password', 'PaRes', 'otp']
+redacted_headers = ['authorization', 'proxy-authorization']
+# values of the cookies, their names and attributes are kept for the replay
+redacted_cookie = re.compile(r'(^|;\s*)([^=;\s]+=)[^;]*')
+redacted_set_cookie = re.compile(r'^([^=]+=)[^;]*')
+redacted_form_field = re.compile(r'(^|&)(' + '|'.join(redacted_fields) + r')=[^&]*')
+redacted_json_key = re.compile(r'("(?:' + '|'.join(redacted_fields) + r')"\s*:\s*)"[^"]*"')
+# hidden inputs of the pages, and the cvv of the generated e-number
+redacted_input = re.compile(r'(<input[^>]*name="(?:' + '|'.join(redacted_fields) + r')"[^>]*value=")[^"]*')
+redacted_cvv = re.compile(r'(<dl id="content-cryptogramme".*?<dd>)(.*?)(</dd>)', re.DOTALL)
+span_text = re.compile(r'>[^<]+<')
+# response texts are encoded to json by chunks of this many characters
+text_chunk_size = 64 * 1024
+
+
+def redact_body(text: str) -> str:
+    """The request or response body, without the password, PaRes, otp code and cvv."""
+    if not text:
+        return text
+    if text.startswith('{'):
+        return redacted_json_key.sub(r'\1"' + redacted + '"', text)
+    if '<' not in text:
+        return redacted_form_field.sub(r'\1\2=' + redacted, text)
+    text = redacted_input.sub(r'\1' + redacted, text)
+    if 'content-cryptogramme' not in text:
+        return text
+    return redacted_cvv.sub(lambda match: match.group(1) + span_text.sub('>' + redacted + '<', match.group(2))
+                            + match.group(3), text)
+
+
+def redact_header(name: str, value: str) -> str:
+    lower = name.lower()
+    if lower in redacted_headers:
+        return redacted
+    if lower == 'cookie':
+        return redacted_cookie.sub(r'\1\2' + redacted, value)
+    if lower == 'set-cookie':
+        return redacted_set_cookie.sub(r'\1' + redacted, value)
+    return value
+
+
+def har_headers(headers) -> list:
+    # httpx and urllib3 keep the repeated headers apart, Set-Cookie included
+    items = headers.multi_items() if hasattr(headers, 'multi_items') else headers.items()
+    return [{'name': name, 'value': redact_header(name, value)} for name, value in items]
+
+
+def har_entry(response) -> dict:
+    """The HAR entry of a requests or httpx response and its request, secrets redacted."""
+    request = response.request
+    # requests and httpx don't name the request body and the reason the same way
+    body = request.body if hasattr(request, 'body') else request.content
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    elapsed = response.elapsed.total_seconds() * 1000
+    text = response.text
+    entry = {
+        'startedDateTime': datetime.fromtimestamp(time.time() - elapsed / 1000, timezone.utc).isoformat(),
+        'time': round(elapsed, 3),
+        'request': {
+            'method': request.method,
+            'url': str(request.url),
+            'httpVersion': 'HTTP/1.1',
+            'headers': har_headers(request.headers),
+            'queryString': [],
+            'cookies': [],
+            'headersSize': -1,
+            'bodySize': len(body.encode('utf-8')) if body else 0,
+        },
+        'response': {
+            'status': response.status_code,
+            'statusText': getattr(response, 'reason', None) or getattr(response, 'reason_phrase', ''),
+            'httpVersion': 'HTTP/1.1',
+            # requests joins the repeated headers of the response, not the underlying urllib3 ones
+            'headers': har_headers(getattr(getattr(response, 'raw', None), 'headers', None) or response.headers),
+            'cookies': [{'name': name, 'value': redacted} for name in response.cookies.keys()],
+            'content': {
+                'mimeType': response.headers.get('Content-Type', ''),
+                'size': len(response.content),
+                'text': redact_body(text),
+            },
+            'redirectURL': response.headers.get('Location', ''),
+            'headersSize': -1,
+            'bodySize': len(response.content),
+        },
+        'cache': {},
+        'timings': {'send': 0, 'wait': round(elapsed, 3), 'receive': 0},
+    }
+    if body:
+        entry['request']['postData'] = {'mimeType': request.headers.get('Content-Type', ''),
+                                        'text': redact_body(body)}
+    return entry
+
+
+def write_entry(stream, entry: dict, indent: int = None) -> None:
+    """Write the HAR entry as json, its response text encoded a chunk at a time instead of copied whole.
+
+    json.dumps, unlike json.dump, runs the C encoder: the entry is encoded with an empty response text, which is then
+    written in its place chunk by chunk.
+    """
+    response = entry['response']
+    content = response['content']
+    text = content.get('text') or ''
+    encoded = json.dumps(dict(entry, response=dict(response, content=dict(content, text=''))), indent=indent,
+                         ensure_ascii=False)
+    # the response content, after the request and its post data, has the last text key
+    position = encoded.rindex('"text": ""') + len('"text": "')
+    stream.write(encoded[:position])
+    for start in range(0, len(text), text_chunk_size):
+        stream.write(json.dumps(text[start:start + text_chunk_size], ensure_ascii=False)[1:-1])
+    stream.write(encoded[position:])
+
+
+class HarFileHandler(logging.Handler):
+    """Logging handler writing the exchange of each record to a HAR file, rotated once over max_bytes.
+
+    Records without an exchange (the response in record.exchange) are ignored. Entries are written as they come,
+    and the file is a valid HAR once closed or rotated. The capture of a previous run is rotated when the file is
+    opened; backups older files are kept as path.1, path.2...
+    """
+
+    def __init__(self, path: str, max_bytes: int = None, backups: int = None):
+        super().__init__(logging.DEBUG)
+        self.path = path
+        self.max_bytes = ecard.http_capture_max_bytes if max_bytes is None else max_bytes
+        self.backups = ecard.http_capture_backups if backups is None else backups
+        self.stream = None
+        self.entries = 0
+        self.write_lock = threading.Lock()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        response = getattr(record, 'exchange', None)
+        if response is None:
+            return
+        try:
+            entry = har_entry(response)
+            with self.write_lock:
+                if self.stream is None:
+                    self.open()
+                elif self.stream.tell() >= self.max_bytes:
+                    self.rotate()
+                self.stream.write(',\n' if self.entries else '\n')
+                write_entry(self.stream, entry)
+                self.stream.flush()
+                self.entries += 1
+        except Exception:
+            self.handleError(record)
+
+    def open(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', mode=0o700, exist_ok=True)
+        if os.path.exists(self.path):
+            self.shift_backups()
+        self.stream = open(os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8')
+        self.stream.write('{"log": {"version": "1.2", "creator": {"name": "ecartebleue-python", "version": "'
+                          + ecard.__version__ + '"}, "entries": [')
+        self.entries = 0
+
+    def rotate(self) -> None:
+        self.finish()
+        self.open()
+
+    def shift_backups(self) -> None:
+        """Keep the current file as path.1, path.1 as path.2..., dropping the oldest one."""
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(self.path + '.' + str(number)):
+                os.replace(self.path + '.' + str(number), self.path + '.' + str(number + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+
+    def finish(self) -> None:
+        self.stream.write('\n]}}\n')
+        self.stream.close()
+        self.stream = None
+
+    def close(self) -> None:
+        with self.write_lock:
+            if self.stream is not None:
+                self.finish()
+        super().close()
+
+
+def capture(path: str = None) -> HarFileHandler:
+    """Capture the http exchanges logged at the DEBUG level to a HAR file, the configuration's by default."""
+    http_logger = logging.getLogger('ecard.http')
+    for handler in http_logger.handlers:
+        if isinstance(handler, HarFileHandler):
+            return handler
+    handler = HarFileHandler(path or ecard.http_capture_path)
+    http_logger.addHandler(handler)
+    return handler
+
+
+class FixtureRecorder:
+    """Writes each exchange of the sessions to directory, as a fixture in the format of the mocks replayable by
+    ecard_stub.recorded_routes: a HAR entry per file, named after its rank and http step (001_login.json...), with the
+    secrets redacted.
+
+    Redirects are recorded before their final response. Nothing is kept in memory between two exchanges, and the
+    response texts are written through a buffer of http_record_buffer_size bytes.
+    """
+
+    def __init__(self, directory: str, buffer_size: int = None):
+        self.directory = directory
+        self.buffer_size = buffer_size or ecard.http_record_buffer_size
+        self.exchanges = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def record(self, response) -> None:
+        for exchange in list(response.history) + [response]:
+            entry = har_entry(exchange)
+            with self.lock:
+                self.exchanges += 1
+                name = '%03d_%s.json' % (self.exchanges, http_step(str(exchange.url)) or 'page')
+            path = os.path.join(self.directory, name)
+            with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8',
+                      buffering=self.buffer_size) as fixture:
+                write_entry(fixture, entry, indent=2)
+                fixture.write('\n')
+
+
+def load_entries(path: str) -> list:
+    """The entries of a HAR file, also of a capture still being written."""
+    with open(path, encoding='utf-8') as har_file:
+        text = har_file.read()
+    if not text.rstrip().endswith('}}'):
+        text += '\n]}}'
+    return json.loads(text)['log']['entries']
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+import contextlib
+import io
+import json
+import logging
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import requests
+
+import ecard
+from ecard_client import ECardManager
+from ecard_har import FixtureRecorder, HarFileHandler, load_entries, redact_body
+from ecard_stub import StubServer, bank_routes, load_mock, recorded_routes, t3ds_routes
+
+
+class HarTest(unittest.TestCase):
+
+    def test_redact_body(self):
+        self.assertEqual('request=login&identifiant=login&password=REDACTED&token=123',
+                         redact_body('request=login&identifiant=login&password=p4ssw0rd&token=123'))
+        self.assertEqual('MD=MDRESP1&PaRes=REDACTED', redact_body('MD=MDRESP1&PaRes=PARES123'))
+        self.assertEqual('{"accountId": "1", "hubAuthenticationInput": {"otp": "REDACTED"}}',
+                         redact_body('{"accountId": "1", "hubAuthenticationInput": {"otp": "12345678"}}'))
+        pa_response = redact_body(load_mock('auth_3ds_6_parequestfromauthpages')[2].decode('utf-8'))
+        self.assertIn('name="PaRes" value="REDACTED"', pa_response)
+        self.assertIn('name="MD" value="MDRESP1234567890"', pa_response)
+        e_card = redact_body(load_mock('generate_ecard_success')[2].decode('utf-8'))
+        self.assertIn('<dd><span class="restricted-only">REDACTED</span>'
+                      '<span class="default-only visual-spacing">REDACTED</span></dd>', e_card)
+        self.assertIn('<span>Cryptogramme</span>', e_card)
+
+    def test_capture(self):
+
+        with contextlib.ExitStack() as stack:
+            # Given
+            bank_server = stack.enter_context(StubServer(bank_routes))
+            t3ds_server = stack.enter_context(StubServer(t3ds_routes))
+            directory = stack.enter_context(tempfile.TemporaryDirectory())
+            stack.enter_context(patch.object(ecard, 't3ds_host', t3ds_server.url))
+            stack.enter_context(patch.object(ecard, 'prefetch_connections', False))
+            stack.enter_context(patch('builtins.input', return_value='12345678'))
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            path = os.path.join(directory, 'http.har')
+            handler = HarFileHandler(path, max_bytes=100000, backups=1)
+            http_logger = logging.getLogger('ecard.http')
+            http_logger.addHandler(handler)
+            stack.callback(http_logger.removeHandler, handler)
+            stack.callback(ecard.logger.setLevel, ecard.logger.level)
+            ecard.logger.setLevel(logging.DEBUG)
+            stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+
+            # When
+            e_card_manager = ECardManager(host=bank_server.url + '/fr/caisse-epargne')
+            e_card_manager.do_login('login', 'p4ssw0rd')
+            e_card_manager.auth_3ds()
+            e_card_manager.generate_ecard('10.54', '1.000000', '3')
+            e_card_manager.list_historic()
+            e_card_manager.do_logout()
+            handler.close()
+
+            # Then, the capture was rotated over 100 kB, keeping a single older file
+            entries = load_entries(path + '.1') + load_entries(path)
+            self.assertFalse(os.path.exists(path + '.2'))
+            self.assertLess(len(entries), bank_server.requests + t3ds_server.requests)
+            self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+            self.assertEqual(['GET', '/fr/caisse-epargne/logout', 200],
+                             [entries[-1]['request']['method'], entries[-1]['request']['url'][len(bank_server.url):],
+                              entries[-1]['response']['status']])
+            captured = json.dumps(entries)
+            self.assertNotIn('p4ssw0rd', captured)
+            self.assertNotIn('PARES12345678901234567890', captured)
+            self.assertNotIn('"12345678"', captured)
+            self.assertNotIn('restricted-only\\">123<', captured)
+            self.assertIn('1234567890123456', captured)
+
+    def test_capture_rotated_at_each_run(self):
+
+        with tempfile.TemporaryDirectory() as directory, StubServer(bank_routes) as server:
+            # Given
+            path = os.path.join(directory, 'http.har')
+            urls = [server.url + '/fr/caisse-epargne/payer', server.url + '/fr/caisse-epargne/logout']
+
+            # When, 3 runs capturing an exchange each
+            for url in urls + urls[:1]:
+                handler = HarFileHandler(path, backups=1)
+                handler.emit(logging.makeLogRecord({'exchange': requests.get(url)}))
+                handler.close()
+
+            # Then, the capture of the previous run is kept, the older one is dropped
+            self.assertEqual([urls[0]], [entry['request']['url'] for entry in load_entries(path)])
+            self.assertEqual([urls[1]], [entry['request']['url'] for entry in load_entries(path + '.1')])
+            self.assertFalse(os.path.exists(path + '.2'))
+
+    def test_record_replay(self):
+
+        def run_flow(bank_url: str, t3ds_url: str, recorder=None) -> tuple:
+            with patch.object(ecard, 't3ds_host', t3ds_url):
+                e_card_manager = ECardManager(host=bank_url + '/fr/caisse-epargne')
+                e_card_manager.recorder = recorder
+                e_card_manager.do_login('login', 'p4ssw0rd')
+                e_card_manager.auth_3ds()
+                e_card = e_card_manager.generate_ecard('10.54', '1.000000', '3')
+                historic = e_card_manager.list_historic()
+                e_card_manager.do_logout()
+                e_card_manager.transport.close()
+            return e_card.number, e_card.expired_at, historic
+
+        with contextlib.ExitStack() as stack:
+            # Given, a flow recorded against the stubs
+            directory = stack.enter_context(tempfile.TemporaryDirectory())
+            stack.enter_context(patch.object(ecard, 'prefetch_connections', False))
+            stack.enter_context(patch('builtins.input', return_value='12345678'))
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            with StubServer(bank_routes) as bank_server, StubServer(t3ds_routes) as t3ds_server:
+                recorded = run_flow(bank_server.url, t3ds_server.url, FixtureRecorder(directory, buffer_size=4096))
+                requests = bank_server.requests + t3ds_server.requests
+
+            # When, replayed by stubs serving the fixtures
+            routes = recorded_routes(directory)
+            bank_replay = stack.enter_context(StubServer(routes[bank_server.url]))
+            t3ds_replay = stack.enter_context(StubServer(routes[t3ds_server.url]))
+            replayed = run_flow(bank_replay.url, t3ds_replay.url)
+
+            # Then
+            fixtures = sorted(os.listdir(directory))
+            self.assertEqual(requests, len(fixtures))
+            self.assertEqual(['001_login.json', '002_paRequest.json', '003_authentPage.json'], fixtures[:3])
+            self.assertEqual('012_logout.json', fixtures[-1])
+            self.assertEqual(recorded, replayed)
+            self.assertEqual(requests, bank_replay.requests + t3ds_replay.requests)
+            for fixture in fixtures:
+                self.assertEqual(0o600, os.stat(os.path.join(directory, fixture)).st_mode & 0o777)
+                with open(os.path.join(directory, fixture)) as fixture_file:
+                    text = fixture_file.read()
+                self.assertNotIn('p4ssw0rd', text)
+                self.assertNotIn('1234567890ABCDEF1234567890ABCDEF', text)
+            self.assertEqual(load_mock('historic')[2],
+                             load_mock(os.path.join(directory, fixtures[-2][:-len('.json')]))[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
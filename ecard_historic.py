@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+import argparse
+import sys
+from datetime import datetime
+
+import ecard
+from ecard import TableFormatter
+from ecard_client import ECardManager, HistoricStore
+from ecard_pages import HistoricBatch, HistoricEntry, HistoricStats, format_amount
+
+
+def date_type(x):
+    try:
+        return datetime.strptime(x, '%d/%m/%Y').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('date must be dd/mm/yyyy')
+
+
+def cents_type(x):
+    try:
+        return HistoricStore.cents(x)
+    except ArithmeticError:
+        raise argparse.ArgumentTypeError('invalid amount: ' + x)
+
+
+def action_sync(args, e_card_manager: ECardManager):
+    store = HistoricStore(args.card)
+    inserted = store.sync(e_card_manager.list_historic_entries())
+    print(str(inserted) + ' new rows in the historic of ' + args.card)
+
+
+def query(args):
+    store = HistoricStore(args.card)
+    rows = store.query(args.start, args.end, args.merchant, args.min_amount, args.max_amount, args.used)
+    if args.format != 'table':
+        ecard.write_records((HistoricStore.to_entry(row) for row in rows), HistoricEntry.__slots__, args.format)
+        return
+    table_formatter = TableFormatter()
+    table_formatter.set_rows(ECardManager.historic_table([HistoricStore.to_entry(row) for row in rows]))
+    print(table_formatter)
+
+
+def stats(args):
+    batch = HistoricStore(args.card).batch(args.start, args.end, args.all_cards)
+    groups = batch.stats(args.by)
+    if args.format != 'table':
+        ecard.write_records(groups, HistoricStats.__slots__, args.format)
+        return
+    table_formatter = TableFormatter()
+    table_formatter.set_rows([[args.by.upper(), 'E-NUMBERS', 'USED', 'SPENT', 'UNUSED CEILING']] + [
+        [group.key or '─', str(group.count), str(group.used), format_amount(group.spent),
+         format_amount(group.unused_ceiling)] for group in groups])
+    print(table_formatter)
+
+
+def argument_parser() -> argparse.ArgumentParser:
+    """The command line, whose sync namespace is run by ecard.run like the ones of ecard.py."""
+    parser = argparse.ArgumentParser(description='local historic of the generated e-numbers')
+    parser.add_argument('-c', '--card', default=ecard.default_card, help='card''s name defined in gopass')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose mode')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sync_parser = commands.add_parser('sync', help='login and store the rows of the historic not stored yet')
+    sync_parser.add_argument('-s', '--session-cache', action='store_true', default=False,
+                             help='reuse the session of the previous run, and keep it alive instead of logging out')
+    sync_parser.add_argument('-t', '--trace', metavar='FILE', help='append the timings of each http step to FILE')
+
+    query_parser = commands.add_parser('query', help='list the stored historic, without logging in')
+    query_parser.add_argument('--from', dest='start', type=date_type, help='from this date, dd/mm/yyyy')
+    query_parser.add_argument('--to', dest='end', type=date_type, help='up to this date, dd/mm/yyyy')
+    query_parser.add_argument('-m', '--merchant', help='merchant''s name containing this text')
+    query_parser.add_argument('--min', dest='min_amount', type=cents_type, help='minimum amount in euro')
+    query_parser.add_argument('--max', dest='max_amount', type=cents_type, help='maximum amount in euro')
+    status = query_parser.add_mutually_exclusive_group()
+    status.add_argument('--used', dest='used', action='store_const', const=True, help='used e-numbers only')
+    status.add_argument('--unused', dest='used', action='store_const', const=False, help='unused e-numbers only')
+    query_parser.add_argument('-f', '--format', choices=ecard.output_formats, default='table',
+                              help='output format, default is table')
+
+    stats_parser = commands.add_parser('stats', help='e-numbers, spend and ceilings of the unused e-numbers of the '
+                                                     'stored historic, per merchant, month or card')
+    stats_parser.add_argument('-b', '--by', choices=HistoricBatch.group_keys, default='month',
+                              help='grouping, default is month')
+    stats_parser.add_argument('-a', '--all-cards', action='store_true', default=False,
+                              help='the stored historic of all the cards, instead of --card')
+    stats_parser.add_argument('--from', dest='start', type=date_type, help='from this date, dd/mm/yyyy')
+    stats_parser.add_argument('--to', dest='end', type=date_type, help='up to this date, dd/mm/yyyy')
+    stats_parser.add_argument('-f', '--format', choices=ecard.output_formats, default='table',
+                              help='output format, default is table')
+    return parser
+
+
+if __name__ == '__main__':
+    _args = argument_parser().parse_args()
+
+    if _args.command == 'sync':
+        ecard.run(_args, action_sync)
+    if _args.command == 'stats':
+        stats(_args)
+    else:
+        query(_args)
+    sys.exit(0)
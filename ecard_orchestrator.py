@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ecard
+from ecard import logger
+from ecard_client import BankRegistry, ECardManager, HostLimiter, RequestScheduler, background
+import ecard_credentials
+from ecard_credentials import CachedProvider, CredentialProvider
+
+# accounts run in parallel
+max_workers = 8
+# concurrent requests per host, for all the accounts, to avoid the bank's rate limiting
+max_requests_per_host = 4
+
+
+class CardProfile:
+    """A card to run an action for: its bank, the provider of its credentials and the action parameters.
+
+    credentials is the name of a provider of ecard_credentials (gopass, env, keyring or file), the configured one by
+    default, or a CredentialProvider.
+    """
+
+    def __init__(self, card: str, bank: str = None, credentials=None, action='generate', amount: str = None,
+                 currency: str = None, validity: str = None):
+        self.card = card
+        self.bank = bank or ecard.bank
+        self.credentials = credentials
+        self.action = action
+        self.amount = amount
+        self.currency = currency or ecard.euro
+        self.validity = validity or '3'
+
+        if action not in actions:
+            raise ValueError('unknown action for card ' + card + ': ' + action)
+        if isinstance(credentials, str) and credentials not in ecard_credentials.providers:
+            raise ValueError('unknown credentials provider for card ' + card + ': ' + credentials)
+        if action == 'generate':
+            ecard.amount_type(str(amount))
+
+
+class ProfileCredentials:
+    """The credentials of the profiles, from their providers: the named ones are created once, and cache the
+    credentials of their cards for the run."""
+
+    def __init__(self):
+        self.providers = {}
+        self.lock = threading.Lock()
+
+    def get(self, profile: CardProfile) -> tuple:
+        provider = profile.credentials
+        if not isinstance(provider, CredentialProvider):
+            name = provider or ecard.credentials_provider
+            with self.lock:
+                if name not in self.providers:
+                    self.providers[name] = CachedProvider(ecard_credentials.get_provider(name))
+                provider = self.providers[name]
+        return provider.get(profile.card)
+
+
+def load_profiles(path: str) -> list:
+    """Load the card profiles of a json file, a list of objects with the CardProfile arguments."""
+    with open(path) as json_file:
+        return [CardProfile(**profile) for profile in json.load(json_file)]
+
+
+def action_generate(e_card_manager: ECardManager, profile: CardProfile):
+    return e_card_manager.generate_ecard(profile.amount, profile.currency, profile.validity).as_dict()
+
+
+def action_historic(e_card_manager: ECardManager, profile: CardProfile):
+    # without the header row, after the e-numbers of the other accounts
+    with e_card_manager.transport.prioritized(background):
+        return e_card_manager.list_historic()[1:]
+
+
+actions = {
+    'generate': action_generate,
+    'historic': action_historic,
+}
+
+
+def run_profile(profile: CardProfile, limiter: HostLimiter, banks: BankRegistry,
+                credentials: ProfileCredentials) -> dict:
+    """Login, run the action and logout for a single card. Errors are reported in the result instead of raised."""
+    start = time.perf_counter()
+    result = {'card': profile.card, 'bank': profile.bank, 'action': profile.action}
+    e_card_manager = banks.manager(profile.bank, limiter, card=profile.card)
+    logged_in = False
+    try:
+        e_card_manager.do_login(*credentials.get(profile))
+        logged_in = True
+        if e_card_manager.auth_3ds_needed:
+            e_card_manager.auth_3ds()
+        result['result'] = actions[profile.action](e_card_manager, profile)
+    except Exception as e:
+        result['error'] = str(e).strip()
+    finally:
+        if logged_in:
+            try:
+                e_card_manager.do_logout()
+            except Exception as e:
+                logger.debug('logout failed for %s: %s', profile.card, e)
+        e_card_manager.transport.close()
+    result['elapsed'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def orchestrate(profiles: list, workers: int = None, requests_per_host: int = None,
+                scheduler: RequestScheduler = None) -> dict:
+    """Run every profile on a bounded pool of workers, and aggregate their results in a single report.
+
+    The accounts of a bank share its connections, see BankRegistry, and their requests are paced by the scheduler, the
+    configuration's by default.
+    """
+    limiter = HostLimiter(requests_per_host or max_requests_per_host)
+    banks = BankRegistry(scheduler=scheduler or RequestScheduler())
+    credentials = ProfileCredentials()
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers or max_workers) as executor:
+            results = list(executor.map(lambda profile: run_profile(profile, limiter, banks, credentials), profiles))
+    finally:
+        banks.close()
+    failed = len([result for result in results if 'error' in result])
+    return {
+        'accounts': len(results),
+        'succeeded': len(results) - failed,
+        'failed': failed,
+        'elapsed': round(time.perf_counter() - start, 3),
+        'results': results
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run e-Carte Bleue actions for several cards in parallel')
+    parser.add_argument('profiles', help='json file of card profiles, e.g. [{"card": "joint", "bank": "sg", '
+                                         '"action": "generate", "amount": "12.50"}, '
+                                         '{"card": "pro", "action": "historic"}]')
+    parser.add_argument('-w', '--workers', type=int, default=max_workers,
+                        help='accounts run in parallel, default is ' + str(max_workers))
+    parser.add_argument('-p', '--per-host', type=int, default=max_requests_per_host,
+                        help='concurrent requests per host, default is ' + str(max_requests_per_host))
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose mode')
+    _args = parser.parse_args()
+
+    ecard.set_verbose(_args.verbose)
+    report = orchestrate(load_profiles(_args.profiles), _args.workers, _args.per_host)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    sys.exit(1 if report['failed'] else 0)
@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+
+import contextlib
+import io
+import os
+import subprocess
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import ecard
+from ecard import HostLimiter
+from ecard_client import RequestScheduler, background, interactive
+from ecard_credentials import EnvProvider
+from ecard_orchestrator import CardProfile, orchestrate
+from ecard_stub import StubServer, bank_routes, t3ds_routes
+from ecard_test import mocked_requests_response
+
+
+def mocked_bank(url, headers=None, data=None, allow_redirects=True, timeout=None):
+    if url.endswith('/login'):
+        return mocked_requests_response('login_failed' if 'identifiant=unknown' in data else 'login_success')
+    if url.endswith('/cpn'):
+        return mocked_requests_response('generate_ecard_success')
+    if url.endswith('/historic'):
+        return mocked_requests_response('historic')
+    return mocked_requests_response('logout')
+
+
+# the requests are mocked, don't open connections to the real hosts
+@patch.object(ecard, 'prefetch_connections', False)
+class OrchestratorTest(unittest.TestCase):
+
+    @patch.dict(os.environ, {'ECARD_JOINT_LOGIN': 'login', 'ECARD_JOINT_PASSWORD': 'password',
+                             'ECARD_PRO_LOGIN': 'login', 'ECARD_PRO_PASSWORD': 'password',
+                             'ECARD_OLD_LOGIN': 'unknown', 'ECARD_OLD_PASSWORD': 'password'})
+    @patch('requests.Session.get', side_effect=mocked_bank)
+    @patch('requests.Session.post', side_effect=mocked_bank)
+    def test_orchestrate(self, mock_post, mock_get):
+
+        # Given
+        profiles = [
+            CardProfile('joint', credentials='env', amount='10.54'),
+            CardProfile('pro', bank='sg', credentials='env', action='historic'),
+            CardProfile('old', credentials='env', amount='10.54'),
+            CardProfile('new', credentials='env', amount='10.54')
+        ]
+
+        # When
+        report = orchestrate(profiles, workers=4, requests_per_host=2)
+
+        # Then
+        self.assertEqual(4, report['accounts'])
+        self.assertEqual(2, report['succeeded'])
+        self.assertEqual(2, report['failed'])
+
+        results = report['results']
+        self.assertEqual(['joint', 'pro', 'old', 'new'], [result['card'] for result in results])
+        self.assertEqual('1234567890123456', results[0]['result']['number'])
+        self.assertEqual(8, len(results[1]['result']))
+        self.assertEqual('Votre identification est incorrecte.', results[2]['error'])
+        self.assertEqual('Environment variable ECARD_NEW_LOGIN is not set.', results[3]['error'])
+
+        # each bank has its own url, and only logged in accounts log out
+        login_urls = sorted(call[0][0] for call in mock_post.call_args_list if call[0][0].endswith('/login'))
+        self.assertEqual(['https://service.e-cartebleue.com/fr/caisse-epargne/login'] * 2
+                         + ['https://service.e-cartebleue.com/fr/sg/login'], login_urls)
+        self.assertEqual(2, mock_get.call_count)
+
+    def test_host_limiter(self):
+
+        # Given
+        limiter = HostLimiter(2)
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def request(url):
+            with limiter.semaphore(url):
+                with lock:
+                    running.append(url)
+                    max_running.append(running.count(url))
+                time.sleep(0.01)
+                with lock:
+                    running.remove(url)
+
+        # When
+        threads = [threading.Thread(target=request, args=(url,))
+                   for url in ['https://bank.example/login', 'https://acs.example/paRequest'] * 5]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Then
+        self.assertEqual(2, max(max_running))
+
+    def test_request_scheduler(self):
+
+        # Given, a host whose burst is spent, then taking a request every 20 ms
+        scheduler = RequestScheduler(host_rate=50, host_burst=1, account_rate=0, max_wait=5)
+        scheduler.acquire('bank.example')
+        order = []
+
+        def request(account, priority):
+            scheduler.acquire('bank.example', account, priority)
+            order.append(account)
+
+        # When
+        threads = [threading.Thread(target=request, args=arguments)
+                   for arguments in [('sync', background)] * 4 + [('joint', interactive)] * 4
+                   + [('pro', interactive)] * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Then, the interactive requests first, in turn between their accounts
+        self.assertEqual(['sync'] * 4, order[8:])
+        self.assertEqual(['joint', 'pro'], sorted(order[:2]))
+        self.assertEqual(order[:2] * 4, order[:8])
+        stats = scheduler.stats()['bank.example']
+        self.assertEqual((13, 0), (stats['requests'], stats['queued']))
+        self.assertGreater(stats['max_wait'], 0.2)
+
+    def test_request_scheduler_backpressure(self):
+
+        # Given, a host taking a request every 50 ms with two background requests waiting, and a host taking one per s
+        scheduler = RequestScheduler(host_rate=20, host_burst=1, account_rate=0, queue_limit=2, max_wait=1)
+        scheduler.acquire('bank.example')
+        threads = [threading.Thread(target=scheduler.acquire, args=('bank.example', 'sync', background))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.01)
+        slow_scheduler = RequestScheduler(host_rate=1, host_burst=1, max_wait=0.1)
+        slow_scheduler.acquire('acs.example')
+
+        # When
+        with self.assertRaises(Exception) as rejected:
+            scheduler.acquire('bank.example', 'sync', background)
+        waited = scheduler.acquire('bank.example', 'joint', interactive)
+        with self.assertRaises(Exception) as expired:
+            slow_scheduler.acquire('acs.example', 'joint', interactive)
+        for thread in threads:
+            thread.join()
+
+        # Then, the background request is rejected at once, the interactive one goes first, up to max_wait
+        self.assertEqual('Too many requests waiting for bank.example: 2, retry later', str(rejected.exception))
+        self.assertLess(waited, 0.1)
+        self.assertEqual('Rate limited: request to acs.example waited more than 0.1 s', str(expired.exception))
+        stats = scheduler.stats()['bank.example']
+        self.assertEqual((4, 1, 0, 0), (stats['requests'], stats['rejected'], stats['expired'], stats['queued']))
+        self.assertEqual((1, 1, 0), tuple(slow_scheduler.stats()['acs.example'][key]
+                                          for key in ['requests', 'expired', 'queued']))
+
+    @patch.dict(os.environ, {'ECARD_LOGIN': 'login', 'ECARD_PASSWORD': 'password'})
+    def test_rate_limited_bank(self):
+
+        with contextlib.ExitStack() as stack:
+            # Given, a bank blocking the logins past 40 requests per second, in bursts of up to 5
+            bank_server = stack.enter_context(StubServer(bank_routes, rate_limit=40, rate_burst=5))
+            t3ds_server = stack.enter_context(StubServer(t3ds_routes))
+            stack.enter_context(patch.object(ecard, 'service_url', bank_server.url + '/fr/'))
+            stack.enter_context(patch.object(ecard, 't3ds_host', t3ds_server.url))
+            stack.enter_context(patch('builtins.input', return_value='12345678'))
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            profiles = [CardProfile('card%d' % n, credentials=EnvProvider('ECARD_LOGIN', 'ECARD_PASSWORD'),
+                                    amount='10.54') for n in range(4)]
+
+            # When
+            unpaced = orchestrate(profiles, workers=4, scheduler=RequestScheduler(host_rate=0, account_rate=0))
+            blocked = bank_server.blocked
+            time.sleep(0.2)
+            paced = orchestrate(profiles, workers=4, scheduler=RequestScheduler(host_rate=30, host_burst=5))
+
+        # Then
+        self.assertGreater(unpaced['failed'], 0)
+        self.assertIn("trop d'identifications incorrectes", [result for result in unpaced['results']
+                                                             if 'error' in result][0]['error'])
+        self.assertEqual(0, paced['failed'])
+        self.assertEqual(blocked, bank_server.blocked)
+
+    @patch('requests.Session.get', side_effect=mocked_bank)
+    @patch('requests.Session.post', side_effect=mocked_bank)
+    @patch('subprocess.run', return_value=subprocess.CompletedProcess([], 0, b'password\nlogin: login\n', b''))
+    def test_configured_credentials_provider(self, mock_run, mock_post, mock_get):
+
+        # Given, 2 e-numbers of the same card
+        profiles = [CardProfile('joint', amount='10.54'), CardProfile('joint', amount='20.00')]
+
+        # When
+        with patch.object(ecard, 'credentials_provider', 'gopass'):
+            report = orchestrate(profiles, workers=1)
+
+        # Then, a single gopass call for the login and the password of the card
+        self.assertEqual(2, report['succeeded'])
+        self.assertEqual(1, mock_run.call_count)
+        self.assertEqual(['gopass', 'show', '-f', ecard.password_gopass_location.format(card='joint')],
+                         mock_run.call_args[0][0])
+
+    def test_unknown_credentials_provider(self):
+        with self.assertRaises(ValueError) as context:
+            CardProfile('joint', credentials='vault', amount='10.54')
+        self.assertEqual('unknown credentials provider for card joint: vault', str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,381 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import json
+import os
+import queue
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, InvalidStateError, TimeoutError
+
+import ecard
+
+# the code in the text of a forwarded sms
+sms_code = re.compile(r'\b\d{6,8}\b')
+
+
+class OtpProvider:
+    """Source of the sms codes of the 3D Secure authentications.
+
+    request returns a future of the card's code, resolved by the provider's single listening thread: wait blocks the
+    calling thread until the code comes or the timeout expires, and wait_async only suspends the calling coroutine.
+    """
+
+    def request(self, card: str = None) -> Future:
+        """Ask for the code sent to the card, None if there is a single card."""
+        raise NotImplementedError
+
+    def wait(self, card: str = None, timeout: float = None) -> str:
+        timeout = ecard.otp_timeout if timeout is None else timeout
+        future = self.request(card)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise Exception(OtpProvider.timeout_message(card, timeout))
+
+    async def wait_async(self, card: str = None, timeout: float = None) -> str:
+        timeout = ecard.otp_timeout if timeout is None else timeout
+        future = self.request(card)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise Exception(OtpProvider.timeout_message(card, timeout))
+
+    def close(self) -> None:
+        pass
+
+    @staticmethod
+    def resolve(future: Future, code: str = None, exception: Exception = None) -> bool:
+        """Set the code of a future, unless it was cancelled meanwhile."""
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(code)
+            return True
+        except InvalidStateError:
+            return False
+
+    @staticmethod
+    def timeout_message(card: str, timeout: float) -> str:
+        return 'No 3D Secure code received%s within %g s' % (' for ' + card if card else '', timeout)
+
+
+class TerminalProvider(OtpProvider):
+    """Codes typed in the terminal: a single thread prompts for the requested codes in turn, naming their card."""
+
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def request(self, card: str = None) -> Future:
+        future = Future()
+        self.requests.put((card, future))
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.prompt, name='otp-terminal', daemon=True)
+                self.thread.start()
+        return future
+
+    def prompt(self) -> None:
+        while True:
+            card, future = self.requests.get()
+            # timed out while the previous code was typed
+            if future.done():
+                continue
+            try:
+                code = input('Enter code of ' + card + ': ' if card else 'Enter code: ')
+            except Exception as e:
+                OtpProvider.resolve(future, exception=e)
+            else:
+                OtpProvider.resolve(future, code.strip())
+
+
+class PushedProvider(OtpProvider):
+    """Codes pushed by another process, e.g. an sms forwarder, as "CODE" or "CARD CODE" lines.
+
+    A code naming its card goes to the request of that card, one without to the oldest request. A code pushed before
+    its request, the sms being sent while the authentication starts, is kept for otp_timeout seconds.
+    """
+
+    def __init__(self):
+        # (card, future) of the waiting requests, and (time, card, code) of the codes not requested yet
+        self.waiting = []
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def request(self, card: str = None) -> Future:
+        future = Future()
+        with self.lock:
+            now = time.monotonic()
+            self.pending = [code for code in self.pending if now - code[0] < ecard.otp_timeout]
+            for pushed in self.pending:
+                if PushedProvider.matches(card, pushed[1]):
+                    self.pending.remove(pushed)
+                    future.set_result(pushed[2])
+                    return future
+            self.waiting.append((card, future))
+        return future
+
+    def push(self, code: str, card: str = None) -> bool:
+        """Hand the code to its request, return False if it is kept until requested."""
+        with self.lock:
+            self.waiting = [waiting for waiting in self.waiting if not waiting[1].done()]
+            for waiting in self.waiting:
+                if PushedProvider.matches(waiting[0], card) and OtpProvider.resolve(waiting[1], code):
+                    self.waiting.remove(waiting)
+                    return True
+            self.pending.append((time.monotonic(), card, code))
+            return False
+
+    def push_line(self, line: str) -> bool:
+        words = line.split()
+        if not words:
+            raise Exception('Expected "CODE" or "CARD CODE"')
+        return self.push(words[-1], ' '.join(words[:-1]) or None)
+
+    @staticmethod
+    def matches(requested: str, pushed: str) -> bool:
+        return requested is None or pushed is None or requested == pushed
+
+
+class LineHandler(socketserver.StreamRequestHandler):
+    """A code per line, answered by "delivered" or "pending" lines."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                answer = 'delivered' if self.server.provider.push_line(line.decode('utf-8')) else 'pending'
+            except Exception as e:
+                answer = 'error: ' + str(e)
+            self.wfile.write((answer + '\n').encode('utf-8'))
+
+
+class SocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class SocketProvider(PushedProvider):
+    """Codes written to a unix socket, otp_socket_path of the configuration by default."""
+
+    def __init__(self, path: str = None):
+        super().__init__()
+        self.path = path or ecard.otp_socket_path
+        os.makedirs(os.path.dirname(self.path) or '.', mode=0o700, exist_ok=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = SocketServer(self.path, LineHandler)
+        os.chmod(self.path, 0o600)
+        self.server.provider = self
+        threading.Thread(target=self.server.serve_forever, name='otp-socket', daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class FifoProvider(PushedProvider):
+    """Codes written to a named pipe, otp_fifo_path of the configuration by default: echo 12345678 > otp.fifo"""
+
+    def __init__(self, path: str = None):
+        super().__init__()
+        self.path = path or ecard.otp_fifo_path
+        self.closed = False
+        os.makedirs(os.path.dirname(self.path) or '.', mode=0o700, exist_ok=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.mkfifo(self.path, 0o600)
+        threading.Thread(target=self.read, name='otp-fifo', daemon=True).start()
+
+    def read(self) -> None:
+        # reopened after each writer, until closed
+        while not self.closed:
+            try:
+                fifo = open(self.path, encoding='utf-8')
+            except FileNotFoundError:
+                return
+            with fifo:
+                for line in fifo:
+                    try:
+                        self.push_line(line)
+                    except Exception as e:
+                        ecard.logger.warning('%s: %s', self.path, e)
+
+    def close(self) -> None:
+        self.closed = True
+        try:
+            # wakes the reader up, waiting for a writer
+            os.close(os.open(self.path, os.O_WRONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class WebhookProvider(PushedProvider):
+    """Codes posted to a webhook on localhost, port otp_webhook_port of the configuration by default, 0 for any.
+
+    The body is json or a form, with a code and optionally a card, or the text of the forwarded sms:
+    {"card": "joint", "code": "12345678"}, or text=Votre code est 12345678. Answers 200 if the code was handed to its
+    request, 202 if it is kept until requested.
+    """
+
+    def __init__(self, port: int = None, host: str = '127.0.0.1'):
+        import http.server
+        super().__init__()
+        provider = self
+
+        class WebhookHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+                try:
+                    fields = json.loads(body) if body.startswith('{') else dict(urllib.parse.parse_qsl(body))
+                    code = fields.get('code') or WebhookProvider.parse_sms(fields.get('text') or '')
+                    status = 200 if provider.push(str(code), fields.get('card')) else 202
+                except Exception as e:
+                    self.send_error(400, str(e))
+                    return
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, ecard.otp_webhook_port if port is None else port),
+                                                      WebhookHandler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.url = 'http://%s:%d/' % (host, self.port)
+        threading.Thread(target=self.server.serve_forever, name='otp-webhook', daemon=True).start()
+
+    @staticmethod
+    def parse_sms(text: str) -> str:
+        match = sms_code.search(text)
+        if match is None:
+            raise Exception('No code in the sms: ' + text)
+        return match.group(0)
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FileProvider(PushedProvider):
+    """Codes written to a file, otp_file_path of the configuration by default, polled every otp_poll_interval seconds.
+
+    The file is removed once read: write it whole, e.g. to a temporary file renamed to the path.
+    """
+
+    def __init__(self, path: str = None, interval: float = None):
+        super().__init__()
+        self.path = path or ecard.otp_file_path
+        self.interval = ecard.otp_poll_interval if interval is None else interval
+        self.closed = threading.Event()
+        threading.Thread(target=self.watch, name='otp-file', daemon=True).start()
+
+    def watch(self) -> None:
+        while not self.closed.wait(self.interval):
+            try:
+                # taken away from the writers before being read
+                os.replace(self.path, self.path + '.read')
+            except FileNotFoundError:
+                continue
+            with open(self.path + '.read', encoding='utf-8') as codes:
+                lines = [line for line in codes if line.strip()]
+            os.remove(self.path + '.read')
+            for line in lines:
+                self.push_line(line)
+
+    def close(self) -> None:
+        self.closed.set()
+
+
+providers = {
+    'terminal': TerminalProvider,
+    'socket': SocketProvider,
+    'fifo': FifoProvider,
+    'webhook': WebhookProvider,
+    'file': FileProvider,
+}
+# providers of the process, listening from their first use
+started = {}
+started_lock = threading.Lock()
+
+
+def get_provider(name: str = None) -> OtpProvider:
+    """The provider of the configuration, or the named one, shared by all the sessions of the process."""
+    name = name or ecard.otp_provider
+    if name not in providers:
+        raise Exception('Unknown otp provider: ' + name + ', expected one of ' + ', '.join(providers))
+    with started_lock:
+        if name not in started:
+            started[name] = providers[name]()
+        return started[name]
+
+
+def send_code(code: str, card: str = None, provider: str = None) -> str:
+    """Push a code to the provider listening in another process, return its answer."""
+    provider = provider or ecard.otp_provider
+    line = (card + ' ' if card else '') + code + '\n'
+    if provider == 'socket':
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            try:
+                client.connect(ecard.otp_socket_path)
+            except OSError as e:
+                raise Exception('No process waiting for a code on ' + ecard.otp_socket_path + ': ' + e.strerror)
+            client.sendall(line.encode('utf-8'))
+            client.shutdown(socket.SHUT_WR)
+            return client.makefile(encoding='utf-8').readline().strip()
+    if provider == 'fifo':
+        try:
+            descriptor = os.open(ecard.otp_fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            raise Exception('No process waiting for a code on ' + ecard.otp_fifo_path + ': ' + e.strerror)
+        with open(descriptor, 'w', encoding='utf-8') as fifo:
+            fifo.write(line)
+        return 'sent'
+    if provider == 'webhook':
+        import requests
+        response = requests.post('http://127.0.0.1:%d/' % ecard.otp_webhook_port, json={'card': card, 'code': code},
+                                 timeout=ecard.http_connect_timeout)
+        response.raise_for_status()
+        return 'delivered' if response.status_code == 200 else 'pending'
+    if provider == 'file':
+        with open(os.open(ecard.otp_file_path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+            file.write(line)
+        os.replace(ecard.otp_file_path + '.tmp', ecard.otp_file_path)
+        return 'sent'
+    raise Exception('Codes are typed in the terminal by the ' + provider + ' provider')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='send the 3D Secure code of a card to a waiting ecard.py, '
+                                                 'orchestrator or daemon')
+    parser.add_argument('code', help='code received by sms')
+    parser.add_argument('-c', '--card', help='card the code was sent for, needed if several cards wait for theirs')
+    parser.add_argument('-p', '--provider', choices=[name for name in providers if name != 'terminal'],
+                        help='otp provider of the waiting process, default is the configured one')
+    _args = parser.parse_args()
+
+    try:
+        print(send_code(_args.code, _args.card, _args.provider))
+    except Exception as e:
+        print(e)
+        sys.exit(1)
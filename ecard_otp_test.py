@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+
+import asyncio
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import DEFAULT, patch
+
+import ecard
+import ecard_otp
+from ecard_async import AsyncECardManager
+from ecard_client import ECardManager
+from ecard_credentials import EnvProvider
+from ecard_orchestrator import CardProfile, orchestrate
+from ecard_otp import FifoProvider, FileProvider, PushedProvider, SocketProvider, TerminalProvider, WebhookProvider
+from ecard_stub import StubServer, bank_routes, t3ds_routes
+from ecard_test import mocked_requests_response
+
+
+def wait_for_requests(provider: PushedProvider, count: int) -> None:
+    deadline = time.monotonic() + 5
+    while len([waiting for waiting in provider.waiting if not waiting[1].done()]) < count:
+        if time.monotonic() > deadline:
+            raise Exception('%d requests expected, %d waiting' % (count, len(provider.waiting)))
+        time.sleep(0.01)
+
+
+class OtpTest(unittest.TestCase):
+
+    def test_pushed_codes(self):
+
+        # Given, a code pushed before its request, and requests of two cards
+        provider = PushedProvider()
+        self.assertFalse(provider.push_line('11111111\n'))
+        early = provider.request('early')
+        joint = provider.request('joint')
+        pro = provider.request('pro')
+
+        # When
+        delivered = [provider.push_line('pro 22222222'), provider.push('33333333')]
+
+        # Then, a code naming its card goes to it, one without to the oldest request
+        self.assertEqual([True, True], delivered)
+        self.assertEqual(['11111111', '33333333', '22222222'], [early.result(0), joint.result(0), pro.result(0)])
+        with self.assertRaises(Exception) as context:
+            provider.wait('late', timeout=0.05)
+        self.assertEqual('No 3D Secure code received for late within 0.05 s', str(context.exception))
+        self.assertFalse(provider.push('44444444', 'other'))
+
+    @patch('builtins.input', side_effect=['12345678 ', '87654321'])
+    def test_terminal(self, mock_input):
+
+        # Given
+        provider = TerminalProvider()
+
+        # When, two cards waiting at once
+        codes = {}
+        threads = [threading.Thread(target=lambda card=card: codes.update({card: provider.wait(card, timeout=5)}))
+                   for card in ['joint', 'pro']]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+
+        # Then, prompted in turn
+        self.assertEqual({'joint': '12345678', 'pro': '87654321'}, codes)
+        self.assertEqual(['Enter code of joint: ', 'Enter code of pro: '],
+                         [call.args[0] for call in mock_input.call_args_list])
+
+    @patch.object(ecard, 'prefetch_connections', False)
+    def test_auth_3ds_otp_sms(self):
+
+        def send_code(provider: PushedProvider, name: str) -> None:
+            # pushed by another process, once the code is awaited
+            wait_for_requests(provider, 1)
+            ecard_otp.send_code('87654321', 'joint', name)
+
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['socket', 'fifo', 'webhook', 'file']:
+                with self.subTest(name), contextlib.ExitStack() as stack:
+                    # Given
+                    stack.enter_context(patch.object(ecard, 'otp_socket_path', os.path.join(directory, 'otp.sock')))
+                    stack.enter_context(patch.object(ecard, 'otp_fifo_path', os.path.join(directory, 'otp.fifo')))
+                    stack.enter_context(patch.object(ecard, 'otp_file_path', os.path.join(directory, 'otp')))
+                    stack.enter_context(patch.object(ecard, 'otp_poll_interval', 0.05))
+                    provider = {'socket': SocketProvider, 'fifo': FifoProvider, 'file': FileProvider,
+                                'webhook': lambda: WebhookProvider(port=0)}[name]()
+                    stack.callback(provider.close)
+                    if name == 'webhook':
+                        stack.enter_context(patch.object(ecard, 'otp_webhook_port', provider.port))
+                    mocks = stack.enter_context(patch.multiple('requests.Session', post=DEFAULT, get=DEFAULT))
+                    mocks['get'].side_effect = [mocked_requests_response('auth_3ds_1_parequest_redirect')]
+                    mocks['post'].side_effect = [mocked_requests_response('auth_3ds_1_parequest'),
+                                                 mocked_requests_response('auth_3ds_2_getsession'),
+                                                 mocked_requests_response('auth_3ds_3_startauthent'),
+                                                 mocked_requests_response('auth_3ds_4_updateauthent'),
+                                                 mocked_requests_response('auth_3ds_5_endauthent'),
+                                                 mocked_requests_response('auth_3ds_6_parequestfromauthpages'),
+                                                 mocked_requests_response('receive3ds')]
+                    stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+                    e_card_manager = ECardManager()
+                    e_card_manager.otp = provider
+                    e_card_manager.card = 'joint'
+                    e_card_manager.auth_3ds_md = 'MD123456789012345678'
+                    e_card_manager.auth_3ds_pareq = 'PaReqABCDEF1234567890ABCDEF1234567890'
+                    sender = threading.Thread(target=send_code, args=(provider, name))
+                    sender.start()
+
+                    # When
+                    e_card_manager.auth_3ds()
+                    sender.join()
+
+                    # Then
+                    self.assertTrue(e_card_manager.auth_3ds_completed)
+                    update_authent = mocks['post'].call_args_list[3]
+                    self.assertTrue(update_authent.args[0].endswith('/updateAuthent'))
+                    self.assertEqual('87654321',
+                                     json.loads(update_authent.kwargs['data'])['hubAuthenticationInput']['otp'])
+                    # the file of the code is removed once read
+                    self.assertFalse(os.path.exists(os.path.join(directory, 'otp')))
+
+    @patch.dict(os.environ, {'ECARD_LOGIN': 'login', 'ECARD_PASSWORD': 'password'})
+    def test_concurrent_accounts(self):
+
+        def send_codes(provider: PushedProvider) -> None:
+            # the 3 cards at the sms step at the same time, their codes sent in any order
+            wait_for_requests(provider, 4)
+            for card in ['card2', 'card0', 'card1']:
+                ecard_otp.send_code('12345678', card, 'socket')
+
+        with contextlib.ExitStack() as stack:
+            # Given, a 4th card whose code never comes
+            directory = stack.enter_context(tempfile.TemporaryDirectory())
+            bank_server = stack.enter_context(StubServer(bank_routes))
+            t3ds_server = stack.enter_context(StubServer(t3ds_routes))
+            stack.enter_context(patch.object(ecard, 'service_url', bank_server.url + '/fr/'))
+            stack.enter_context(patch.object(ecard, 't3ds_host', t3ds_server.url))
+            stack.enter_context(patch.object(ecard, 'otp_provider', 'socket'))
+            stack.enter_context(patch.object(ecard, 'otp_socket_path', os.path.join(directory, 'otp.sock')))
+            stack.enter_context(patch.object(ecard, 'otp_timeout', 1))
+            stack.enter_context(patch.object(ecard_otp, 'started', {}))
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            provider = ecard_otp.get_provider()
+            stack.callback(provider.close)
+            profiles = [CardProfile('card%d' % n, credentials=EnvProvider('ECARD_LOGIN', 'ECARD_PASSWORD'),
+                                    amount='10.54') for n in range(4)]
+            sender = threading.Thread(target=send_codes, args=(provider,))
+            sender.start()
+
+            # When
+            start = time.monotonic()
+            report = orchestrate(profiles, workers=4)
+            elapsed = time.monotonic() - start
+            sender.join()
+
+        # Then, the late card timed out alone, while the others went on
+        self.assertEqual(1, report['failed'])
+        self.assertEqual([None, None, None, 'No 3D Secure code received for card3 within 1 s'],
+                         [result.get('error') for result in report['results']])
+        self.assertLess(elapsed, 3)
+
+
+class AsyncOtpTest(unittest.IsolatedAsyncioTestCase):
+
+    @patch.object(ecard, 'prefetch_connections', False)
+    async def test_concurrent_accounts(self):
+
+        with contextlib.ExitStack() as stack:
+            # Given
+            bank_server = stack.enter_context(StubServer(bank_routes))
+            t3ds_server = stack.enter_context(StubServer(t3ds_routes))
+            stack.enter_context(patch.object(ecard, 't3ds_host', t3ds_server.url))
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            provider = PushedProvider()
+            e_card_managers = []
+            for card in ['joint', 'pro', 'late']:
+                e_card_manager = AsyncECardManager(host=bank_server.url + '/fr/caisse-epargne')
+                e_card_manager.otp = provider
+                e_card_manager.card = card
+                e_card_managers.append(e_card_manager)
+
+            async def authenticate(e_card_manager: AsyncECardManager):
+                await e_card_manager.do_login('login', 'password')
+                await e_card_manager.auth_3ds()
+                return e_card_manager.auth_3ds_completed
+
+            async def send_codes():
+                # once the 3 sessions wait in the same event loop
+                while len(provider.waiting) < 3:
+                    await asyncio.sleep(0.01)
+                provider.push('12345678', 'pro')
+                provider.push('12345678', 'joint')
+
+            # When
+            with patch.object(ecard, 'otp_timeout', 0.5):
+                results = await asyncio.gather(send_codes(), *[authenticate(e_card_manager)
+                                                               for e_card_manager in e_card_managers],
+                                               return_exceptions=True)
+            for e_card_manager in e_card_managers:
+                await e_card_manager.transport.close()
+
+        # Then
+        self.assertEqual([True, True], results[1:3])
+        self.assertEqual('No 3D Secure code received for late within 0.5 s', str(results[3]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,337 @@
+#!/usr/bin/python3
+
+from array import array
+from datetime import date
+from decimal import Decimal
+
+import lxml.html as html_parser
+from lxml import etree
+
+
+class ECard:
+    """A generated e-number."""
+
+    __slots__ = ('number', 'expired_at', 'cvv', 'owner')
+    labels = ('Card number', 'Expired at', 'CVV', 'Owner')
+
+    def __init__(self, number: str, expired_at: str, cvv: str, owner: str):
+        self.number = number
+        self.expired_at = expired_at
+        self.cvv = cvv
+        self.owner = owner
+
+    def as_dict(self) -> dict:
+        return {field: getattr(self, field) for field in ECard.__slots__}
+
+    def __str__(self):
+        return '\n'.join('%-11s : %s' % (label, getattr(self, field))
+                         for label, field in zip(ECard.labels, ECard.__slots__))
+
+
+class HistoricEntry:
+    """A row of the historic page, parsed once: a date, Decimal euros, and None for the page's empty values."""
+
+    __slots__ = ('date', 'merchant', 'number', 'ceiling', 'amount', 'used')
+
+    def __init__(self, date: date, merchant: str, number: str, ceiling: Decimal, amount: Decimal, used: bool):
+        self.date = date
+        self.merchant = merchant
+        self.number = number
+        self.ceiling = ceiling
+        self.amount = amount
+        self.used = used
+
+    def as_dict(self) -> dict:
+        return {field: getattr(self, field) for field in HistoricEntry.__slots__}
+
+    @staticmethod
+    def from_page(values: list, used: bool) -> 'HistoricEntry':
+        """The entry of the texts of a historic row: date, merchant, e-number, ceiling and amount."""
+        return HistoricEntry(parse_date(values[0]), None if values[1] == empty_value else values[1], values[2],
+                             parse_amount(values[3]), parse_amount(values[4]), used)
+
+
+class HistoricStats:
+    """Totals of a group of historic rows: e-numbers, used ones, their spend, and the ceilings of the unused ones."""
+
+    __slots__ = ('key', 'count', 'used', 'spent', 'unused_ceiling')
+
+    def __init__(self, key: str, count: int, used: int, spent: Decimal, unused_ceiling: Decimal):
+        self.key = key
+        self.count = count
+        self.used = used
+        self.spent = spent
+        self.unused_ceiling = unused_ceiling
+
+    def as_dict(self) -> dict:
+        return {field: getattr(self, field) for field in HistoricStats.__slots__}
+
+
+class HistoricBatch:
+    """Columnar form of historic entries, for aggregations over many rows.
+
+    Dates, months and amounts are arrays of integers: date ordinals, yyyymm and cents, with 0 cents for an empty
+    amount. Merchants and cards stay lists, merchants None for the unused e-numbers.
+    """
+
+    group_keys = ['merchant', 'month', 'card']
+
+    def __init__(self, entries=(), card: str = None):
+        self.dates = array('l')
+        self.months = array('l')
+        self.ceilings = array('q')
+        self.amounts = array('q')
+        self.used = array('b')
+        self.merchants = []
+        self.cards = []
+        self.extend(entries, card)
+
+    def extend(self, entries, card: str = None) -> None:
+        for entry in entries:
+            self.add(entry.date, entry.merchant, int(entry.ceiling * 100),
+                     0 if entry.amount is None else int(entry.amount * 100), entry.used, card)
+
+    def add(self, day: date, merchant: str, ceiling: int, amount: int, used: bool, card: str = None) -> None:
+        """Append a row, amounts in cents."""
+        self.dates.append(day.toordinal())
+        self.months.append(day.year * 100 + day.month)
+        self.ceilings.append(ceiling)
+        self.amounts.append(amount)
+        self.used.append(used)
+        self.merchants.append(merchant)
+        self.cards.append(card)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def stats(self, by: str) -> list:
+        """HistoricStats per merchant, yyyy-mm or card, in one pass over the columns: the months most recent first,
+        the other groups by decreasing spend."""
+        if by not in HistoricBatch.group_keys:
+            raise Exception('Unknown group: ' + by + ', expected one of ' + ', '.join(HistoricBatch.group_keys))
+        keys = {'merchant': self.merchants, 'month': self.months, 'card': self.cards}[by]
+        groups = {}
+        for key, ceiling, amount, used in zip(keys, self.ceilings, self.amounts, self.used):
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = [0, 0, 0, 0]
+            group[0] += 1
+            if used:
+                group[1] += 1
+                group[2] += amount
+            else:
+                group[3] += ceiling
+        if by == 'month':
+            keys = sorted(groups, reverse=True)
+        else:
+            keys = sorted(groups, key=lambda key: groups[key][2], reverse=True)
+        return [HistoricStats('%04d-%02d' % divmod(key, 100) if by == 'month' else key, groups[key][0], groups[key][1],
+                              Decimal(groups[key][2]).scaleb(-2), Decimal(groups[key][3]).scaleb(-2))
+                for key in keys]
+
+    def spend_by_merchant(self) -> dict:
+        """Total amount of the used e-numbers, in Decimal euros, per merchant."""
+        return HistoricBatch.euros(HistoricBatch.sum_by(self.merchants, self.amounts, self.used))
+
+    def spend_by_month(self) -> dict:
+        """Total amount of the used e-numbers, in Decimal euros, per yyyy-mm."""
+        totals = HistoricBatch.sum_by(self.months, self.amounts, self.used)
+        return HistoricBatch.euros({'%04d-%02d' % divmod(month, 100): total for month, total in totals.items()})
+
+    @staticmethod
+    def sum_by(keys, values, mask) -> dict:
+        totals = {}
+        for key, value, selected in zip(keys, values, mask):
+            if selected:
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    @staticmethod
+    def euros(totals: dict) -> dict:
+        return {key: Decimal(cents).scaleb(-2) for key, cents in totals.items()}
+
+
+class PageSchema:
+    """Fields of a bank page, extracted by a single precompiled XPath expression.
+
+    Each field is an XPath to a string (attribute or text node), flags are XPaths whose presence is tested. A required
+    field missing from the page is reported by its name, so a change of the bank's markup is easy to spot.
+    """
+
+    # private use character, never in the bank's pages
+    separator = '\ue000'
+
+    def __init__(self, name: str, fields: dict, optional=(), flags: dict = None):
+        self.name = name
+        self.keys = list(fields)
+        self.optional = optional
+        self.flags = list(flags or {})
+        parts = ['string(' + path + ')' for path in fields.values()] \
+            + ['count(' + path + ')' for path in (flags or {}).values()]
+        separator = ", '" + PageSchema.separator + "', "
+        self.xpath = etree.XPath('concat(' + separator.join(parts + ["''"]) + ')')
+
+    def extract(self, dom) -> dict:
+        values = self.xpath(dom).split(PageSchema.separator)
+        page = {key: value.strip() or None for key, value in zip(self.keys, values)}
+        page.update({key: value != '0' for key, value in zip(self.flags, values[len(self.keys):])})
+
+        missing = [key for key in self.keys if page[key] is None and key not in self.optional]
+        if missing:
+            raise Exception('Unexpected ' + self.name + ' page, ' + ', '.join(missing) + ' not found.')
+        return page
+
+
+# Page schemas
+login_page = PageSchema('login', {'token': '//input[@name="token"]/@value'},
+                        flags={'auth_3ds_needed': '//form[@id="form-3ds-authentificate"]'})
+t3ds_form = PageSchema('3D Secure form', {
+    'md': '//input[@name="MD"]/@value',
+    'pareq': '//input[@name="PaReq"]/@value',
+    'termurl': '//input[@name="TermUrl"]/@value'
+})
+payer_page = PageSchema('payment', {'token': '//form[@id="form-code-generator"]//input[@name="token"]/@value'},
+                        optional=['token'])
+pa_response_page = PageSchema('3D Secure response', {
+    'md': '//input[@name="MD"]/@value',
+    'pares': '//input[@name="PaRes"]/@value'
+})
+ecard_page = PageSchema('e-number', {
+    'number': '//dd[@id="generated-code-dd"]/span/@data-drag-txt',
+    'expired_at': '//dl[@id="content-expiration-date"]/dd/text()',
+    'cvv': '//dl[@id="content-cryptogramme"]//span[@class="restricted-only"]/text()',
+    'owner': '//dl[@id="content-card-owner"]//span[@class="restricted-only"]/text()',
+    'token': '//input[@name="token"]/@value'
+}, optional=['token'])
+error_alert = etree.XPath('//form[@id="form-error-confirmation"]//p[@role="alert"]')
+# value of the historic page's empty cells
+empty_value = '-----------'
+# historic panes, and whether their e-numbers are used
+historic_panes = {'history-panes-used-numbers-print': True, 'history-panes-unused-numbers-print': False}
+
+
+def parse_page(html: str):
+    dom = html_parser.document_fromstring(html)
+    check_error(dom)
+    return dom
+
+
+def parse_login_page(html: str) -> dict:
+    dom = parse_page(html)
+    page = login_page.extract(dom)
+    if page['auth_3ds_needed']:
+        page.update(t3ds_form.extract(dom))
+    return page
+
+
+def parse_payer_page(html: str):
+    """Return the token of the e-number form, or None when the session is no longer authenticated."""
+    return payer_page.extract(html_parser.document_fromstring(html))['token']
+
+
+def parse_pa_response_page(html: str) -> tuple:
+    page = pa_response_page.extract(html_parser.document_fromstring(html))
+    return page['md'], page['pares']
+
+
+def parse_ecard_page(html: str) -> tuple:
+    page = ecard_page.extract(parse_page(html))
+    return ECard(page['number'], page['expired_at'], page['cvv'], page['owner']), page['token']
+
+
+def parse_historic_page(html: str) -> list:
+    return historic_table(parse_historic_entries(html))
+
+
+def parse_historic_entries(html: str) -> list:
+    return list(iter_historic_entries(chunks(html)))
+
+
+def iter_historic_entries(chunks, since: date = None, limit: int = None):
+    """Yield the rows of the historic page while it is parsed, from an iterable of html chunks.
+
+    Rows are removed from the tree once read, so memory doesn't grow with the page's length. Each pane lists its
+    e-numbers most recent first: the rest of a pane is skipped from its first row older than since, and parsing
+    stops once both panes are read or after limit rows.
+    """
+    panes = historic_panes
+    parser = etree.HTMLPullParser(events=('start', 'end'), tag=['div', 'tr', 'form'])
+    # lxml.html elements, as check_error expects
+    parser.set_element_class_lookup(html_parser.HtmlElementClassLookup())
+    pane = None
+    skip = False
+    panes_read = 0
+    count = 0
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == 'start':
+                if element.tag == 'div' and element.get('id') in panes:
+                    pane = element
+                    skip = False
+            elif element.tag == 'tr' and pane is not None and element.getparent().tag == 'table':
+                if not skip:
+                    entry = HistoricEntry.from_page([col.text.strip() for col in element],
+                                                    panes[pane.get('id')])
+                    if since is not None and entry.date < since:
+                        skip = True
+                    else:
+                        yield entry
+                        count += 1
+                        if count == limit:
+                            return
+                # drop the rows already read
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            elif element is pane:
+                pane = None
+                panes_read += 1
+                if panes_read == len(panes):
+                    return
+            elif element.tag == 'form' and element.get('id') == 'form-error-confirmation':
+                check_error(element)
+    parser.close()
+
+
+def chunks(text: str, size: int = 64 * 1024):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def historic_table(entries: list) -> list:
+    items = [[format_date(entry.date), entry.merchant or '─', entry.number, format_amount(entry.ceiling),
+              '─' if entry.amount is None else format_amount(entry.amount)]
+             for entry in sorted(entries, key=lambda entry: entry.date, reverse=True)]
+
+    # add headers
+    items.insert(0, ['DATE   ', 'COMMERCANT', 'E-NUMERO     ', 'PLAFOND', 'TRANSACTION'])
+    return items
+
+
+def parse_date(text: str) -> date:
+    """'08/12/2020' to a date, without the cost of strptime."""
+    return date(int(text[6:10]), int(text[3:5]), int(text[:2]))
+
+
+def format_date(day: date) -> str:
+    return '%02d/%02d/%04d' % (day.day, day.month, day.year)
+
+
+def parse_amount(text: str) -> Decimal:
+    """'1 012,00 €' to Decimal('1012.00'), None for an empty cell."""
+    if text == empty_value:
+        return None
+    return Decimal(text.replace('€', '').replace('\xa0', '').replace(' ', '').replace(',', '.'))
+
+
+def format_amount(value: Decimal) -> str:
+    return str(value).replace('.', ',') + ' €'
+
+
+def check_error(dom: html_parser) -> None:
+    errors = error_alert(dom)
+    if len(errors) > 0:
+        # convert <br> to \n
+        for br in errors[0].iter('br'):
+            br.tail = '\n' + br.tail if br.tail else '\n'
+        raise Exception(errors[0].text_content().strip())
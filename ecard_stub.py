@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+mocks_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mocks')
+
+# (method, path pattern, mock name or list of mock names served in turn) served by the e-cartebleue stub
+bank_routes = [
+    ('POST', r'/fr/[^/]+/login$', 'login_success_auth_3ds_needed'),
+    ('POST', r'/fr/[^/]+/receive3ds$', 'receive3ds'),
+    ('GET', r'/fr/[^/]+/payer$', 'login_success'),
+    ('POST', r'/fr/[^/]+/cpn$', 'generate_ecard_success'),
+    ('POST', r'/fr/[^/]+/historic$', 'historic'),
+    ('GET', r'/fr/[^/]+/logout$', 'logout'),
+]
+
+# (method, path pattern, mock name) served by the 3D Secure stub
+t3ds_routes = [
+    ('POST', r'/acs-pa-service/pa/paRequest$', 'auth_3ds_1_parequest'),
+    ('POST', r'/acs-pa-service/pa/paRequestFromAuthPages$', 'auth_3ds_6_parequestfromauthpages'),
+    ('GET', r'/acs-auth-pages/authent/pages/3ds\w+$', 'auth_3ds_1_parequest_redirect'),
+    ('POST', r'/acs-auth-pages/authent/pages/getSession/\w+$', 'auth_3ds_2_getsession'),
+    ('POST', r'/acs-auth-pages/authent/pages/startAuthent$', 'auth_3ds_3_startauthent'),
+    ('POST', r'/acs-auth-pages/authent/pages/updateAuthent$', 'auth_3ds_4_updateauthent'),
+    ('POST', r'/acs-auth-pages/authent/pages/startPolling$', 'auth_3ds_41_startpolling_ok'),
+    ('POST', r'/acs-auth-pages/authent/pages/endAuthent$', 'auth_3ds_5_endauthent'),
+]
+
+# 3D Secure stub authenticating by mobile app, approved at the second poll
+t3ds_mobile_routes = [
+    (method, pattern, {
+        'auth_3ds_3_startauthent': 'auth_3ds_31_startauthent',
+        'auth_3ds_41_startpolling_ok': ['auth_3ds_41_startpolling_waiting', 'auth_3ds_41_startpolling_ok']
+    }.get(name, name)) for method, pattern, name in t3ds_routes
+]
+
+# headers computed by the stub itself
+skipped_headers = ['content-length', 'content-encoding', 'transfer-encoding', 'connection']
+
+
+def recorded_routes(directory: str) -> dict:
+    """The routes replaying the fixtures recorded in directory (see ecard_har.FixtureRecorder), by recorded host.
+
+    Each route matches a recorded method and path exactly, and serves its responses in the recorded order.
+    """
+    routes = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(directory, name)) as json_file:
+            request = json.load(json_file)['request']
+        url = urllib.parse.urlparse(request['url'])
+        host_routes = routes.setdefault(url.scheme + '://' + url.netloc, [])
+        pattern = '^' + re.escape(url.path) + '$'
+        mock = os.path.join(os.path.abspath(directory), name[:-len('.json')])
+        route = next((route for route in host_routes if route[:2] == (request['method'], pattern)), None)
+        if route is None:
+            host_routes.append((request['method'], pattern, [mock]))
+        else:
+            route[2].append(mock)
+    return routes
+
+
+def load_mock(name: str) -> tuple:
+    # a mock of mocks/, or the path of a fixture without its .json extension
+    with open(os.path.join(mocks_dir, name + '.json')) as json_file:
+        data = json.load(json_file)['response']
+    headers = [(header['name'], header['value']) for header in data['headers']
+               if header['name'].lower() not in skipped_headers]
+    body = (data['content'].get('text') or '').encode('utf-8')
+    return data['status'], headers, body
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # idle keep-alive connections are closed after keepalive seconds
+        self.timeout = self.server.keepalive
+        super().setup()
+        # the first response of a connection waits for its simulated handshake
+        self.handshake_end = time.monotonic() + self.server.handshake
+
+    def do_GET(self):
+        self.replay('GET')
+
+    def do_POST(self):
+        self.replay('POST')
+
+    def replay(self, method):
+        # always drain the request body, so the connection can be kept alive
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        self.server.count_request()
+        handshake = self.handshake_end - time.monotonic()
+        if handshake > 0:
+            time.sleep(handshake)
+        delay, fault = self.server.draw()
+        if delay:
+            time.sleep(delay)
+        if fault == 'reset':
+            # drop the connection without answering
+            self.close_connection = True
+            return
+        if fault == 'error':
+            self.server.count_error()
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        path = urllib.parse.urlparse(self.path).path
+        mock = self.server.blocked_mock if self.server.over_rate_limit() else self.server.find_mock(method, path)
+        if mock is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        status, headers, body = mock
+        self.send_response(status)
+        for name, value in headers:
+            if name.lower() == 'location':
+                # redirect to this stub instead of the recorded host
+                location = urllib.parse.urlparse(value)
+                value = self.server.url + location.path
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, routes: list, delay: float, jitter: float = 0.0, error_rate: float = 0.0,
+                 reset_rate: float = 0.0, seed=None, handshake: float = 0.0, keepalive: float = None,
+                 rate_limit: float = 0.0, rate_burst: float = None, blocked: str = 'login_blocked'):
+        super().__init__(address, StubHandler)
+        # token bucket of the rate limit, refilled at rate_limit requests per second
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst or rate_limit
+        self.rate_tokens = self.rate_burst
+        self.rate_updated = time.monotonic()
+        self.blocked_mock = load_mock(blocked)
+        self.blocked = 0
+        self.handshake = handshake
+        self.keepalive = keepalive
+        self.delay = delay
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.random = random.Random(seed)
+        self.routes = []
+        for method, pattern, names in routes:
+            names = [names] if isinstance(names, str) else names
+            self.routes.append((method, re.compile(pattern), [load_mock(name) for name in names]))
+        self.served = [0] * len(self.routes)
+        self.url = 'http://%s:%d' % self.server_address[:2]
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def count_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def draw(self) -> tuple:
+        """Draw the delay of the next response, and its injected fault: None, 'error' or 'reset'."""
+        with self.lock:
+            delay = max(0.0, self.delay + self.random.uniform(-self.jitter, self.jitter)) if self.jitter \
+                else self.delay
+            draw = self.random.random()
+        if draw < self.reset_rate:
+            return delay, 'reset'
+        if draw < self.reset_rate + self.error_rate:
+            return delay, 'error'
+        return delay, None
+
+    def over_rate_limit(self) -> bool:
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.rate_tokens = min(self.rate_burst, self.rate_tokens + (now - self.rate_updated) * self.rate_limit)
+            self.rate_updated = now
+            if self.rate_tokens < 1:
+                self.blocked += 1
+                return True
+            self.rate_tokens -= 1
+            return False
+
+    def find_mock(self, method: str, path: str):
+        for index, (route_method, pattern, mocks) in enumerate(self.routes):
+            if route_method == method and pattern.search(path):
+                # a route with several mocks serves them in turn
+                with self.lock:
+                    served = self.served[index]
+                    self.served[index] += 1
+                return mocks[served % len(mocks)]
+        return None
+
+
+class StubServer:
+    """Local http server replaying the mocks/ captures by method and path, for tests and benchmarks on a real socket.
+
+    It counts accepted connections and served requests, so connection reuse can be measured. It can wait delay
+    seconds, plus or minus jitter, before each response to simulate the network and server latency, and inject faults:
+    a 503 error with error_rate probability, a connection closed without answer with reset_rate probability. seed
+    makes the latencies and faults reproducible.
+
+    New connections can simulate the duration of the tcp and tls handshakes: their first response isn't sent before
+    handshake seconds after the connection was accepted, so a connection opened ahead doesn't pay it. Idle connections
+    are closed after keepalive seconds, as the servers do.
+
+    Past rate_limit requests per second, in bursts of up to rate_burst, the requests are answered by the blocked mock,
+    the bank's page of a blocked login by default, as the bank does when it is called too often.
+    """
+
+    def __init__(self, routes: list, host='127.0.0.1', port=0, delay=0.0, jitter=0.0, error_rate=0.0, reset_rate=0.0,
+                 seed=None, handshake=0.0, keepalive=None, rate_limit=0.0, rate_burst=None, blocked='login_blocked'):
+        self.server = StubHTTPServer((host, port), routes, delay, jitter, error_rate, reset_rate, seed, handshake,
+                                     keepalive, rate_limit, rate_burst, blocked)
+        # short poll interval, so that stopping the server doesn't wait
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return self.server.url
+
+    @property
+    def connections(self) -> int:
+        return self.server.connections
+
+    @property
+    def requests(self) -> int:
+        return self.server.requests
+
+    @property
+    def errors(self) -> int:
+        return self.server.errors
+
+    @property
+    def blocked(self) -> int:
+        return self.server.blocked
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+import time
+import unittest
+from unittest.mock import patch
+
+import requests
+
+import ecard_bench
+from ecard_stub import StubServer, bank_routes, load_mock, t3ds_mobile_routes
+
+
+class ECardStubTest(unittest.TestCase):
+    polling_path = '/acs-auth-pages/authent/pages/startPolling'
+
+    def test_mocks_served_in_turn(self):
+
+        # Given
+        with StubServer(t3ds_mobile_routes) as server:
+
+            # When
+            responses = [requests.post(server.url + self.polling_path).json() for _ in range(3)]
+
+        # Then
+        self.assertEqual([False, True, False],
+                         [response['hubAuthenticationOutput']['authenticationSuccess'] for response in responses])
+        self.assertEqual(3, server.requests)
+
+    def test_unknown_route(self):
+
+        # Given
+        with StubServer(t3ds_mobile_routes) as server:
+
+            # When
+            response = requests.get(server.url + '/unknown')
+
+        # Then
+        self.assertEqual(404, response.status_code)
+
+    def test_injected_errors(self):
+
+        # Given
+        with StubServer(t3ds_mobile_routes, error_rate=0.5, seed=1) as server:
+
+            # When
+            statuses = [requests.post(server.url + self.polling_path).status_code for _ in range(20)]
+
+        # Then
+        self.assertEqual(server.errors, statuses.count(503))
+        self.assertEqual(20 - server.errors, statuses.count(200))
+        self.assertTrue(0 < server.errors < 20)
+
+    def test_injected_resets(self):
+
+        # Given
+        with StubServer(t3ds_mobile_routes, reset_rate=1.0) as server:
+
+            # When
+            with self.assertRaises(requests.ConnectionError):
+                requests.post(server.url + self.polling_path)
+
+        # Then
+        self.assertEqual(1, server.requests)
+
+    def test_rate_limit(self):
+
+        # Given
+        with StubServer(bank_routes, rate_limit=5, rate_burst=3) as server:
+
+            # When
+            bodies = [requests.post(server.url + '/fr/caisse-epargne/login').content for _ in range(5)]
+            time.sleep(0.2)
+            bodies.append(requests.post(server.url + '/fr/caisse-epargne/login').content)
+
+        # Then, the burst then a request per 200 ms, the others answered by the blocked login page
+        login, blocked = load_mock('login_success_auth_3ds_needed')[2], load_mock('login_blocked')[2]
+        self.assertEqual([login] * 3 + [blocked] * 2 + [login], bodies)
+        self.assertEqual(2, server.blocked)
+
+    def test_latency_with_jitter(self):
+
+        # Given
+        with StubServer(t3ds_mobile_routes, delay=0.02, jitter=0.01, seed=1) as server:
+
+            # When
+            elapsed = [requests.post(server.url + self.polling_path).elapsed.total_seconds() for _ in range(5)]
+
+        # Then
+        self.assertTrue(all(0.01 <= value < 0.1 for value in elapsed))
+        self.assertGreater(max(elapsed) - min(elapsed), 0.001)
+
+    def test_handshake_and_keepalive(self):
+
+        # Given
+        with StubServer(t3ds_mobile_routes, handshake=0.05, keepalive=0.05) as server, requests.Session() as session:
+
+            # When
+            elapsed = [session.post(server.url + self.polling_path).elapsed.total_seconds() for _ in range(2)]
+            time.sleep(0.1)
+            session.post(server.url + self.polling_path)
+
+        # Then, only the first request of a connection waits for the handshake, and idle connections are closed
+        self.assertGreaterEqual(elapsed[0], 0.05)
+        self.assertLess(elapsed[1], 0.05)
+        self.assertEqual(2, server.connections)
+
+    def test_flows_requests(self):
+
+        # Given
+        with patch.object(ecard_bench, 'flow_latency', 0.0), patch.object(ecard_bench, 'flow_jitter', 0.0):
+
+            # When
+            rows = ecard_bench.bench_flows(2)
+
+        # Then, a regression gate on the number of requests of each flow
+        self.assertEqual([['login', '0', '2.0'], ['login + otp 3ds', '0', '10.0'], ['login + mobile 3ds', '0', '11.0'],
+                          ['generate', '0', '1.0'], ['historic', '0', '1.0']],
+                         [[row[0], row[2], row[6]] for row in rows[1:]])
+
+
+if __name__ == '__main__':
+    unittest.main()
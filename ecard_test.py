@@ -1,12 +1,31 @@
 #!/usr/bin/python3
 
+import argparse
+import contextlib
+import io
 import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest.mock
+import urllib.parse
+from datetime import date
+from decimal import Decimal
 from unittest import mock
 from unittest.mock import patch, DEFAULT
 
+import requests
+
 import ecard
-from ecard import ECardManager
+import ecard_historic
+import ecard_pages
+from ecard import ECard, ECardManager, HistoricStore, PollingScheduler, SessionCache, SessionPool
+from ecard_bench import import_times
+from ecard_client import BankProfile, BankRegistry, CircuitBreaker, HttpTransport, RequestScheduler, RetryPolicy, \
+    background
+from ecard_pages import HistoricBatch
+from ecard_stub import StubServer, bank_routes, t3ds_routes
 
 
 def mocked_requests_response(*args, **kwargs):
@@ -41,11 +60,25 @@ def mocked_requests_response(*args, **kwargs):
     return MockResponse(status_code, headers, cookies, body)
 
 
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+
+
+# the requests are mocked, don't open connections to the real hosts
+@patch.object(ecard, 'prefetch_connections', False)
 class ECardTest(unittest.TestCase):
     bank_host = 'https://service.e-cartebleue.com/fr/caisse-epargne'
     t3ds_host = 'https://natixispaymentsolutions-3ds-vdm.wlp-acs.com'
+    timeout = (ecard.http_connect_timeout, ecard.http_read_timeout)
 
-    @patch('requests.post', side_effect=[mocked_requests_response('login_success')])
+    @patch('requests.Session.post', side_effect=[mocked_requests_response('login_success')])
     def test_do_login_success(self, mock_post):
 
         # Given
@@ -67,10 +100,10 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/x-www-form-urlencoded'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, data=expected_data, headers=expected_headers),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, data=expected_data, headers=expected_headers),
                          mock_post.call_args_list[0])
 
-    @patch('requests.post', side_effect=[mocked_requests_response('login_failed')])
+    @patch('requests.Session.post', side_effect=[mocked_requests_response('login_failed')])
     def test_do_login_failed(self, mock_post):
 
         # Given
@@ -95,10 +128,10 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/x-www-form-urlencoded'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, data=expected_data, headers=expected_headers),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, data=expected_data, headers=expected_headers),
                          mock_post.call_args_list[0])
 
-    @patch('requests.post', side_effect=[mocked_requests_response('login_blocked')])
+    @patch('requests.Session.post', side_effect=[mocked_requests_response('login_blocked')])
     def test_do_login_blocked(self, mock_post):
 
         # Given
@@ -125,10 +158,10 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/x-www-form-urlencoded'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, data=expected_data, headers=expected_headers),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, data=expected_data, headers=expected_headers),
                          mock_post.call_args_list[0])
 
-    @patch('requests.get', side_effect=[mocked_requests_response('logout')])
+    @patch('requests.Session.get', side_effect=[mocked_requests_response('logout')])
     def test_do_logout(self, mock_get):
 
         # Given
@@ -144,13 +177,29 @@ class ECardTest(unittest.TestCase):
         # assert mocked being called with the right parameters
         expected_url = self.bank_host + '/logout'
         expected_headers = {
-            'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
-            'Cookie': 'JSESSIONID=1234567890ABCDEF1234567890ABCDEF; eCarteBleue-pref=open'
+            'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers),
                          mock_get.call_args_list[0])
 
-    @patch('requests.post', side_effect=[mocked_requests_response('generate_ecard_success')])
+    def test_session_cookies_sent_to_bank_host_only(self):
+
+        # Given
+        e_card_manager = ECardManager()
+
+        # When
+        e_card_manager.jsessionid = '1234567890ABCDEF1234567890ABCDEF'
+
+        # Then
+        session = e_card_manager.transport.session
+        bank_request = session.prepare_request(requests.Request('POST', self.bank_host + '/cpn'))
+        self.assertIn('JSESSIONID=1234567890ABCDEF1234567890ABCDEF', bank_request.headers['Cookie'])
+        self.assertIn('eCarteBleue-pref=open', bank_request.headers['Cookie'])
+
+        t3ds_request = session.prepare_request(requests.Request('POST', self.t3ds_host + '/acs-pa-service/pa/paRequest'))
+        self.assertNotIn('Cookie', t3ds_request.headers)
+
+    @patch('requests.Session.post', side_effect=[mocked_requests_response('generate_ecard_success')])
     def test_generate_ecard_success(self, mock_post):
 
         # Given
@@ -173,14 +222,92 @@ class ECardTest(unittest.TestCase):
         expected_data = 'request=ocode&token=9876543210&montant=10.54&devise=1.000000&dateValidite=3'
         expected_headers = {
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Cookie': 'JSESSIONID=1234567890ABCDEF1234567890ABCDEF; eCarteBleue-pref=open'
+            'Content-Type': 'application/x-www-form-urlencoded'
         }
 
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, data=expected_data, headers=expected_headers),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, data=expected_data, headers=expected_headers),
                          mock_post.call_args_list[0])
 
-    @patch('requests.post', side_effect=[mocked_requests_response('login_success_auth_3ds_needed')])
+    def test_page_schema_missing_fields(self):
+
+        # Given
+        html = mocked_requests_response('login_success').text
+
+        # When
+        with self.assertRaises(Exception) as context:
+            ECardManager.parse_ecard_page(html)
+
+        # Then
+        self.assertEqual('Unexpected e-number page, number, expired_at, cvv, owner not found.', str(context.exception))
+
+    @patch('requests.Session.post', side_effect=[mocked_requests_response('generate_ecard_success')])
+    def test_batch_action_stdin(self, mock_post):
+
+        # Given, the lines of the batch read from stdin
+        e_card_manager = ECardManager()
+        e_card_manager.token = '0123456789'
+        args = argparse.Namespace(batch=io.StringIO('10.54,1.000000,3\n'), expire_in='3')
+        stdout = io.StringIO()
+
+        # When
+        with patch('sys.stdin', args.batch), contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(io.StringIO()):
+            ecard.ActionBatch.do_action(args, e_card_manager)
+
+        # Then, stdin is left open
+        self.assertEqual('1234567890123456', json.loads(stdout.getvalue())['number'])
+        self.assertFalse(args.batch.closed)
+
+    def test_batch_file_checked_before_login(self):
+
+        # When
+        process = subprocess.run([sys.executable, 'ecard.py', '-b', 'missing.csv'], stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        # Then, rejected by the command line, without looking up the credentials
+        self.assertEqual(2, process.returncode)
+        self.assertIn("can't open 'missing.csv'", process.stderr.decode('utf-8'))
+        self.assertEqual(b'', process.stdout)
+
+    @patch('requests.Session.post', side_effect=[mocked_requests_response('generate_ecard_success'),
+                                                 mocked_requests_response('login_failed'),
+                                                 mocked_requests_response('generate_ecard_success')])
+    @patch('requests.Session.get', side_effect=[mocked_requests_response('login_success')])
+    def test_generate_batch(self, mock_get, mock_post):
+
+        # Given
+        e_card_manager = ECardManager()
+        e_card_manager.jsessionid = '1234567890ABCDEF1234567890ABCDEF'
+        e_card_manager.token = '0123456789'
+        lines = ['amount,currency,validity\n',
+                 '10.54,1.000000,3\n',
+                 '-1\n',
+                 '{"amount": "20", "validity": "6"}\n',
+                 '\n',
+                 '5.00,,24\n']
+
+        # When
+        results = list(ecard.generate_batch(e_card_manager, lines, '3'))
+
+        # Then
+        self.assertEqual(4, len(results))
+        self.assertEqual({'line': 2, 'amount': '10.54', 'currency': '1.000000', 'validity': '3',
+                          'number': '1234567890123456', 'expired_at': '01/23', 'cvv': '123', 'owner': 'M XXXXX YYYYY'},
+                         results[0])
+        self.assertEqual({'line': 3, 'error': 'invalid line: amount must be greater than 0'}, results[1])
+        self.assertEqual({'line': 4, 'amount': '20', 'currency': '1.000000', 'validity': '6',
+                          'error': 'Votre identification est incorrecte.'}, results[2])
+        self.assertEqual('1234567890123456', results[3]['number'])
+        self.assertEqual('24', results[3]['validity'])
+
+        # the token is refreshed from each result page, and after the failure
+        self.assertEqual('request=ocode&token=0123456789&montant=10.54&devise=1.000000&dateValidite=3',
+                         mock_post.call_args_list[0][1]['data'])
+        self.assertEqual('request=ocode&token=9876543210&montant=20&devise=1.000000&dateValidite=6',
+                         mock_post.call_args_list[1][1]['data'])
+        self.assertEqual(self.bank_host + '/payer', mock_get.call_args_list[0][0][0])
+
+    @patch('requests.Session.post', side_effect=[mocked_requests_response('login_success_auth_3ds_needed')])
     def test_do_login_success_auth_3ds_needed(self, mock_post):
 
         # Given
@@ -205,11 +332,11 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/x-www-form-urlencoded'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, data=expected_data, headers=expected_headers),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, data=expected_data, headers=expected_headers),
                          mock_post.call_args_list[0])
 
     @patch('builtins.input', return_value='12345678')
-    @patch.multiple('requests', post=DEFAULT, get=DEFAULT)
+    @patch.multiple('requests.Session', post=DEFAULT, get=DEFAULT)
     def test_auth_3ds_otp_sms(self, mock_input, **mocks):
 
         # Given
@@ -244,7 +371,7 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/x-www-form-urlencoded'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=False, data=expected_data, headers=expected_headers),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=False, data=expected_data, headers=expected_headers),
                          mocks['post'].call_args_list[0])
 
         # 1.2 check PaRequest redirection
@@ -252,7 +379,7 @@ class ECardTest(unittest.TestCase):
         expected_headers = {
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers),
                          mocks['get'].call_args_list[0])
 
         # 2. check getSession
@@ -263,7 +390,7 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/json'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[1])
 
         # 3. check startAuthent
@@ -273,7 +400,7 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/json'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[2])
 
         # 4. check updateAuthent
@@ -284,7 +411,7 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/json'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[3])
 
         # 5. check endAuthent
@@ -294,7 +421,7 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/json'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[4])
 
         # 6. check paRequestFromAuthPages
@@ -305,7 +432,7 @@ class ECardTest(unittest.TestCase):
             'Content-Type': 'application/x-www-form-urlencoded',
             'Upgrade-Insecure-Requests': '1'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[5])
 
         # finally, check received3ds
@@ -314,13 +441,12 @@ class ECardTest(unittest.TestCase):
         expected_headers = {
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/x-www-form-urlencoded',
-            'Cookie': 'JSESSIONID=1234567890ABCDEF1234567890ABCDEF; eCarteBleue-pref=open',
             'Upgrade-Insecure-Requests': '1'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[6])
 
-    @patch.multiple('requests', post=DEFAULT, get=DEFAULT)
+    @patch.multiple('requests.Session', post=DEFAULT, get=DEFAULT)
     def test_auth_3ds_mobile_app(self, **mocks):
 
         # Given
@@ -356,7 +482,7 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/x-www-form-urlencoded'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=False, data=expected_data, headers=expected_headers),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=False, data=expected_data, headers=expected_headers),
                          mocks['post'].call_args_list[0])
 
         # 1.2 check PaRequest redirection
@@ -364,7 +490,7 @@ class ECardTest(unittest.TestCase):
         expected_headers = {
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers),
                          mocks['get'].call_args_list[0])
 
         # 2. check getSession
@@ -375,7 +501,7 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/json'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[1])
 
         # 3. check startAuthent
@@ -385,7 +511,7 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/json'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[2])
 
         # 4. check startAuthent
@@ -396,10 +522,10 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/json'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[3])
 
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[4])
 
         # 5. check endAuthent
@@ -409,7 +535,7 @@ class ECardTest(unittest.TestCase):
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/json'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[5])
 
         # 6. check paRequestFromAuthPages
@@ -420,7 +546,7 @@ class ECardTest(unittest.TestCase):
             'Content-Type': 'application/x-www-form-urlencoded',
             'Upgrade-Insecure-Requests': '1'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[6])
 
         # finally, check received3ds
@@ -429,13 +555,88 @@ class ECardTest(unittest.TestCase):
         expected_headers = {
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
             'Content-Type': 'application/x-www-form-urlencoded',
-            'Cookie': 'JSESSIONID=1234567890ABCDEF1234567890ABCDEF; eCarteBleue-pref=open',
             'Upgrade-Insecure-Requests': '1'
         }
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, headers=expected_headers, data=expected_data),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers, data=expected_data),
                          mocks['post'].call_args_list[7])
 
-    @patch('requests.post', side_effect=[mocked_requests_response('historic')])
+    @patch('requests.Session.post', side_effect=[mocked_requests_response('auth_3ds_41_startpolling_waiting'),
+                                                 mocked_requests_response('auth_3ds_41_startpolling_waiting'),
+                                                 mocked_requests_response('auth_3ds_41_startpolling_ok')])
+    def test_auth_by_mobile_app_time_to_success(self, mock_post):
+
+        # Given
+        clock = FakeClock()
+        polling = PollingScheduler(first_interval=0.5, factor=2, jitter=0, clock=clock.time, sleep=clock.sleep)
+        e_card_manager = ECardManager(polling=polling)
+
+        # When
+        e_card_manager.auth_by_mobile_app({}, 'accid1234567890-1234567890', 'hubsessid-1234567890', 'hubao-1234567890')
+
+        # Then
+        self.assertEqual(3, mock_post.call_count)
+        # 0.5 + 1 + 2 seconds, instead of 3 times 5 seconds with the former fixed delay
+        self.assertEqual(3.5, clock.now)
+
+    @patch('requests.Session.post', side_effect=[mocked_requests_response('auth_3ds_41_startpolling_waiting'),
+                                                 mocked_requests_response('auth_3ds_41_startpolling_ko')])
+    def test_auth_by_mobile_app_failed(self, mock_post):
+
+        # Given
+        clock = FakeClock()
+        polling = PollingScheduler(clock=clock.time, sleep=clock.sleep)
+        e_card_manager = ECardManager(polling=polling)
+
+        # When
+        with self.assertRaises(Exception) as context:
+            e_card_manager.auth_by_mobile_app({}, 'accid1234567890-1234567890', 'hubsessid-1234567890',
+                                              'hubao-1234567890')
+
+        # Then
+        self.assertIn('AUTHENTICATION ERROR', str(context.exception))
+        self.assertEqual(2, mock_post.call_count)
+
+    @patch('requests.Session.post', side_effect=lambda *args, **kwargs:
+           mocked_requests_response('auth_3ds_41_startpolling_waiting'))
+    def test_auth_by_mobile_app_deadline(self, mock_post):
+
+        # Given
+        clock = FakeClock()
+        polling = PollingScheduler(max_interval=5, deadline=60, clock=clock.time, sleep=clock.sleep)
+        e_card_manager = ECardManager(polling=polling)
+
+        # When
+        with self.assertRaises(Exception) as context:
+            e_card_manager.auth_by_mobile_app({}, 'accid1234567890-1234567890', 'hubsessid-1234567890',
+                                              'hubao-1234567890')
+
+        # Then
+        self.assertIn('Authentication time out.', str(context.exception))
+        self.assertEqual(60, clock.now)
+        self.assertLess(mock_post.call_count, 25)
+
+    @patch('requests.Session.post')
+    def test_auth_by_mobile_app_cancelled(self, mock_post):
+
+        # Given
+        polling = PollingScheduler(first_interval=0.01)
+        e_card_manager = ECardManager(polling=polling)
+
+        def cancel_while_waiting(*args, **kwargs):
+            polling.cancel()
+            return mocked_requests_response('auth_3ds_41_startpolling_waiting')
+        mock_post.side_effect = cancel_while_waiting
+
+        # When
+        with self.assertRaises(Exception) as context:
+            e_card_manager.auth_by_mobile_app({}, 'accid1234567890-1234567890', 'hubsessid-1234567890',
+                                              'hubao-1234567890')
+
+        # Then
+        self.assertIn('Authentication canceled.', str(context.exception))
+        self.assertEqual(1, mock_post.call_count)
+
+    @patch('requests.Session.post', side_effect=[mocked_requests_response('historic')])
     def test_historic(self, mock_post):
 
         # Given
@@ -455,11 +656,10 @@ class ECardTest(unittest.TestCase):
         expected_data = 'token=9876543210'
         expected_headers = {
             'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*',
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Cookie': 'JSESSIONID=1234567890ABCDEF1234567890ABCDEF; eCarteBleue-pref=open'
+            'Content-Type': 'application/x-www-form-urlencoded'
         }
 
-        self.assertEqual(mock.call(expected_url, allow_redirects=True, data=expected_data, headers=expected_headers),
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, data=expected_data, headers=expected_headers),
                          mock_post.call_args_list[0])
 
         # print table
@@ -467,5 +667,487 @@ class ECardTest(unittest.TestCase):
         table_formatter.set_rows(all_historic)
         print(table_formatter)
 
+    def test_iter_historic_entries(self):
+
+        # Given
+        html = mocked_requests_response('historic').text
+        error_html = mocked_requests_response('login_failed').text
+
+        # When
+        entries = list(ECardManager.iter_historic_entries(ECardManager.chunks(html, 1024)))
+        recent = list(ECardManager.iter_historic_entries(ECardManager.chunks(html, 1024), since=date(2020, 11, 29)))
+        first = list(ECardManager.iter_historic_entries(ECardManager.chunks(html, 1024), limit=2))
+
+        # Then
+        self.assertEqual(8, len(entries))
+        self.assertEqual([date(2020, 12, 8), 'ESHOP', '1234 5678 9012 0006', Decimal('204.26'), Decimal('204.26'), True],
+                         list(entries[0].as_dict().values()))
+        self.assertEqual([(False, None)], [(entry.used, entry.amount) for entry in entries if entry.merchant is None])
+        self.assertEqual([date(2020, 12, 8), date(2020, 12, 5), date(2020, 12, 5), date(2020, 11, 29), date(2020, 12, 6)],
+                         [entry.date for entry in recent])
+        self.assertEqual(['1234 5678 9012 0006', '1234 5678 9012 0002'], [entry.number for entry in first])
+        with self.assertRaises(Exception) as context:
+            list(ECardManager.iter_historic_entries(ECardManager.chunks(error_html, 1024)))
+        self.assertEqual('Votre identification est incorrecte.', str(context.exception))
+
+    def test_historic_batch(self):
+
+        # Given
+        entries = ECardManager.parse_historic_entries(mocked_requests_response('historic').text)
+
+        # When
+        batch = HistoricBatch(entries)
+
+        # Then
+        self.assertEqual(8, len(batch))
+        self.assertEqual({'ESHOP': Decimal('204.26'), 'ANOTHER SHOP': Decimal('250.18'), 'A SHOP': Decimal('42.00'),
+                          'WONDERFUL SHOP 8': Decimal('51.50'), 'TINY SHOP': Decimal('1012.00'),
+                          'FOREIGN SHOP CO': Decimal('99.74')}, batch.spend_by_merchant())
+        self.assertEqual({'2020-12': Decimal('125.94'), '2020-11': Decimal('1533.74')}, batch.spend_by_month())
+        self.assertEqual(Decimal('1012.00'), ecard_pages.parse_amount('1\xa0012,00 €'))
+        self.assertEqual('-120,32 €', ecard_pages.format_amount(ecard_pages.parse_amount('-120,32 €')))
+        self.assertEqual(date(2020, 12, 8), ecard_pages.parse_date('08/12/2020'))
+
+    def test_write_records(self):
+
+        # Given
+        html = mocked_requests_response('historic').text
+        e_card = ECard('1234567890123456', '12/24', '123', 'JOHN DOE')
+
+        # When
+        outputs = {}
+        for output_format in ['json', 'ndjson', 'csv']:
+            outputs[output_format] = io.StringIO()
+            ecard.write_records(ECardManager.iter_historic_entries(ECardManager.chunks(html, 1024)),
+                                ('date', 'merchant', 'used'), output_format, outputs[output_format])
+        empty = io.StringIO()
+        ecard.write_records([], ('date',), 'json', empty)
+
+        # Then
+        entries = json.loads(outputs['json'].getvalue())
+        self.assertEqual(8, len(entries))
+        self.assertEqual({'date': '2020-12-08', 'merchant': 'ESHOP', 'number': '1234 5678 9012 0006',
+                          'ceiling': '204.26', 'amount': '204.26', 'used': True}, entries[0])
+        self.assertEqual(entries, [json.loads(line) for line in outputs['ndjson'].getvalue().splitlines()])
+        lines = outputs['csv'].getvalue().splitlines()
+        self.assertEqual(['date,merchant,used', '2020-12-08,ESHOP,true'], lines[:2])
+        self.assertEqual(9, len(lines))
+        self.assertEqual([], json.loads(empty.getvalue()))
+        self.assertEqual('Card number : 1234567890123456\nExpired at  : 12/24\nCVV         : 123\nOwner       : JOHN DOE',
+                         str(e_card))
+        with self.assertRaises(AttributeError):
+            e_card.brand = 'visa'
+
+    @patch('requests.Session.get', side_effect=[mocked_requests_response('login_success')])
+    def test_resume_session_alive(self, mock_get):
+
+        # Given
+        e_card_manager = ECardManager()
+        session = {'jsessionid': '1234567890ABCDEF1234567890ABCDEF', 'token': '0123456789', 'auth_3ds_completed': True}
+
+        # When
+        alive = e_card_manager.resume_session(session)
+
+        # Then
+        self.assertEqual(True, alive)
+        self.assertEqual('1234567890ABCDEF1234567890ABCDEF', e_card_manager.jsessionid)
+        self.assertEqual('9876543210', e_card_manager.token)
+        self.assertEqual(False, e_card_manager.auth_3ds_needed)
+
+        expected_url = self.bank_host + '/payer'
+        expected_headers = {
+            'User-Agent': 'ecartebleue-python/' + ecard.__version__, 'Accept': '*/*'
+        }
+        self.assertEqual(mock.call(expected_url, timeout=self.timeout, allow_redirects=True, headers=expected_headers),
+                         mock_get.call_args_list[0])
+
+    @patch('requests.Session.post', side_effect=[mocked_requests_response('login_success')])
+    @patch('requests.Session.get', side_effect=[mocked_requests_response('logout')])
+    def test_resume_session_stale(self, mock_get, mock_post):
+
+        # Given
+        with tempfile.TemporaryDirectory() as directory:
+            session_cache = SessionCache(directory)
+            session_cache.save('joint', 'password', {
+                'jsessionid': 'EXPIRED567890ABCDEF1234567890ABCDEF', 'token': '0123456789', 'auth_3ds_completed': True
+            })
+            session = session_cache.load('joint', 'password')
+        e_card_manager = ECardManager()
+
+        # When
+        alive = e_card_manager.resume_session(session)
+        if not alive:
+            e_card_manager.do_login('login', 'password')
+
+        # Then
+        self.assertEqual(False, alive)
+        self.assertEqual(1, mock_get.call_count)
+        self.assertEqual(1, mock_post.call_count)
+        self.assertEqual('1234567890ABCDEF1234567890ABCDEF', e_card_manager.jsessionid)
+        self.assertEqual('9876543210', e_card_manager.token)
+
+    def test_cli_startup_imports(self):
+
+        # When
+        cli = import_times('ecard.py', '-V')
+        client = import_times('-c', 'import ecard_client')
+
+        # Then, the http client and the parsers are only loaded by the network actions
+        for module in ['requests', 'urllib3', 'lxml', 'sqlite3', 'ecard_client', 'ecard_pages']:
+            self.assertNotIn(module, cli)
+            self.assertIn(module, client)
+        self.assertLess(import_times('-c', 'import ecard')['ecard'], client['ecard_client'] / 2)
+
+    def test_bank_profiles(self):
+
+        # Given
+        bank_profiles = {'sg': {'t3ds_host': 'https://acs.example.com', 'endpoints': {'historic': '/historique'}}}
+
+        with patch.object(ecard, 'bank_profiles', bank_profiles):
+            # When
+            banks = BankRegistry()
+            sg = banks.manager('sg')
+            other_sg = banks.manager('sg')
+            caisse_epargne = banks.manager()
+
+            # Then, the urls of each bank, and a pool per bank, shared by its sessions with their own cookies
+            self.assertEqual('https://service.e-cartebleue.com/fr/sg/historique', sg.url('historic'))
+            self.assertEqual('https://acs.example.com/acs-pa-service/pa/paRequest', sg.url('paRequest'))
+            self.assertEqual('https://service.e-cartebleue.com/fr/caisse-epargne/cpn', caisse_epargne.url('cpn'))
+            self.assertEqual(self.t3ds_host + '/acs-auth-pages/authent/pages/endAuthent',
+                             caisse_epargne.url('endAuthent'))
+            self.assertIs(sg.bank, other_sg.bank)
+            self.assertIs(sg.transport.pool, other_sg.transport.pool)
+            self.assertIsNot(sg.transport.pool, caisse_epargne.transport.pool)
+            sg.jsessionid = '1234567890ABCDEF1234567890ABCDEF'
+            self.assertIsNone(other_sg.jsessionid)
+            with self.assertRaises(Exception) as context:
+                BankProfile('sg', endpoints={'generate': '/generer'})
+            self.assertEqual('Unknown endpoints for bank sg: generate', str(context.exception))
+
+    def test_session_cache(self):
+
+        # Given
+        session = {'jsessionid': '1234567890ABCDEF1234567890ABCDEF', 'token': '9876543210', 'auth_3ds_completed': True}
+
+        with tempfile.TemporaryDirectory() as directory:
+            # When
+            SessionCache(directory).save('joint', 'password', session)
+
+            # Then
+            self.assertEqual(session, SessionCache(directory).load('joint', 'password'))
+            self.assertEqual(None, SessionCache(directory).load('joint', 'wrong password'))
+            self.assertEqual(None, SessionCache(directory).load('another card', 'password'))
+            self.assertEqual(None, SessionCache(directory, ttl=-1).load('joint', 'password'))
+            with open(SessionCache(directory).path('joint')) as cache_file:
+                self.assertNotIn('1234567890ABCDEF1234567890ABCDEF', cache_file.read())
+
+    def test_session_pool(self):
+
+        # Given, sessions whose session is alive until expired is set
+        def connect():
+            e_card_manager = mock.Mock(expired=False)
+            e_card_manager.refresh_token.side_effect = lambda: not e_card_manager.expired
+            return e_card_manager
+
+        def generate(e_card_manager):
+            if e_card_manager.expired:
+                raise Exception('session expired')
+            return e_card_manager
+
+        pool = SessionPool(connect, size=2, keepalive_interval=3600)
+
+        # When
+        pool.warm_up()
+        first = pool.acquire()
+        second = pool.acquire()
+        with self.assertRaises(Exception):
+            pool.acquire(timeout=0.01)
+        pool.release(first)
+        pool.release(second)
+
+        # Then, the most recently released session is handed out first
+        self.assertIs(second, pool.run(generate))
+
+        # When, the session expired meanwhile
+        second.expired = True
+        third = pool.run(generate)
+
+        # Then, it is evicted, the call runs on the other session, and the warm pool logs in a new one
+        self.assertIs(first, third)
+        pool.warm_up()
+        pool.keepalive_interval = 0
+        pool.ping_idle()
+        stats = pool.stats()
+        self.assertEqual((2, 2, 5, 1, 3, 1, 2), (stats['sessions'], stats['idle'], stats['hits'], stats['misses'],
+                                                  stats['logins'], stats['evictions'], stats['keepalives']))
+        self.assertEqual(0.833, stats['hit_rate'])
+
+        # When
+        pool.close()
+
+        # Then, the idle sessions are logged out
+        first.do_logout.assert_called_once_with()
+        second.do_logout.assert_not_called()
+        self.assertEqual(0, pool.stats()['sessions'])
+
+    def test_historic_store_sync(self):
+
+        # Given
+        entries = ECardManager.parse_historic_entries(mocked_requests_response('historic').text)
+        store = HistoricStore('joint', ':memory:')
+
+        # When
+        first_sync = store.sync(entries)
+        second_sync = store.sync(entries)
+        # the unused e-number has been used since
+        entries[-1].merchant, entries[-1].amount, entries[-1].used = 'LAST SHOP', Decimal('46.87'), True
+        third_sync = store.sync(entries)
+
+        # Then
+        self.assertEqual(8, first_sync)
+        self.assertEqual(0, second_sync)
+        self.assertEqual(1, third_sync)
+        self.assertEqual(8, len(store.query()))
+        self.assertEqual([], store.query(used=False))
+
+    @patch.dict(os.environ, {'ECARD_JOINT_LOGIN': 'login', 'ECARD_JOINT_PASSWORD': 'password'})
+    def test_historic_sync_run(self):
+
+        with contextlib.ExitStack() as stack:
+            # Given, the namespace of ecard_historic.py sync, without the options of ecard.py
+            directory = stack.enter_context(tempfile.TemporaryDirectory())
+            bank_server = stack.enter_context(StubServer(bank_routes))
+            t3ds_server = stack.enter_context(StubServer(t3ds_routes))
+            stack.enter_context(patch.object(ecard, 'service_url', bank_server.url + '/fr/'))
+            stack.enter_context(patch.object(ecard, 't3ds_host', t3ds_server.url))
+            stack.enter_context(patch.object(ecard, 'historic_store_path', os.path.join(directory, 'historic.db')))
+            stack.enter_context(patch.object(ecard, 'credentials_provider', 'env'))
+            stack.enter_context(patch.object(ecard, 'prefetch_connections', False))
+            stack.enter_context(patch('builtins.input', return_value='12345678'))
+            stdout = stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            args = ecard_historic.argument_parser().parse_args(['sync'])
+
+            # When, run() exits once done
+            with self.assertRaises(SystemExit):
+                ecard.run(args, ecard_historic.action_sync)
+
+            # Then
+            self.assertIn('new rows in the historic of joint', stdout.getvalue())
+            self.assertNotIn('attribute', stdout.getvalue())
+            self.assertGreater(len(HistoricStore('joint').query()), 0)
+
+    def test_historic_store_query(self):
+
+        # Given
+        store = HistoricStore('joint', ':memory:')
+        store.sync(ECardManager.parse_historic_entries(mocked_requests_response('historic').text))
+        store.add_ecard(ECard('1234567890123456', '01/23', '123', 'M XXXXX YYYYY'), '10.54', date(2020, 12, 10))
+
+        # When
+        december = store.query(start=date(2020, 12, 1), end=date(2020, 12, 31))
+        another_shop = store.query(merchant='another')
+        over_100 = store.query(min_amount=10000, used=True)
+
+        # Then
+        self.assertEqual(['2020-12-10', '2020-12-08', '2020-12-06', '2020-12-05', '2020-12-05'],
+                         [row['date'] for row in december])
+        self.assertEqual([-12032, 37050], sorted(row['amount'] for row in another_shop))
+        self.assertEqual(['1234567890120006', '1234567890120002', '1234567890120001'],
+                         [row['number'] for row in over_100])
+        self.assertEqual({'date': date(2020, 12, 10), 'merchant': None, 'number': '1234 5678 9012 3456',
+                          'ceiling': Decimal('10.54'), 'amount': None, 'used': False},
+                         HistoricStore.to_entry(december[0]).as_dict())
+        self.assertEqual(Decimal('-120.32'), HistoricStore.to_entry(another_shop[0]).amount)
+
+    def test_historic_store_stats(self):
+
+        # Given
+        entries = ECardManager.parse_historic_entries(mocked_requests_response('historic').text)
+        store = HistoricStore('joint', ':memory:')
+        store.sync(entries)
+        pro_store = HistoricStore('pro', ':memory:')
+        pro_store.connection = store.connection
+        pro_store.sync(entries[:3])
+
+        # When
+        by_month = store.batch().stats('month')
+        by_card = store.batch(all_cards=True).stats('card')
+        by_merchant = store.batch(start=date(2020, 12, 1)).stats('merchant')
+
+        # Then
+        self.assertEqual([('2020-12', 4, 3, Decimal('125.94'), Decimal('46.87')),
+                          ('2020-11', 4, 4, Decimal('1533.74'), Decimal('0.00'))],
+                         [tuple(stats.as_dict().values()) for stats in by_month])
+        self.assertEqual([('joint', 8, Decimal('1659.68')), ('pro', 3, Decimal('125.94'))],
+                         [(stats.key, stats.count, stats.spent) for stats in by_card])
+        self.assertEqual(['ESHOP', 'A SHOP', None, 'ANOTHER SHOP'], [stats.key for stats in by_merchant])
+        with self.assertRaises(Exception) as context:
+            store.batch().stats('week')
+        self.assertEqual('Unknown group: week, expected one of merchant, month, card', str(context.exception))
+
+    @patch('requests.Session.post', side_effect=[mocked_requests_response('generate_ecard_success')])
+    def test_generate_ecard_recorded_in_store(self, mock_post):
+
+        # Given
+        e_card_manager = ECardManager()
+        e_card_manager.token = '9876543210'
+        e_card_manager.store = HistoricStore('joint', ':memory:')
+
+        # When
+        e_card_manager.generate_ecard('10.54', '1.000000', '3')
+
+        # Then
+        rows = e_card_manager.store.query(used=False)
+        self.assertEqual([{'date': date.today().isoformat(), 'merchant': None, 'number': '1234567890123456',
+                           'ceiling': 1054, 'amount': None, 'used': 0}], rows)
+
     if __name__ == '__main__':
         unittest.main()
+
+
+class HttpPolicyTest(unittest.TestCase):
+
+    def transport(self, breaker=None) -> HttpTransport:
+        transport = HttpTransport(breaker=breaker or CircuitBreaker())
+        transport.sleep = lambda delay: None
+        self.addCleanup(transport.close)
+        return transport
+
+    def test_retry_idempotent_requests(self):
+
+        # Given
+        with StubServer(bank_routes, error_rate=0.5, seed=3) as server:
+            transport = self.transport()
+            base = server.url + '/fr/caisse-epargne'
+
+            # When
+            statuses = [transport.get(base + '/payer', {}).status_code for _ in range(5)]
+            historic = transport.post(base + '/historic', {}, '').status_code
+            server.server.error_rate = 1.0
+            requests_before = server.requests
+            cpn = transport.post(base + '/cpn', {}, '').status_code
+
+        # Then, the 503 errors of the GETs and of the historic are retried, not the one of the cpn
+        self.assertEqual([200] * 5, statuses)
+        self.assertEqual(200, historic)
+        self.assertEqual(503, cpn)
+        self.assertEqual(requests_before + 1, server.requests)
+        stats = transport.breaker.stats()[urllib.parse.urlparse(server.url).netloc]
+        self.assertEqual(server.errors, stats['failures'])
+        self.assertEqual(server.errors - 1, stats['retries'])
+
+    def test_retry_connection_errors(self):
+
+        # Given
+        with StubServer(bank_routes, reset_rate=1.0) as server:
+            transport = self.transport()
+            base = server.url + '/fr/caisse-epargne'
+
+            # When, the connection is closed once the request is sent
+            with self.assertRaises(requests.ConnectionError):
+                transport.get(base + '/payer', {})
+            get_requests = server.requests
+            with self.assertRaises(requests.ConnectionError):
+                transport.post(base + '/cpn', {}, '')
+
+        # Then, a GET is retried, a POST that may have been processed isn't
+        self.assertEqual(1 + ecard.http_retries, get_requests)
+        self.assertEqual(get_requests + 1, server.requests)
+
+        # a POST refused before being sent is retried
+        transport = self.transport()
+        with self.assertRaises(requests.ConnectionError):
+            transport.post(base + '/cpn', {}, '')
+        self.assertEqual(ecard.http_retries, transport.breaker.stats()[urllib.parse.urlparse(base).netloc]['retries'])
+
+    def test_read_timeout(self):
+
+        # Given
+        with StubServer(bank_routes, delay=0.2) as server:
+            transport = self.transport()
+            transport.policies['historic'] = RetryPolicy(read_timeout=0.05, retries=1, idempotent=True)
+
+            # When
+            with self.assertRaises(requests.Timeout):
+                transport.post(server.url + '/fr/caisse-epargne/historic', {}, '')
+
+        # Then
+        stats = transport.breaker.stats()[urllib.parse.urlparse(server.url).netloc]
+        self.assertEqual((2, 2, 1), (stats['failures'], stats['timeouts'], stats['retries']))
+
+    def test_circuit_breaker(self):
+
+        # Given
+        clock = FakeClock()
+        with StubServer(bank_routes, error_rate=1.0) as server:
+            transport = self.transport(CircuitBreaker(failures=3, reset_timeout=10, clock=clock.time))
+            url = server.url + '/fr/caisse-epargne/payer'
+            host = urllib.parse.urlparse(url).netloc
+
+            # When, the bank fails
+            self.assertEqual(503, transport.get(url, {}).status_code)
+            with self.assertRaises(Exception) as context:
+                transport.get(url, {})
+            requests_when_open = server.requests
+            # then recovers, after the reset timeout
+            clock.sleep(10)
+            server.server.error_rate = 0.0
+            status = transport.get(url, {}).status_code
+
+        # Then
+        self.assertEqual(3, requests_when_open)
+        self.assertEqual('Circuit breaker open for ' + host + ' after 3 failed requests, retry in 10 s',
+                         str(context.exception))
+        self.assertEqual(200, status)
+        self.assertEqual({'state': 'closed', 'failures_in_row': 0, 'requests': 4, 'failures': 3, 'timeouts': 0,
+                          'retries': 2, 'rejected': 1, 'opens': 1}, transport.breaker.stats()[host])
+
+    def test_circuit_breaker_trial_error(self):
+
+        # Given, an open circuit
+        clock = FakeClock()
+        with StubServer(bank_routes) as server:
+            transport = self.transport(CircuitBreaker(failures=1, reset_timeout=10, clock=clock.time))
+            url = server.url + '/fr/caisse-epargne/payer'
+            host = urllib.parse.urlparse(url).netloc
+            transport.breaker.failure(host)
+            clock.sleep(10)
+
+            # When, the trial request fails with an error other than a connection error or a timeout
+            with patch('requests.Session.get', side_effect=requests.exceptions.ChunkedEncodingError('truncated')):
+                with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                    transport.get(url, {})
+            opened = transport.breaker.stats()[host]['state']
+            clock.sleep(10)
+            status = transport.get(url, {}).status_code
+
+        # Then, the circuit opened again, and a later trial closed it
+        self.assertEqual('open', opened)
+        self.assertEqual(200, status)
+        self.assertEqual('closed', transport.breaker.stats()[host]['state'])
+
+    def test_circuit_breaker_trial_rejected_by_scheduler(self):
+
+        # Given, an open circuit, and a scheduler rejecting the background requests
+        clock = FakeClock()
+        with StubServer(bank_routes) as server:
+            transport = self.transport(CircuitBreaker(failures=1, reset_timeout=10, clock=clock.time))
+            transport.scheduler = RequestScheduler(host_rate=0, account_rate=0, queue_limit=0)
+            url = server.url + '/fr/caisse-epargne/payer'
+            host = urllib.parse.urlparse(url).netloc
+            transport.breaker.failure(host)
+            clock.sleep(10)
+
+            # When, the trial request isn't sent
+            with transport.prioritized(background), self.assertRaises(Exception) as context:
+                transport.get(url, {})
+            released = transport.breaker.stats()[host]
+            status = transport.get(url, {}).status_code
+
+        # Then, the next request was the trial
+        self.assertEqual('Too many requests waiting for %s: 0, retry later' % host, str(context.exception))
+        self.assertEqual(('open', 0), (released['state'], released['requests']))
+        self.assertEqual(1, server.requests)
+        self.assertEqual(200, status)
+        self.assertEqual('closed', transport.breaker.stats()[host]['state'])
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import threading
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+# durations of the http events, in seconds
+phases = ['connect', 'tls', 'ttfb', 'total']
+
+
+class JSONLinesSink:
+    """Hook writing each http event as a json line, e.g. for --trace."""
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+
+    def __call__(self, event: dict) -> None:
+        line = json.dumps(event) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+
+class PrometheusSink:
+    """Hook aggregating the http events into Prometheus metrics, rendered in the text exposition format."""
+
+    def __init__(self, prefix: str = 'ecard_http'):
+        self.prefix = prefix
+        self.requests = {}
+        self.durations = {}
+        self.bytes = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, event: dict) -> None:
+        step = event['step'] or 'other'
+        status = 'error' if event['status'] is None else str(event['status'])
+        with self.lock:
+            self.requests[(step, status)] = self.requests.get((step, status), 0) + 1
+            for phase in phases:
+                if event[phase] is not None:
+                    total, count = self.durations.get((step, phase), (0.0, 0))
+                    self.durations[(step, phase)] = (total + event[phase], count + 1)
+            for direction in ['request', 'response']:
+                key = (step, direction)
+                self.bytes[key] = self.bytes.get(key, 0) + event[direction + '_bytes']
+
+    def render(self) -> str:
+        with self.lock:
+            lines = ['# HELP ' + self.prefix + '_requests_total HTTP requests by step and status.',
+                     '# TYPE ' + self.prefix + '_requests_total counter']
+            for (step, status), count in sorted(self.requests.items()):
+                lines.append('%s_requests_total{step="%s",status="%s"} %d' % (self.prefix, step, status, count))
+
+            lines += ['# HELP ' + self.prefix + '_duration_seconds HTTP request durations by step and phase.',
+                      '# TYPE ' + self.prefix + '_duration_seconds summary']
+            for (step, phase), (total, count) in sorted(self.durations.items()):
+                labels = '{step="%s",phase="%s"}' % (step, phase)
+                lines.append('%s_duration_seconds_sum%s %.6f' % (self.prefix, labels, total))
+                lines.append('%s_duration_seconds_count%s %d' % (self.prefix, labels, count))
+
+            lines += ['# HELP ' + self.prefix + '_bytes_total HTTP bodies size by step and direction.',
+                      '# TYPE ' + self.prefix + '_bytes_total counter']
+            for (step, direction), size in sorted(self.bytes.items()):
+                lines.append('%s_bytes_total{step="%s",direction="%s"} %d' % (self.prefix, step, direction, size))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str) -> None:
+        """Write the metrics atomically, e.g. for node_exporter's textfile collector."""
+        with open(path + '.tmp', 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(path + '.tmp', path)
+
+
+class OpenTelemetrySink:
+    """Hook turning each http event into an OpenTelemetry span, child of the current span if any.
+
+    The tracer defaults to the global tracer provider's, and needs the opentelemetry-api library.
+    """
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            if otel_trace is None:
+                raise Exception('OpenTelemetrySink needs the opentelemetry-api library: pip3 install opentelemetry-api')
+            tracer = otel_trace.get_tracer('ecard')
+        self.tracer = tracer
+
+    def __call__(self, event: dict) -> None:
+        start = int(event['timestamp'] * 1e9)
+        attributes = {
+            'http.request.method': event['method'],
+            'url.full': event['url'],
+            'http.response.status_code': event['status'],
+            'http.request.body.size': event['request_bytes'],
+            'http.response.body.size': event['response_bytes'],
+            'ecard.step': event['step'],
+            'ecard.connections': event['connections'],
+            'error.type': event['error']
+        }
+        attributes.update({'ecard.' + phase: event[phase] for phase in phases})
+        span = self.tracer.start_span('ecard ' + (event['step'] or 'http'), start_time=start,
+                                      attributes={key: value for key, value in attributes.items() if value is not None})
+        span.end(end_time=start + int(event['total'] * 1e9))
+
+
+def pool_metrics(pools: dict, prefix: str = 'ecard_session_pool') -> str:
+    """Prometheus text exposition of the SessionPool.stats of each bank and card, by (bank, card)."""
+    metrics = [
+        ('sessions', 'gauge', 'Authenticated sessions, idle or in use.'),
+        ('idle', 'gauge', 'Idle sessions, ready to be handed out.'),
+        ('hits', 'counter', 'Sessions handed out without waiting.'),
+        ('misses', 'counter', 'Sessions handed out after a login or a wait.'),
+        ('logins', 'counter', 'Sessions logged in.'),
+        ('keepalives', 'counter', 'Pings keeping idle sessions alive.'),
+        ('evictions', 'counter', 'Expired sessions evicted.'),
+    ]
+    lines = []
+    for name, kind, description in metrics:
+        suffix = '_total' if kind == 'counter' else ''
+        lines += ['# HELP %s_%s%s %s' % (prefix, name, suffix, description),
+                  '# TYPE %s_%s%s %s' % (prefix, name, suffix, kind)]
+        for (bank, card), stats in sorted(pools.items()):
+            lines.append('%s_%s%s{bank="%s",card="%s"} %d' % (prefix, name, suffix, bank, card, stats[name]))
+    lines += ['# HELP ' + prefix + '_warm_up_seconds Mean login time of a session, 3D Secure included.',
+              '# TYPE ' + prefix + '_warm_up_seconds gauge']
+    for (bank, card), stats in sorted(pools.items()):
+        if stats['warm_up'] is not None:
+            lines.append('%s_warm_up_seconds{bank="%s",card="%s"} %.3f' % (prefix, bank, card, stats['warm_up']))
+    return '\n'.join(lines) + '\n'
+
+
+def breaker_metrics(hosts: dict, prefix: str = 'ecard_http') -> str:
+    """Prometheus text exposition of the CircuitBreaker.stats of each host."""
+    metrics = [
+        ('requests', 'requests', 'Requests sent, retries included.'),
+        ('failures', 'failures', 'Requests failed by a connection error, a timeout or a 5xx status.'),
+        ('timeouts', 'timeouts', 'Requests failed by a connect or read timeout.'),
+        ('retries', 'retries', 'Failed requests retried.'),
+        ('rejected', 'rejected', 'Requests failed at once by the open circuit breaker.'),
+        ('breaker_opens', 'opens', 'Openings of the circuit breaker.'),
+    ]
+    lines = []
+    for name, key, description in metrics:
+        lines += ['# HELP %s_%s_total %s' % (prefix, name, description),
+                  '# TYPE %s_%s_total counter' % (prefix, name)]
+        for host, stats in sorted(hosts.items()):
+            lines.append('%s_%s_total{host="%s"} %d' % (prefix, name, host, stats[key]))
+    lines += ['# HELP ' + prefix + '_breaker_open Whether the circuit breaker of the host is open, 0.5 when half-open.',
+              '# TYPE ' + prefix + '_breaker_open gauge']
+    for host, stats in sorted(hosts.items()):
+        lines.append('%s_breaker_open{host="%s"} %g'
+                     % (prefix, host, {'closed': 0, 'half-open': 0.5, 'open': 1}[stats['state']]))
+    return '\n'.join(lines) + '\n'
+
+
+def scheduler_metrics(hosts: dict, prefix: str = 'ecard_scheduler') -> str:
+    """Prometheus text exposition of the RequestScheduler.stats of each host."""
+    metrics = [
+        ('requests_total', 'requests', 'counter', '%d', 'Requests dispatched, retries included.'),
+        ('wait_seconds_total', 'wait_seconds', 'counter', '%.3f', 'Time the requests waited for their turn.'),
+        ('max_wait_seconds', 'max_wait', 'gauge', '%.3f', 'Longest wait of a dispatched request.'),
+        ('queued', 'queued', 'gauge', '%d', 'Requests waiting for their turn.'),
+        ('rejected_total', 'rejected', 'counter', '%d', 'Background requests rejected while too many were waiting.'),
+        ('expired_total', 'expired', 'counter', '%d', 'Requests failed after waiting scheduler_max_wait.'),
+    ]
+    lines = []
+    for name, key, kind, value_format, description in metrics:
+        lines += ['# HELP %s_%s %s' % (prefix, name, description), '# TYPE %s_%s %s' % (prefix, name, kind)]
+        for host, stats in sorted(hosts.items()):
+            lines.append(('%s_%s{host="%s"} ' + value_format) % (prefix, name, host, stats[key]))
+    return '\n'.join(lines) + '\n'
+
+
+def summarize(events: list) -> list:
+    """Rows of the mean durations per step, in milliseconds, and the step's share of the total time."""
+    steps = {}
+    for event in events:
+        steps.setdefault(event['step'] or 'other', []).append(event)
+    overall = sum(event['total'] for event in events) or 1.0
+
+    rows = [['STEP', 'CALLS'] + [phase.upper() for phase in phases] + ['SHARE']]
+    for step, step_events in steps.items():
+        row = [step, str(len(step_events))]
+        for phase in phases:
+            values = [event[phase] for event in step_events if event[phase] is not None]
+            row.append('%.1f ms' % (sum(values) * 1000 / len(values)) if values else '─')
+        row.append('%.0f %%' % (sum(event['total'] for event in step_events) * 100 / overall))
+        rows.append(row)
+    return rows
+
+
+if __name__ == '__main__':
+    from ecard import TableFormatter
+
+    parser = argparse.ArgumentParser(description='summarize a --trace file, per http step')
+    parser.add_argument('trace', help='json lines file written by ecard.py --trace')
+    _args = parser.parse_args()
+
+    with open(_args.trace) as trace_file:
+        table_formatter = TableFormatter()
+        table_formatter.set_rows(summarize([json.loads(line) for line in trace_file if line.strip()]))
+    print(table_formatter)
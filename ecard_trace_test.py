@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+import contextlib
+import io
+import json
+import unittest
+from unittest.mock import patch
+
+import ecard
+from ecard import ECardManager
+from ecard_stub import StubServer, bank_routes, t3ds_routes
+from ecard_trace import JSONLinesSink, OpenTelemetrySink, PrometheusSink, summarize
+
+
+class FakeSpan:
+    def __init__(self, name, start_time, attributes):
+        self.name = name
+        self.start_time = start_time
+        self.attributes = attributes
+        self.end_time = None
+
+    def end(self, end_time):
+        self.end_time = end_time
+
+
+class FakeTracer:
+    def __init__(self):
+        self.spans = []
+
+    def start_span(self, name, start_time, attributes):
+        self.spans.append(FakeSpan(name, start_time, attributes))
+        return self.spans[-1]
+
+
+class ECardTraceTest(unittest.TestCase):
+
+    def run_flow(self, *hooks):
+        with StubServer(bank_routes) as bank_server, StubServer(t3ds_routes) as t3ds_server, \
+                patch.object(ecard, 't3ds_host', t3ds_server.url), patch('builtins.input', return_value='12345678'), \
+                contextlib.redirect_stdout(io.StringIO()):
+            e_card_manager = ECardManager(host=bank_server.url + '/fr/' + ecard.bank)
+            e_card_manager.hooks.extend(hooks)
+            e_card_manager.do_login('login', 'password')
+            e_card_manager.auth_3ds()
+            e_card_manager.generate_ecard('10.54', '1.000000', '3')
+            e_card_manager.do_logout()
+            with self.assertRaises(Exception):
+                e_card_manager._get(bank_server.url + '/unknown', ECardManager.get_common_headers({}))
+            e_card_manager.transport.close()
+
+    def test_http_events(self):
+
+        # Given
+        events = []
+
+        # When
+        self.run_flow(events.append)
+
+        # Then
+        self.assertEqual(['login', 'paRequest', 'authentPage', 'getSession', 'startAuthent', 'updateAuthent',
+                          'endAuthent', 'paRequestFromAuthPages', 'receive3ds', 'cpn', 'logout', None],
+                         [event['step'] for event in events])
+        # the 3D Secure and receive3ds connections are opened ahead, during the previous requests
+        self.assertEqual([1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0], [event['connections'] for event in events])
+        self.assertEqual(404, events[-1]['status'])
+        login = events[0]
+        self.assertEqual('POST', login['method'])
+        self.assertEqual(200, login['status'])
+        self.assertEqual(len('request=login&identifiantCrypte=&app=&identifiant=login&memorize=false'
+                             '&password=password&token=9876543210'), login['request_bytes'])
+        self.assertGreater(login['response_bytes'], 0)
+        self.assertGreater(login['connect'], 0)
+        self.assertEqual(0, login['tls'])
+        self.assertLessEqual(login['connect'] + login['ttfb'], login['total'])
+        self.assertEqual(0, events[2]['connect'])
+
+    @patch.object(ecard, 'prefetch_connections', False)
+    def test_preconnect(self):
+
+        # Given
+        events = []
+        with StubServer(bank_routes) as bank_server:
+            e_card_manager = ECardManager(host=bank_server.url + '/fr/' + ecard.bank)
+            e_card_manager.hooks.append(events.append)
+
+            # When
+            with patch.object(ecard, 'prefetch_connections', True), e_card_manager.preconnecting():
+                credentials = ('login', 'password')
+            e_card_manager.do_login(*credentials)
+            e_card_manager.transport.close()
+
+        # Then, the login reuses the connection opened meanwhile
+        self.assertEqual(0, events[0]['connections'])
+        self.assertEqual(1, bank_server.requests)
+
+        # When, the host is unreachable, the first request will fail instead
+        with patch.object(ecard, 'prefetch_connections', True), \
+                ECardManager(host=bank_server.url + '/fr/' + ecard.bank).preconnecting():
+            pass
+
+    @patch.object(ecard, 'prefetch_connections', False)
+    def test_preconnect_disabled(self):
+
+        # Given
+        events = []
+        with StubServer(bank_routes) as bank_server:
+            e_card_manager = ECardManager(host=bank_server.url + '/fr/' + ecard.bank)
+            e_card_manager.hooks.append(events.append)
+
+            # When
+            with patch.object(e_card_manager.transport, 'prefetch') as mock_prefetch, e_card_manager.preconnecting():
+                credentials = ('login', 'password')
+            e_card_manager.do_login(*credentials)
+            e_card_manager.transport.close()
+
+        # Then, the login opens its own connection
+        mock_prefetch.assert_not_called()
+        self.assertEqual(1, events[0]['connections'])
+
+    def test_sinks(self):
+
+        # Given
+        output = io.StringIO()
+        prometheus = PrometheusSink()
+        tracer = FakeTracer()
+
+        # When
+        self.run_flow(JSONLinesSink(output), prometheus, OpenTelemetrySink(tracer))
+
+        # Then
+        events = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(12, len(events))
+
+        metrics = prometheus.render()
+        self.assertIn('ecard_http_requests_total{step="cpn",status="200"} 1\n', metrics)
+        self.assertIn('ecard_http_requests_total{step="other",status="404"} 1\n', metrics)
+        self.assertIn('ecard_http_duration_seconds_count{step="login",phase="ttfb"} 1\n', metrics)
+
+        self.assertEqual(12, len(tracer.spans))
+        span = tracer.spans[9]
+        self.assertEqual('ecard cpn', span.name)
+        self.assertEqual(200, span.attributes['http.response.status_code'])
+        self.assertEqual(int(events[9]['timestamp'] * 1e9), span.start_time)
+        self.assertGreaterEqual(span.end_time, span.start_time)
+
+        rows = summarize(events)
+        self.assertEqual(['STEP', 'CALLS', 'CONNECT', 'TLS', 'TTFB', 'TOTAL', 'SHARE'], rows[0])
+        self.assertEqual(13, len(rows))
+
+
+if __name__ == '__main__':
+    unittest.main()